@@ -0,0 +1,328 @@
+"""
+Сквозной нагрузочный прогон бота на локальных заглушках Green-API и OpenAI (fakes.py).
+
+Генерирует население чатов (выбор языка, кнопки, форма консультации, свободный текст),
+гонит его через настоящий конвейер WhatsAppBot и печатает msg/s, p50/p95/p99 по стадиям
+и рост памяти. Без сети и ключей — подходит для CI на одной Linux-машине.
+
+    python bench.py --chats 200 --mode poll
+    python bench.py --chats 500 --mode direct --openai-latency 0.3 --json report.json --min-throughput 50
+    python bench.py --chats 200 --mode poll --defaults   # стриминг, кеш ответов и склейка — как в main.py
+
+Режимы подачи:
+    poll    — уведомления лежат в очереди FakeGreenApiServer, бот забирает их NotificationReceiver'ом
+    webhook — уведомления приходят POST'ами на WebhookServer бота
+    direct  — уведомления сразу отдаются диспетчеру (потолок обработки без приёма)
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import fakes
+
+QUESTIONS = {
+    'ru': ["Сколько по времени делается бот?", "Можно интегрировать с Kaspi?", "У нас стоматология, что посоветуете?",
+           "Чем вы отличаетесь от конструкторов?", "Нужен сайт и бот для доставки еды"],
+    'kk': ["Бот жасау қанша уақыт алады?", "Kaspi-мен біріктіруге бола ма?", "Бізде дүкен бар, не ұсынасыз?"],
+    'en': ["How long does a bot take to build?", "Can you integrate with our CRM?", "We run a dental clinic, ideas?"],
+}
+GREETING = {'ru': "Здравствуйте", 'kk': "Сәлем", 'en': "Hello"}
+LANG_PICK = {'ru': "1", 'kk': "2", 'en': "3"}
+FORM = {
+    'ru': ["Айгерим", "ТОО Ромашка", "+7 701 123 45 67", "Бот для записи клиентов"],
+    'kk': ["Айгерим", "жоқ", "+7 701 123 45 67", "Дүкенге бот"],
+    'en': ["John", "none", "+7 701 123 45 67", "Booking bot"],
+}
+
+
+def chat_script(chat_id: str, rnd: random.Random, actions: int) -> list:
+    """Сценарий одного клиента: приветствие → язык → случайные действия (кнопки, интенты, форма, вопросы)."""
+    lang = rnd.choices(['ru', 'kk', 'en'], weights=[6, 2, 2])[0]
+    script = [fakes.incoming_text(chat_id, GREETING[lang])]
+    if rnd.random() < 0.5:
+        script.append(fakes.incoming_button(chat_id, f"lang_{lang}"))
+    else:
+        script.append(fakes.incoming_text(chat_id, LANG_PICK[lang]))
+
+    for _ in range(actions):
+        kind = rnd.choices(["llm", "price", "services", "intent", "form"], weights=[5, 2, 1, 1, 1])[0]
+        if kind == "llm":
+            script.append(fakes.incoming_text(chat_id, rnd.choice(QUESTIONS[lang])))
+        elif kind == "price":
+            script.append(fakes.incoming_button(chat_id, "get_price"))
+        elif kind == "services":
+            script.append(fakes.incoming_button(chat_id, "short_services"))
+        elif kind == "intent":
+            script.append(fakes.incoming_text(chat_id, {"ru": "сколько стоит?", "kk": "баға қандай", "en": "price?"}[lang]))
+        else:
+            script.append(fakes.incoming_button(chat_id, "book_consult"))
+            script.extend(fakes.incoming_text(chat_id, answer) for answer in FORM[lang])
+    return script
+
+
+def population(chats: int, actions: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    return [chat_script(f"7700{i:07d}@c.us", rnd, actions) for i in range(chats)]
+
+
+def interleave(scripts: list) -> list:
+    """Сообщения разных чатов вперемешку, порядок внутри чата сохранён."""
+    queues = [list(s) for s in scripts]
+    out = []
+    while any(queues):
+        for q in queues:
+            if q:
+                out.append(q.pop(0))
+    return out
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * (len(s) - 1) + 0.5))]
+    return {"count": len(s), "mean": sum(s) / len(s), "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99),
+            "max": s[-1]}
+
+
+def make_recording_metrics(main_module):
+    class RecordingMetrics(main_module.Metrics):
+        """Metrics, который дополнительно хранит сырые значения — для точных перцентилей в отчёте."""
+
+        def __init__(self):
+            super().__init__()
+            self.samples = {}
+            self._samples_lock = threading.Lock()
+
+        def observe(self, name, value, **labels):
+            super().observe(name, value, **labels)
+            if name == "bot_stage_seconds":
+                key = ("stage", labels.get("stage"))
+            elif name == "green_api_request_seconds":
+                key = ("green_api", labels.get("method"))
+            else:
+                return
+            with self._samples_lock:
+                self.samples.setdefault(key, []).append(value)
+
+        def count(self, key) -> int:
+            with self._samples_lock:
+                return len(self.samples.get(key, ()))
+
+    return RecordingMetrics()
+
+
+def configure_env(args, green, openai, workdir: str):
+    if not args.defaults:
+        # Воспроизводимый прогон: стриминг и кеш — по флагам, склейка выключена
+        os.environ.update({
+            "LLM_STREAMING": "true" if args.streaming else "false",
+            "ANSWER_CACHE": "true" if args.answer_cache else "false",
+            "COALESCE_WINDOW": "0",
+        })
+    os.environ.update({
+        "INSTANCE_ID": "1101000001",
+        "INSTANCE_TOKEN": "bench-token",
+        "OPENAI_API_KEY": "sk-bench",
+        "GREEN_API_URL": green.url,
+        "OPENAI_BASE_URL": f"{openai.url}/v1",
+        "PRICE_FILE_URL": f"{green.url}/price.pdf",
+        "STATE_BACKEND": args.state,
+        "STATE_DB": os.path.join(workdir, "bot_state.db"),
+        "ACK_JOURNAL": os.path.join(workdir, "ack_journal.jsonl"),
+        "DEDUPE_PATH": os.path.join(workdir, "processed_messages.log"),
+        "LEADS_FILE": os.path.join(workdir, "client_records.jsonl"),
+        "BOT_WORKERS": str(args.workers),
+        "OUTBOUND_RATE": str(args.outbound_rate),
+        "METRICS_PORT": "0",
+        "WEBHOOK_PORT": "0",
+        "RECEIVE_TIMEOUT": "5",
+        "GOOGLE_SHEETS_ENABLED": "false",
+    })
+
+
+def drive(args, bot, main_module, green, notifications: list, scripts: list):
+    """Подаёт уведомления выбранным способом; возвращает функцию остановки приёма."""
+    if args.mode == "direct":
+        for n in notifications:
+            bot._submit(None, {"receiptId": None, "body": n})
+        return lambda: None
+
+    if args.mode == "poll":
+        for n in notifications:
+            green.push(n)
+        bot.receiver = main_module.NotificationReceiver(
+            bot.poll_notification, bot.dispatch, bot._release_head, receive_timeout=bot.receive_timeout,
+        )
+        threading.Thread(target=bot.receiver.run, name="bench-receiver", daemon=True).start()
+        return bot.receiver.stop
+
+    server = bot.start_webhook_server()
+    url = f"http://127.0.0.1:{server.port}{bot.webhook_path}"
+
+    def send_chat(script):
+        sender = fakes.FakeWebhookSender(url, bot.webhook_token)
+        for body in script:
+            while sender.send(body) == 503:
+                time.sleep(0.05)
+
+    pool = ThreadPoolExecutor(max_workers=args.senders, thread_name_prefix="bench-sender")
+    for script in scripts:
+        pool.submit(send_chat, script)
+    return lambda: (pool.shutdown(wait=False), server.stop())
+
+
+def print_report(report: dict):
+    print(f"\n=== {report['mode']}: {report['messages']} сообщений от {report['chats']} чатов, "
+          f"воркеров {report['workers']}{', умолчания main.py' if report.get('defaults') else ''} ===")
+    print(f"время: {report['elapsed']:.2f} с   пропускная способность: {report['msgs_per_sec']:.1f} msg/s"
+          f"{'   (не дождались: таймаут)' if report['timed_out'] else ''}")
+    print(f"OpenAI запросов: {report['openai_requests']}   отправок Green-API: {report['green_sends']}   "
+          f"ошибок (инъекция): green={report['green_errors']} openai={report['openai_errors']}")
+    print(f"память RSS: {report['rss_start_mb']:.1f} → {report['rss_end_mb']:.1f} МБ "
+          f"(+{report['rss_end_mb'] - report['rss_start_mb']:.1f})"
+          + (f"   tracemalloc peak: {report['tracemalloc_peak_mb']:.1f} МБ" if 'tracemalloc_peak_mb' in report else ""))
+    print(f"\n{'стадия':<36}{'n':>8}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+    for name, row in report["stages"].items():
+        if not row.get("count"):
+            continue
+        print(f"{name:<36}{row['count']:>8}{row['p50'] * 1000:>10.1f}{row['p95'] * 1000:>10.1f}"
+              f"{row['p99'] * 1000:>10.1f}{row['max'] * 1000:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальных заглушках")
+    parser.add_argument("--mode", choices=["poll", "webhook", "direct"], default="direct")
+    parser.add_argument("--chats", type=int, default=100)
+    parser.add_argument("--actions", type=int, default=4, help="действий на чат после выбора языка")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--senders", type=int, default=16, help="параллельных отправителей вебхуков")
+    parser.add_argument("--state", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--streaming", action="store_true", help="стриминг ответов LLM")
+    parser.add_argument("--answer-cache", action="store_true", help="включить кеш ответов")
+    parser.add_argument("--defaults", action="store_true",
+                        help="стриминг, кеш ответов и склейка — по умолчаниям main.py (или из окружения)")
+    parser.add_argument("--outbound-rate", type=float, default=0, help="лимит отправок в секунду (0 — без лимита)")
+    parser.add_argument("--green-latency", type=float, default=0.02)
+    parser.add_argument("--green-errors", type=float, default=0.0, help="доля 500 от Green-API")
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="доля 500 от OpenAI")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="пауза между кусками стрима OpenAI")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tracemalloc", action="store_true", help="пик аллокаций Python (медленнее)")
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    parser.add_argument("--min-throughput", type=float, default=0, help="код выхода 1, если msg/s ниже")
+    args = parser.parse_args()
+
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix="qdigit-bench-")
+    os.chdir(workdir)  # CSV заявок и прочие файлы бота — во временный каталог
+
+    green = fakes.FakeGreenApiServer(latency=args.green_latency, jitter=args.green_latency / 2,
+                                     error_rate=args.green_errors, seed=args.seed).start()
+    openai = fakes.FakeOpenAIServer(latency=args.openai_latency, jitter=args.openai_latency / 4,
+                                    error_rate=args.openai_errors, chunk_delay=args.chunk_delay,
+                                    seed=args.seed).start()
+    configure_env(args, green, openai, workdir)
+
+    import main as main_module
+
+    for name in ('whatsapp_bot', 'httpx', 'openai'):
+        main_module.logging.getLogger(name).setLevel(main_module.logging.WARNING)
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    bot = main_module.WhatsAppBot()
+    bot.metrics = make_recording_metrics(main_module)
+    bot.transport.metrics = bot.metrics
+
+    scripts = population(args.chats, args.actions, args.seed)
+    notifications = interleave(scripts)
+    total = len(notifications)
+
+    if bot.workers > 0:
+        bot.dispatcher = main_module.ChatDispatcher(bot._process_journaled, bot.workers, bot.max_pending)
+        bot.dispatcher.start()
+    bot.acks.start()
+
+    rss_start = rss_mb()
+    started = time.monotonic()
+    stop_intake = drive(args, bot, main_module, green, notifications, scripts)
+
+    def busy() -> bool:
+        # Склеенные серии отвечаются позже маршрутизации — ждём и их
+        return (bot.metrics.count(("stage", "process")) < total
+                or (bot.coalescer is not None and bot.coalescer.waiting() > 0)
+                or (bot.dispatcher is not None and bot.dispatcher.pending() > 0))
+
+    deadline = started + args.timeout
+    while busy() and time.monotonic() < deadline:
+        time.sleep(0.02)
+    elapsed = time.monotonic() - started
+    done = bot.metrics.count(("stage", "process"))
+
+    stop_intake()
+    if bot.dispatcher:
+        bot.dispatcher.stop(timeout=30)
+    bot.acks.flush(timeout=10)
+    bot.state.flush()
+
+    report = {
+        "mode": args.mode,
+        "defaults": args.defaults,
+        "chats": args.chats,
+        "messages": total,
+        "processed": done,
+        "timed_out": done < total,
+        "workers": bot.workers,
+        "elapsed": elapsed,
+        "msgs_per_sec": done / elapsed if elapsed else 0.0,
+        "openai_requests": openai.requests.get("chat.completions", 0),
+        "openai_errors": openai.errors,
+        "green_sends": green.sent_count,
+        "green_errors": green.errors,
+        "rss_start_mb": rss_start,
+        "rss_end_mb": rss_mb(),
+        "stages": {},
+        "llm_usage": bot.llm_usage.snapshot(),
+        "breaker": bot.llm_breaker.snapshot(),
+    }
+    if args.tracemalloc:
+        report["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    for (group, name), samples in sorted(bot.metrics.samples.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        report["stages"][f"{group}:{name}"] = percentiles(samples)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    green.stop()
+    openai.stop()
+    if report["timed_out"] or report["msgs_per_sec"] < args.min_throughput:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Микробенчмарк маршрутизации интентов: старый линейный поиск подстрок (словари собираются
+на каждый вызов) против IntentMatcher, скомпилированного один раз.
+
+    python bench_intents.py --n 200000
+"""
+import argparse
+import random
+import time
+
+from main import GREETINGS, INTENT_KEYWORDS, IntentMatcher
+
+SAMPLES = {
+    'ru': ["Здравствуйте, сколько стоит бот для салона?", "Хочу записаться на консультацию",
+           "а можно прайс-лист скинуть", "нужна поддержка, бот не отвечает", "около месяца назад писал вам",
+           "у нас интернет-магазин одежды, 200 заказов в день, интересует автоматизация",
+           "ок", "Привет!", "какие сроки разработки?"],
+    'kk': ["Сәлеметсіз бе, бағасы қандай?", "кеңес алғым келеді", "иә", "қолдау керек", "бот жасау қанша уақыт"],
+    'en': ["Hi! How much does a bot cost?", "I want to book a call", "we need help with integration",
+           "can you share price", "our business is a bakery with delivery", "Hello"],
+}
+
+
+def legacy_route(text: str, lang_code: str) -> set:
+    """Прежняя реализация route_intent/is_greeting — для сравнения."""
+    t = (text or "").lower().strip()
+    price_kw = {
+        'ru': ["цена", "стоимость", "прайс", "сколько стоит", "прайслист", "прайс-лист", "ценник",
+               "давай", "давайте", "скинь", "скиньте", "пришли", "прайс пожалуйста", "прайс пж", "ок", "окей"],
+        'kk': ["баға", "құны", "прайс", "иә", "болсын", "жібер", "жібере сал", "ок"],
+        'en': ["price", "pricing", "cost", "how much", "pricelist", "send price", "ok", "okay", "yes",
+               "share price"]
+    }
+    support_kw = {
+        'ru': ["поддержк", "саппорт", "техпод", "help", "support", "помощь", "свяжитесь"],
+        'kk': ["қолдау", "көмек", "support"],
+        'en': ["support", "help", "contact", "assist"]
+    }
+    consult_keywords = {
+        'ru': ["записаться", "консультац", "созвон", "перезвон", "запишите меня", "запишите"],
+        'kk': ["жазылу", "кеңес", "қоңырау", "жазыңыз мені"],
+        'en': ["schedule", "consultation", "appointment", "call me", "book"]
+    }
+    found = set()
+    if any(k in t for k in price_kw.get(lang_code, [])):
+        found.add("price")
+    if any(k in t for k in support_kw.get(lang_code, [])):
+        found.add("support")
+    if any(k in t for k in consult_keywords.get(lang_code, [])):
+        found.add("consult")
+
+    ru_greetings = {'привет', 'здравствуй', 'здравствуйте', 'салам', 'здорово',
+                    'добрый день', 'добрый вечер', 'доброе утро', 'прив', 'здраст',
+                    'дратути', 'хай', 'приветик', 'приветствую'}
+    kk_greetings = {'сәлем', 'салам', 'сәлеметсіз бе', 'қайырлы таң', 'қайырлы күн', 'қайырлы кеш'}
+    en_greetings = {'hi', 'hello', 'hey', 'good morning', 'good day', 'good evening', 'greetings', 'hiya', 'howdy'}
+    all_greetings = ru_greetings | kk_greetings | en_greetings
+    base = t.replace('!', '').replace(',', '').strip()
+    if t in all_greetings or base in all_greetings:
+        found.add("greeting")
+    return found
+
+
+def make_compiled_route():
+    matcher = IntentMatcher(INTENT_KEYWORDS)
+
+    def route(text: str, lang_code: str) -> set:
+        found = matcher.match(text, lang_code)
+        t = (text or "").lower().strip()
+        if t in GREETINGS or t.replace('!', '').replace(',', '').strip() in GREETINGS:
+            found.add("greeting")
+        return found
+
+    return route
+
+
+def bench(name: str, fn, workload: list) -> float:
+    start = time.perf_counter()
+    for lang, text in workload:
+        fn(text, lang)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<10} {elapsed:8.3f} s   {len(workload) / elapsed:12,.0f} msg/s   "
+          f"{elapsed / len(workload) * 1e6:6.2f} µs/msg")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации интентов")
+    parser.add_argument("--n", type=int, default=200_000, help="число сообщений")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    pool = [(lang, text) for lang, texts in SAMPLES.items() for text in texts]
+    workload = [rnd.choice(pool) for _ in range(args.n)]
+
+    compiled = make_compiled_route()
+    legacy_time = bench("legacy", legacy_route, workload)
+    compiled_time = bench("compiled", compiled, workload)
+    print(f"ускорение: ×{legacy_time / compiled_time:.1f}")
+
+    # Где решения разошлись — ожидаемо только там, где старый поиск ловил ключ внутри слова
+    for lang, text in pool:
+        old, new = legacy_route(text, lang), compiled(text, lang)
+        if old != new:
+            print(f"  [{lang}] {text!r}: legacy={sorted(old)} compiled={sorted(new)}")
+
+
+if __name__ == "__main__":
+    main()
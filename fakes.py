@@ -0,0 +1,468 @@
+"""
+Локальные заглушки для проверки бота без реальных Green-API и Google Sheets.
+
+Пример — прогнать webhook-режим вручную:
+    WEBHOOK_URL=http://localhost:8080/webhook python main.py
+    python fakes.py webhook --url http://localhost:8080/webhook --chat 77001112233@c.us --text "привет"
+
+Локальные Green-API и OpenAI для нагрузочного прогона (см. bench.py):
+    python fakes.py servers --green-port 9001 --openai-port 9002 --latency 0.05
+    GREEN_API_URL=http://127.0.0.1:9001 OPENAI_BASE_URL=http://127.0.0.1:9002/v1 python main.py
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+_ids = itertools.count(1)
+
+
+# === КОНСТРУКТОРЫ УВЕДОМЛЕНИЙ (формат Green-API) ===
+
+def _sender(chat_id: str) -> dict:
+    return {"chatId": chat_id, "sender": chat_id, "senderName": "Test"}
+
+
+def incoming_text(chat_id: str, text: str, message_id: Optional[str] = None) -> dict:
+    return {
+        "typeWebhook": "incomingMessageReceived",
+        "idMessage": message_id or f"FAKE{next(_ids):08d}",
+        "timestamp": int(time.time()),
+        "senderData": _sender(chat_id),
+        "messageData": {"typeMessage": "textMessage", "textMessageData": {"textMessage": text}},
+    }
+
+
+def incoming_button(chat_id: str, button_id: str, button_text: str = "", message_id: Optional[str] = None) -> dict:
+    return {
+        "typeWebhook": "incomingMessageReceived",
+        "idMessage": message_id or f"FAKE{next(_ids):08d}",
+        "timestamp": int(time.time()),
+        "senderData": _sender(chat_id),
+        "messageData": {
+            "typeMessage": "interactiveButtonsResponse",
+            "interactiveButtonsResponse": {"selectedButtonId": button_id, "selectedButtonText": button_text},
+        },
+    }
+
+
+def outgoing_text(chat_id: str, text: str, message_id: Optional[str] = None) -> dict:
+    """Сообщение менеджера с телефона (например, /bot_off)."""
+    body = incoming_text(chat_id, text, message_id)
+    body["typeWebhook"] = "outgoingMessageReceived"
+    return body
+
+
+# === ОТПРАВИТЕЛЬ ВЕБХУКОВ ===
+
+class FakeWebhookSender:
+    """Шлёт вебхуки на локальный WebhookServer так же, как это делает Green-API."""
+
+    def __init__(self, url: str, token: Optional[str] = None, timeout: float = 5):
+        self.url = url
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, body: dict) -> int:
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        r = self.session.post(self.url, json=body, headers=headers, timeout=self.timeout)
+        return r.status_code
+
+    def send_text(self, chat_id: str, text: str) -> int:
+        return self.send(incoming_text(chat_id, text))
+
+    def send_button(self, chat_id: str, button_id: str, button_text: str = "") -> int:
+        return self.send(incoming_button(chat_id, button_id, button_text))
+
+
+# === GOOGLE SHEETS ===
+
+class FakeWorksheet:
+    def __init__(self, title: str, client: Optional["FakeSheetsClient"] = None):
+        self.title = title
+        self.client = client
+        self.rows = []
+
+    def row_values(self, index: int) -> list:
+        return list(self.rows[index - 1]) if len(self.rows) >= index else []
+
+    def update(self, range_name: str, values: list):
+        # Поддерживаем только то, что делает бот: перезапись первой строки
+        if self.rows:
+            self.rows[0] = list(values[0])
+        else:
+            self.rows.append(list(values[0]))
+
+    def append_row(self, row: list, value_input_option: str = "RAW"):
+        self.rows.append(list(row))
+
+    def append_rows(self, rows: list, value_input_option: str = "RAW"):
+        if self.client:
+            self.client._call("append_rows")
+        self.rows.extend(list(r) for r in rows)
+
+
+class FakeSpreadsheet:
+    def __init__(self, client: "FakeSheetsClient"):
+        self.client = client
+        self._sheets = {}
+
+    def worksheets(self) -> list:
+        self.client._call("worksheets")
+        return list(self._sheets.values())
+
+    def worksheet(self, title: str) -> FakeWorksheet:
+        self.client._call("worksheet")
+        return self._sheets[title]
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26) -> FakeWorksheet:
+        self.client._call("add_worksheet")
+        ws = self._sheets[title] = FakeWorksheet(title, self.client)
+        return ws
+
+
+class FakeSheetsClient:
+    """
+    Заглушка gspread.Client для SheetsSink: хранит строки в памяти, считает вызовы API
+    и умеет падать fail_next раз подряд (проверка ретраев).
+    """
+
+    def __init__(self, fail_next: int = 0):
+        self.fail_next = fail_next
+        self.calls = {}
+        self._spreadsheets = {}
+
+    def _call(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.fail_next > 0:
+            self.fail_next -= 1
+            raise ConnectionError(f"fake Sheets failure in {name}")
+
+    def open(self, name: str) -> FakeSpreadsheet:
+        self._call("open")
+        return self._spreadsheets.setdefault(name, FakeSpreadsheet(self))
+
+    def rows(self, spreadsheet: str, worksheet: str) -> list:
+        return self._spreadsheets[spreadsheet]._sheets[worksheet].rows
+
+
+# === HTTP-ЗАГЛУШКИ GREEN-API И OPENAI ===
+
+class _FakeHttpServer:
+    """
+    Общая часть заглушек: ThreadingHTTPServer на 127.0.0.1 (port=0 — свободный порт),
+    задержка latency ± jitter на каждый запрос и доля ошибок error_rate (ответ 500).
+    """
+
+    def __init__(self, port: int = 0, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = {}  # {метод: число запросов}
+        self.errors = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def _delay(self):
+        with self._lock:
+            delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _count(self, name: str) -> bool:
+        """Считает запрос; True — этот запрос должен упасть (инъекция ошибки)."""
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            failed = self.error_rate > 0 and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            return failed
+
+    def handle(self, handler: BaseHTTPRequestHandler, http_method: str):
+        raise NotImplementedError
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело одним пакетом: иначе Nagle + delayed ACK добавляют ~40 мс к каждому ответу
+            wbufsize = 64 * 1024
+            disable_nagle_algorithm = True
+
+            def log_message(self, fmt, *args):
+                pass
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length)) if length else None
+
+            def reply_json(self, status: int, data, headers: Optional[dict] = None):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                server.handle(self, "GET")
+
+            def do_POST(self):
+                server.handle(self, "POST")
+
+            def do_DELETE(self):
+                server.handle(self, "DELETE")
+
+            def do_HEAD(self):
+                server.handle(self, "HEAD")
+
+        return Handler
+
+    def start(self) -> "_FakeHttpServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeGreenApiServer(_FakeHttpServer):
+    """
+    Green-API в памяти: /waInstance{id}/{method}/{token}[/{arg}].
+    push() кладёт уведомление во входящую очередь; receiveNotification отдаёт голову
+    (long-poll до receiveTimeout), deleteNotification удаляет её по receiptId — как настоящий API.
+    Отправки (sendMessage, sendFileByUrl, sendInteractiveButtonsReply) считаются и хранятся в sent.
+    HEAD/GET на любой другой путь отвечает как файл (price_body, ETag price_etag) — для PRICE_FILE_URL;
+    скачивания считаются в file_downloads. uploadFile сохраняет файл в uploads и отдаёт urlFile на него же.
+    """
+
+    SEND_METHODS = {"sendMessage", "sendFileByUrl", "sendInteractiveButtonsReply"}
+
+    def __init__(self, keep_sent: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.keep_sent = keep_sent
+        self.sent = []
+        self.sent_count = 0
+        self.deleted = 0
+        self._inbox = deque()
+        self._inbox_cond = threading.Condition()
+        self._receipts = itertools.count(1)
+        self.price_body = b"%PDF-1.4\n% fake price\n"
+        self.price_etag = '"price-v1"'
+        self.file_downloads = 0
+        self.uploads = []  # [(имя файла, размер)]
+
+    def push(self, body: dict) -> int:
+        receipt_id = next(self._receipts)
+        with self._inbox_cond:
+            self._inbox.append({"receiptId": receipt_id, "body": body})
+            self._inbox_cond.notify_all()
+        return receipt_id
+
+    def inbox_size(self) -> int:
+        with self._inbox_cond:
+            return len(self._inbox)
+
+    def handle(self, handler, http_method: str):
+        parts = urlsplit(handler.path)
+        segments = [p for p in parts.path.split("/") if p]
+        if len(segments) < 3 or not segments[0].startswith("waInstance"):
+            # «Файл» прайса (или загруженная копия)
+            handler.send_response(200)
+            handler.send_header("Content-Type", "application/pdf")
+            handler.send_header("Content-Length", str(len(self.price_body)))
+            handler.send_header("ETag", self.price_etag)
+            handler.end_headers()
+            if http_method == "GET":
+                with self._lock:
+                    self.file_downloads += 1
+                handler.wfile.write(self.price_body)
+            return
+
+        method, args = segments[1], segments[3:]
+        if method == "uploadFile":
+            data = handler.rfile.read(int(handler.headers.get("Content-Length") or 0))
+            file_name = handler.headers.get("GA-Filename") or "file"
+            self._count(method)
+            self._delay()
+            with self._lock:
+                self.uploads.append((file_name, len(data)))
+                n = len(self.uploads)
+            return handler.reply_json(200, {"urlFile": f"{self.url}/uploads/{n}/{file_name}"})
+        payload = handler.read_json() if http_method == "POST" else None
+        failed = self._count(method)
+
+        if method == "receiveNotification":
+            timeout = float((parse_qs(parts.query).get("receiveTimeout") or ["0"])[0])
+            with self._inbox_cond:
+                if not self._inbox and timeout:
+                    self._inbox_cond.wait(min(timeout, 5))
+                head = self._inbox[0] if self._inbox else None
+            self._delay()
+            return handler.reply_json(200, head)
+
+        self._delay()
+        if failed:
+            return handler.reply_json(500, {"error": "injected failure"})
+
+        if method == "deleteNotification":
+            receipt_id = int(args[0]) if args else None
+            with self._inbox_cond:
+                for n in list(self._inbox):
+                    if n["receiptId"] == receipt_id:
+                        self._inbox.remove(n)
+                        self.deleted += 1
+                        break
+            return handler.reply_json(200, {"result": True})
+
+        if method in self.SEND_METHODS:
+            with self._lock:
+                self.sent_count += 1
+                if self.keep_sent:
+                    self.sent.append((method, payload))
+            return handler.reply_json(200, {"idMessage": f"SENT{next(_ids):08d}"})
+
+        handler.reply_json(200, {"saveSettings": True} if method == "setSettings" else {})
+
+
+class FakeOpenAIServer(_FakeHttpServer):
+    """
+    OpenAI-совместимый /v1/chat/completions: обычный ответ и SSE-стрим (stream=true).
+    latency — время до первого токена, chunk_delay — пауза между кусками стрима.
+    usage: prompt_tokens по длине промпта (~3 символа на токен), cached_tokens — общий
+    с предыдущими запросами префикс длиной от 1024 токенов, как у кеша промптов провайдера.
+    """
+
+    REPLY = ("qdigit — делаем чат-боты и автоматизацию для бизнеса 🙂\n\n"
+             "• Сценарии и интеграции с CRM\n• Оплаты и уведомления\n\nРасскажите о вашей нише?")
+
+    def __init__(self, reply: Optional[str] = None, chunk_delay: float = 0.0, chunk_size: int = 12, **kwargs):
+        super().__init__(**kwargs)
+        self.reply = reply or self.REPLY
+        self.chunk_delay = chunk_delay
+        self.chunk_size = max(1, chunk_size)
+        self._prefixes = set()
+
+    def _usage(self, messages: list) -> dict:
+        system = "".join(m.get("content", "") for m in messages if m.get("role") == "system")
+        prompt = sum(len(m.get("content", "")) for m in messages) // 3 + 4 * len(messages)
+        with self._lock:
+            cached = len(system) // 3 if system in self._prefixes else 0
+            self._prefixes.add(system)
+        cached = cached if cached >= 1024 else 0
+        completion = len(self.reply) // 3
+        return {"prompt_tokens": prompt, "completion_tokens": completion, "total_tokens": prompt + completion,
+                "prompt_tokens_details": {"cached_tokens": cached}}
+
+    def handle(self, handler, http_method: str):
+        if http_method != "POST" or not urlsplit(handler.path).path.endswith("/chat/completions"):
+            return handler.reply_json(404, {"error": {"message": "not found"}})
+        request = handler.read_json() or {}
+        failed = self._count("chat.completions")
+        self._delay()
+        if failed:
+            return handler.reply_json(500, {"error": {"message": "injected failure", "type": "server_error"}})
+
+        base = {"id": f"chatcmpl-{next(_ids)}", "created": int(time.time()), "model": request.get("model", "fake")}
+        usage = self._usage(request.get("messages") or [])
+        if not request.get("stream"):
+            return handler.reply_json(200, {
+                **base, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        handler.close_connection = True
+
+        def event(data):
+            handler.wfile.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            handler.wfile.flush()
+
+        chunk = {**base, "object": "chat.completion.chunk"}
+        for i in range(0, len(self.reply), self.chunk_size):
+            event({**chunk, "choices": [{"index": 0, "delta": {"content": self.reply[i:i + self.chunk_size]},
+                                         "finish_reason": None}]})
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+        event({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            event({**chunk, "choices": [], "usage": usage})
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальные заглушки Green-API")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    wh = sub.add_parser("webhook", help="отправить вебхук на локальный приёмник")
+    wh.add_argument("--url", required=True)
+    wh.add_argument("--token")
+    wh.add_argument("--chat", required=True)
+    group = wh.add_mutually_exclusive_group(required=True)
+    group.add_argument("--text")
+    group.add_argument("--button")
+    group.add_argument("--json", help="произвольное тело вебхука")
+
+    srv = sub.add_parser("servers", help="поднять заглушки Green-API и OpenAI")
+    srv.add_argument("--green-port", type=int, default=9001)
+    srv.add_argument("--openai-port", type=int, default=9002)
+    srv.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    srv.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+
+    args = parser.parse_args()
+    if args.cmd == "webhook":
+        sender = FakeWebhookSender(args.url, args.token)
+        if args.json:
+            status = sender.send(json.loads(args.json))
+        elif args.button:
+            status = sender.send_button(args.chat, args.button)
+        else:
+            status = sender.send_text(args.chat, args.text)
+        print(status)
+    elif args.cmd == "servers":
+        green = FakeGreenApiServer(port=args.green_port, latency=args.latency, error_rate=args.error_rate).start()
+        openai = FakeOpenAIServer(port=args.openai_port, latency=args.latency, error_rate=args.error_rate).start()
+        print(f"GREEN_API_URL={green.url}")
+        print(f"OPENAI_BASE_URL={openai.url}/v1")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            green.stop()
+            openai.stop()
+
+
+if __name__ == "__main__":
+    main()
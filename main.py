@@ -1,13 +1,35 @@
+import time
+_IMPORT_STARTED = time.perf_counter()  # --profile-startup: импорт модулей по настенным часам
 import os
+import csv
+import copy
+import asyncio
 import requests
 import json
-import time
 import re
+import hmac
+import bisect
+import math
+import heapq
+import hashlib
+import sqlite3
+import socket
+import sys
+import random
 import logging
-from datetime import datetime
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 from dotenv import load_dotenv
 from typing import Optional
-from openai import OpenAI
 
 load_dotenv()
 
@@ -15,42 +37,3231 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger = logging.getLogger('whatsapp_bot')
 
 
-class WhatsAppBot:
+# === МЕТРИКИ (Prometheus) ===
+class _StageTimer:
+    """Контекстный менеджер Metrics.timer: outcome можно уточнить внутри блока, при исключении — "error"."""
+
+    def __init__(self, metrics: "Metrics", name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self) -> "_StageTimer":
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.labels["outcome"] = "error"
+        self.labels.setdefault("outcome", "ok")
+        self.metrics.observe(self.name, time.monotonic() - self.started, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    Минимальный реестр метрик в текстовом формате Prometheus: счётчики, гистограммы
+    и коллекторы (функции, которые на каждый scrape отдают текущие значения чужих счётчиков).
+    Метки передаются keyword-аргументами: metrics.inc("x_total", stage="llm", outcome="ok").
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
     def __init__(self):
-        self.instance_id = os.environ.get("INSTANCE_ID")
-        self.api_token = os.environ.get("INSTANCE_TOKEN")
-        self.base_url = f"https://api.green-api.com/waInstance{self.instance_id}"
+        self._lock = threading.Lock()
+        self._meta = {}  # {name: (kind, help, buckets)}
+        self._values = {}  # {name: {labels_key: value | [bucket counts..., sum, count]}}
+        self._collectors = []  # [(name, kind, help, fn)]
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ("counter", help_text, None)
+
+    def histogram(self, name: str, help_text: str, buckets=None):
+        self._meta[name] = ("histogram", help_text, tuple(buckets or self.DEFAULT_BUCKETS))
+
+    def collect(self, name: str, kind: str, help_text: str, fn):
+        """fn() -> число или {(("label", "value"), ...): число}."""
+        self._collectors.append((name, kind, help_text, fn))
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        return tuple(sorted((k, "" if v is None else str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta.get(name, (None, None, self.DEFAULT_BUCKETS))[2] or self.DEFAULT_BUCKETS
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            row = series.get(key)
+            if row is None:
+                row = series[key] = [0] * (len(buckets) + 2)
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def timer(self, name: str, **labels) -> _StageTimer:
+        return _StageTimer(self, name, labels)
+
+    @staticmethod
+    def _fmt_labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        esc = lambda v: v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            snapshot = {name: {k: list(v) if isinstance(v, list) else v for k, v in series.items()}
+                        for name, series in self._values.items()}
+        for name, series in sorted(snapshot.items()):
+            kind, help_text, buckets = self._meta.get(name, ("untyped", "", None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._fmt_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._fmt_labels(key, (('le', repr(float(bound))),))} {cumulative}")
+                lines.append(f"{name}_bucket{self._fmt_labels(key, (('le', '+Inf'),))} {value[-1]}")
+                lines.append(f"{name}_sum{self._fmt_labels(key)} {value[-2]}")
+                lines.append(f"{name}_count{self._fmt_labels(key)} {value[-1]}")
+        grouped = OrderedDict()  # у нескольких инстансов коллекторы одного имени — один блок
+        for name, kind, help_text, fn in self._collectors:
+            grouped.setdefault(name, (kind, help_text, []))[2].append(fn)
+        for name, (kind, help_text, fns) in grouped.items():
+            values = {}
+            for fn in fns:
+                try:
+                    value = fn()
+                except Exception as e:
+                    logger.debug(f"Коллектор {name} упал: {e}")
+                    continue
+                values.update(value if isinstance(value, dict) else {(): value})
+            if not values:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(values.items()):
+                lines.append(f"{name}{self._fmt_labels(self._key(dict(key)))} {value}")
+        return "\n".join(lines) + "\n"
 
-        # ДЕФОЛТЫ, чтобы не было None в тексте
-        self.brand = os.environ.get("BRAND_NAME") or "qdigit"
-        self.support_phone = os.environ.get("SUPPORT_PHONE") or "+7 777 777 77 77"
 
-        # Прайс — публичный прямой URL (см. инструкцию ниже) + дефолтное имя
-        self.price_url = os.environ.get("PRICE_FILE_URL")
-        self.price_filename = os.environ.get("PRICE_FILE_NAME") or "qdigit_price.pdf"
+class TenantMetrics:
+    """Вид на общий реестр Metrics для одного инстанса: ко всем значениям и коллекторам добавляется tenant."""
+
+    def __init__(self, metrics: Metrics, tenant: str):
+        self.base = metrics
+        self.tenant = tenant
+
+    def counter(self, name: str, help_text: str):
+        self.base.counter(name, help_text)
+
+    def histogram(self, name: str, help_text: str, buckets=None):
+        self.base.histogram(name, help_text, buckets)
+
+    def collect(self, name: str, kind: str, help_text: str, fn):
+        def tagged():
+            values = fn()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return {tuple(key) + (("tenant", self.tenant),): value for key, value in values.items()}
+
+        self.base.collect(name, kind, help_text, tagged)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        self.base.inc(name, value, tenant=self.tenant, **labels)
+
+    def observe(self, name: str, value: float, **labels):
+        self.base.observe(name, value, tenant=self.tenant, **labels)
+
+    def timer(self, name: str, **labels) -> _StageTimer:
+        return _StageTimer(self, name, labels)
+
+    def render(self) -> str:
+        return self.base.render()
+
+
+class MetricsServer:
+    """GET /metrics в формате Prometheus на отдельном (по умолчанию локальном) порту."""
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9108):
+        self.metrics = metrics
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                logger.debug("metrics: " + fmt, *args)
+
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = server.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info(f"📈 Метрики: http://{self.httpd.server_address[0]}:{self.port}/metrics")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# === ДИСПЕТЧЕР: пул воркеров с порядком внутри чата ===
+class ChatDispatcher:
+    """
+    Раздаёт уведомления пулу воркеров по ключу chatId.
+    Сообщения одного чата обрабатываются строго по очереди, разные чаты — параллельно.
+    Общее число ожидающих задач ограничено max_pending: при переполнении submit ждёт (backpressure).
+    """
+
+    def __init__(self, handler, workers: int = 8, max_pending: int = 500):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self._cond = threading.Condition()
+        self._queues = {}  # {chat_id: deque([...])} — чат в словаре = в очереди _ready или в работе
+        self._ready = deque()  # чаты, у которых есть задачи и нет активного воркера
+        self._pending = 0
+        self._stopped = False
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"chat-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        logger.info(f"🧵 Диспетчер запущен: воркеров={self.workers}, лимит очереди={self.max_pending}")
+
+    def submit(self, chat_id: str, item, timeout: Optional[float] = None) -> bool:
+        """Ставит задачу в очередь чата. False — если очередь так и не освободилась за timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending < self.max_pending or self._stopped, timeout):
+                return False
+            if self._stopped:
+                return False
+            q = self._queues.get(chat_id)
+            if q is None:
+                q = self._queues[chat_id] = deque()
+                self._ready.append(chat_id)
+            q.append(item)
+            self._pending += 1
+            self._cond.notify_all()
+            return True
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._pending
+
+    def stop(self, timeout: Optional[float] = None):
+        """Дожидается разбора очереди и останавливает воркеры."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending == 0, timeout)
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ready or self._stopped)
+                if not self._ready:
+                    return
+                chat_id = self._ready.popleft()
+                item = self._queues[chat_id].popleft()
+
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.error(f"Ошибка воркера для {chat_id}: {e}")
+
+            with self._cond:
+                self._pending -= 1
+                if self._queues[chat_id]:
+                    self._ready.append(chat_id)  # в конец — чтобы болтливый чат не занимал воркер
+                else:
+                    del self._queues[chat_id]
+                self._cond.notify_all()
+
+
+# === HTTP-ТРАНСПОРТ GREEN-API ===
+class _GreenApiPolicy:
+    """Общая часть sync/async транспорта: адреса, таймауты по методам, расчёт пауз между ретраями."""
+
+    # Таймауты (сек) по методам Green-API; остальное — default
+    TIMEOUTS = {
+        "sendMessage": 10,
+        "sendFileByUrl": 15,
+        "sendInteractiveButtonsReply": 15,
+        "receiveNotification": 15,
+        "deleteNotification": 10,
+        "setSettings": 10,
+        "default": 15,
+    }
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    # POST-методы, повтор которых ничего не задваивает
+    IDEMPOTENT_POSTS = {"setSettings"}
+
+    def __init__(self, base_url: str, api_token: str, retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 8.0, max_retry_after: float = 60.0, timeouts: Optional[dict] = None):
+        self.base_url = base_url
+        self.api_token = api_token
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        self.timeouts = {**self.TIMEOUTS, **(timeouts or {})}
+        self.on_throttle = None  # on_throttle(delay) — сервер ответил 429, исходящий поток стоит притормозить
+        self.metrics = None  # Metrics: время и исход каждого запроса к Green-API
+
+    def observe(self, method: str, started: float, outcome):
+        if self.metrics:
+            self.metrics.observe("green_api_request_seconds", time.monotonic() - started,
+                                 method=method, outcome=outcome)
+
+    def url(self, method: str, *path) -> str:
+        url = f"{self.base_url}/{method}/{self.api_token}"
+        if path:
+            url += "/" + "/".join(str(p) for p in path)
+        return url
+
+    def timeout_for(self, method: str) -> float:
+        return self.timeouts.get(method, self.timeouts["default"])
+
+    def is_idempotent(self, http_method: str, method: str) -> bool:
+        return http_method in ("GET", "DELETE", "HEAD") or method in self.IDEMPOTENT_POSTS
+
+    def retriable_status(self, status: int, idempotent: bool) -> bool:
+        """5xx мог прийти уже после выполненной отправки — неидемпотентное повторяем только на 429."""
+        return status in self.RETRY_STATUSES if idempotent else status == 429
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Экспоненциальная пауза с полным джиттером: 0..min(max, base * 2^attempt)."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def retry_after(self, headers) -> Optional[float]:
+        """Retry-After в секундах или HTTP-датой; None — если заголовка нет или он битый."""
+        value = (headers or {}).get("Retry-After")
+        if not value:
+            return None
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+        return min(max(delay, 0.0), self.max_retry_after)
+
+    def next_delay(self, attempt: int, status: Optional[int], headers=None) -> float:
+        delay = None
+        if status is not None:
+            delay = self.retry_after(headers)
+        if delay is None:
+            delay = self.backoff_delay(attempt)
+        if status == 429 and self.on_throttle:
+            self.on_throttle(delay)
+        return delay
+
+
+class GreenApiTransport(_GreenApiPolicy):
+    """
+    Синхронный транспорт: один requests.Session с пулом keep-alive соединений на весь бот.
+    Повторяет запрос на 429/5xx и обрывы соединения, учитывая Retry-After.
+    Отправки (sendMessage, sendFileByUrl…) повторяем только на 429 и если соединение
+    не установилось: 5xx, таймаут чтения или обрыв после отправки могли задвоить сообщение.
+    """
+
+    def __init__(self, base_url: str, api_token: str, pool_size: int = 20, session=None, **kwargs):
+        super().__init__(base_url, api_token, **kwargs)
+        # Переданный Session (общий для инстансов процесса) уже настроен и принадлежит владельцу
+        self._own_session = session is None
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+
+    def request(self, http_method: str, method: str, *path, json=None, params=None,
+                timeout: Optional[float] = None) -> requests.Response:
+        url = self.url(method, *path)
+        timeout = timeout or self.timeout_for(method)
+        idempotent = self.is_idempotent(http_method, method)
+
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            try:
+                r = self.session.request(http_method, url, json=json, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.observe(method, started, e.__class__.__name__)
+                retriable = idempotent or self._not_sent(e)
+                if not retriable or attempt >= self.retries:
+                    raise
+                delay = self.next_delay(attempt, None)
+                logger.warning(f"🔁 {method}: {e.__class__.__name__}, повтор через {delay:.1f}с")
+            else:
+                self.observe(method, started, r.status_code)
+                if not self.retriable_status(r.status_code, idempotent) or attempt >= self.retries:
+                    return r
+                delay = self.next_delay(attempt, r.status_code, r.headers)
+                logger.warning(f"🔁 {method}: HTTP {r.status_code}, повтор через {delay:.1f}с")
+            time.sleep(delay)
+
+    @staticmethod
+    def _not_sent(e: Exception) -> bool:
+        """Соединение так и не установилось (DNS, отказ, таймаут подключения) — запрос точно не ушёл."""
+        if isinstance(e, requests.ConnectTimeout):
+            return True
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+    def get(self, method: str, *path, **kwargs) -> requests.Response:
+        return self.request("GET", method, *path, **kwargs)
+
+    def post(self, method: str, *path, **kwargs) -> requests.Response:
+        return self.request("POST", method, *path, **kwargs)
+
+    def delete(self, method: str, *path, **kwargs) -> requests.Response:
+        return self.request("DELETE", method, *path, **kwargs)
+
+    def close(self):
+        if self._own_session:
+            self.session.close()
+
+
+class AsyncGreenApiTransport(_GreenApiPolicy):
+    """То же для asyncio-движка: общий httpx.AsyncClient с пулом соединений."""
+
+    def __init__(self, base_url: str, api_token: str, pool_size: int = 100, client=None, **kwargs):
+        super().__init__(base_url, api_token, **kwargs)
+        import httpx
+
+        self._httpx = httpx
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=min(pool_size, 20))
+        self.client = client or httpx.AsyncClient(limits=limits)
+
+    async def request(self, http_method: str, method: str, *path, json=None, params=None,
+                      timeout: Optional[float] = None):
+        url = self.url(method, *path)
+        timeout = timeout or self.timeout_for(method)
+        idempotent = self.is_idempotent(http_method, method)
+
+        for attempt in range(self.retries + 1):
+            started = time.monotonic()
+            try:
+                r = await self.client.request(http_method, url, json=json, params=params, timeout=timeout)
+            except (self._httpx.TransportError,) as e:
+                self.observe(method, started, e.__class__.__name__)
+                not_sent = (self._httpx.ConnectError, self._httpx.ConnectTimeout, self._httpx.PoolTimeout)
+                retriable = idempotent or isinstance(e, not_sent)
+                if not retriable or attempt >= self.retries:
+                    raise
+                delay = self.next_delay(attempt, None)
+                logger.warning(f"🔁 {method}: {e.__class__.__name__}, повтор через {delay:.1f}с")
+            else:
+                self.observe(method, started, r.status_code)
+                if not self.retriable_status(r.status_code, idempotent) or attempt >= self.retries:
+                    return r
+                delay = self.next_delay(attempt, r.status_code, r.headers)
+                logger.warning(f"🔁 {method}: HTTP {r.status_code}, повтор через {delay:.1f}с")
+            await asyncio.sleep(delay)
+
+    async def get(self, method: str, *path, **kwargs):
+        return await self.request("GET", method, *path, **kwargs)
+
+    async def post(self, method: str, *path, **kwargs):
+        return await self.request("POST", method, *path, **kwargs)
+
+    async def delete(self, method: str, *path, **kwargs):
+        return await self.request("DELETE", method, *path, **kwargs)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# === WEBHOOK-ПРИЁМНИК ===
+class WebhookServer:
+    """
+    HTTP-приёмник вебхуков Green-API (альтернатива опросу receiveNotification).
+    Проверяет тело и токен, ставит уведомление в обработку и сразу отвечает 200.
+    on_notification(body) -> bool: False — очередь переполнена, отвечаем 503 (Green-API повторит).
+    """
+
+    MESSAGE_WEBHOOKS = {"incomingMessageReceived", "outgoingMessageReceived", "outgoingAPIMessageReceived"}
+
+    def __init__(self, on_notification, host: str = "0.0.0.0", port: int = 8080, path: str = "/webhook",
+                 token: Optional[str] = None, max_body: int = 1024 * 1024):
+        self.on_notification = on_notification
+        self.path = path
+        self.token = token
+        self.max_body = max_body
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def validate(self, body) -> Optional[str]:
+        """Возвращает текст ошибки или None, если тело похоже на вебхук Green-API."""
+        if not isinstance(body, dict):
+            return "body must be a JSON object"
+        type_webhook = body.get("typeWebhook")
+        if not isinstance(type_webhook, str) or not type_webhook:
+            return "typeWebhook is required"
+        if type_webhook in self.MESSAGE_WEBHOOKS:
+            sender = body.get("senderData")
+            if not isinstance(sender, dict) or not isinstance(sender.get("chatId"), str):
+                return "senderData.chatId is required"
+            if not isinstance(body.get("messageData"), dict):
+                return "messageData is required"
+            if not isinstance(body.get("idMessage"), str):
+                return "idMessage is required"
+        return None
+
+    def _authorized(self, header: Optional[str]) -> bool:
+        if not self.token:
+            return True
+        value = (header or "").strip()
+        if value.lower().startswith("bearer "):
+            value = value[7:].strip()
+        return hmac.compare_digest(value, self.token)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, fmt, *args):
+                logger.debug("webhook: " + fmt, *args)
+
+            def _reply(self, status: int, text: str = ""):
+                data = text.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                if self.path.split("?", 1)[0] != server.path:
+                    return self._reply(404, "not found")
+                if not server._authorized(self.headers.get("Authorization")):
+                    return self._reply(401, "unauthorized")
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    return self._reply(400, "bad Content-Length")
+                if length <= 0 or length > server.max_body:
+                    return self._reply(413 if length > 0 else 400, "bad body size")
+                try:
+                    body = json.loads(self.rfile.read(length))
+                except (ValueError, UnicodeDecodeError):
+                    return self._reply(400, "invalid JSON")
+                error = server.validate(body)
+                if error:
+                    logger.warning(f"⚠️ Отклонён вебхук: {error}")
+                    return self._reply(400, error)
+                if not server.on_notification(body):
+                    return self._reply(503, "busy")
+                self._reply(200, "ok")
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="webhook-server", daemon=True)
+        self._thread.start()
+        logger.info(f"🌐 Webhook-приёмник слушает порт {self.port}{self.path}")
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# === ПРИЁМ ОПРОСОМ (long-poll) ===
+class NotificationReceiver:
+    """
+    Цикл приёма receiveNotification с long-poll (receiveTimeout), адаптивной паузой и конвейерным ack.
+
+    receiveNotification отдаёт голову очереди, пока её не удалят. Поэтому ack предыдущего уведомления
+    уходит в фоне одновременно с запросом следующего: если Green-API успел сдвинуть очередь — следующее
+    уведомление получено без лишнего круга; если вернулась та же голова — дожидаемся ack и опрашиваем снова.
+    Обработка при этом идёт в воркерах диспетчера и не ждёт ни приёма, ни подтверждения.
+    """
+
+    def __init__(self, fetch, deliver, ack, receive_timeout: int = 20, idle_min: float = 0.2,
+                 idle_max: float = 5.0, error_backoff_max: float = 30.0):
+        self.fetch = fetch  # fetch(receive_timeout) -> (ok, notification|None)
+        self.deliver = deliver  # deliver(notification) -> True, если receipt ещё нужно подтвердить
+        self.ack = ack  # ack(receipt_id) -> bool
+        self.receive_timeout = receive_timeout
+        self.idle_min = idle_min
+        self.idle_max = idle_max
+        self.error_backoff_max = error_backoff_max
+        self._acks = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ack")
+        self._recent_acks = OrderedDict()  # {receipt_id: Future} — последние подтверждения
+        self._recent_limit = 1024
+        self._stopped = threading.Event()
+        self._thread = None  # поток, в котором идёт run()
+        self._finished = threading.Event()
+
+    def idle_delay(self, empty_polls: int) -> float:
+        """Пустой long-poll уже подождал на сервере; без long-poll — растущая пауза idle_min..idle_max."""
+        if self.receive_timeout > 0:
+            return 0.0
+        return min(self.idle_max, self.idle_min * (2 ** min(empty_polls, 10)))
+
+    def error_delay(self, errors: int) -> float:
+        return random.uniform(0.5, 1.0) * min(self.error_backoff_max, 0.5 * (2 ** min(errors, 10)))
+
+    def _ack_async(self, receipt_id):
+        self._recent_acks[receipt_id] = self._acks.submit(self.ack, receipt_id)
+        self._recent_acks.move_to_end(receipt_id)
+        while len(self._recent_acks) > self._recent_limit:
+            self._recent_acks.popitem(last=False)
+
+    def run(self):
+        self._thread = threading.current_thread()
+        try:
+            self._loop()
+        finally:
+            # Executor закрывается только здесь: до выхода из цикла он может понадобиться _ack_async
+            self._acks.shutdown(wait=True)
+            self._finished.set()
+
+    def _loop(self):
+        empty_polls = 0
+        errors = 0
+        while not self._stopped.is_set():
+            ok, notification = self.fetch(self.receive_timeout)
+            if not ok:
+                errors += 1
+                self._stopped.wait(self.error_delay(errors))
+                continue
+            errors = 0
+
+            if not notification:
+                empty_polls += 1
+                delay = self.idle_delay(empty_polls)
+                if delay:
+                    self._stopped.wait(delay)
+                continue
+            empty_polls = 0
+
+            receipt_id = notification.get('receiptId')
+            pending = self._recent_acks.get(receipt_id)
+            if pending is not None:
+                # Голова ещё не удалена (или ответ пришёл раньше удаления): ждём свой ack,
+                # а если он не прошёл — подтверждаем ещё раз. Повторно не обрабатываем.
+                if not pending.result():
+                    self._ack_async(receipt_id)
+                    self._recent_acks[receipt_id].result()
+                continue
+
+            if self.deliver(notification) and receipt_id:
+                self._ack_async(receipt_id)
+
+    def stop(self, wait: bool = True):
+        """
+        Останавливает приём. Идущий long-poll не прерывается: wait=True ждёт его и отправленных ack,
+        wait=False возвращается сразу (executor закроет сам цикл после выхода).
+        """
+        self._stopped.set()
+        if self._thread is None:
+            self._acks.shutdown(wait=True)  # run() не запускался
+        elif wait and self._thread is not threading.current_thread():
+            self._finished.wait()
+
+
+# === ПОДТВЕРЖДЕНИЯ (deleteNotification) ===
+class AckPipeline:
+    """
+    Стадия подтверждений: собирает receipt'ы и удаляет уведомления в фоне (пачками, с ограниченной
+    параллельностью), не задерживая ответ клиенту.
+
+    Журнал (JSONL) делает обработку долговечной:
+      accept — уведомление принято в работу (тело сохранено, fsync) — после этого голову очереди
+               Green-API можно освобождать, при рестарте незавершённые accept переигрываются;
+      done   — обработка завершена (fsync); перед ним before_done фиксирует результат (коммит
+               состояния чатов), только после этого receipt ставится на удаление;
+      ack / fail — результат deleteNotification; done без ack при рестарте подтверждается повторно.
+    Ключ записи — receiptId, для вебхуков — "wh:<idMessage>" (их подтверждает ответ 200).
+    """
+
+    def __init__(self, ack, journal_path: Optional[str] = "ack_journal.jsonl", concurrency: int = 4,
+                 batch_size: int = 50, max_attempts: int = 5, fsync: bool = True, compact_every: int = 5000,
+                 on_complete=None, before_done=None):
+        self.ack = ack  # ack(receipt_id) -> bool
+        self.before_done = before_done  # before_done() — до записи done (коммит состояния чатов)
+        self.on_complete = on_complete  # on_complete(jid) — после done (кластер закрывает сообщение inbox)
+        self.journal_path = journal_path
+        self.concurrency = max(1, concurrency)
+        self.batch_size = max(1, batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.fsync = fsync
+        self.compact_every = compact_every
+
+        self._cond = threading.Condition()
+        self._open = {}  # {jid: {"n": notification|None, "done": bool, "acked": bool, "ext": bool}}
+        self._closed = OrderedDict()  # недавно закрытые jid — отсечь голову, вернувшуюся до удаления
+        self._queue = deque()  # receipt'ы, ожидающие удаления
+        self._retry = []  # [(когда_повторить, receipt_id)]
+        self._attempts = {}  # {receipt_id: попыток}
+        self._journal = None
+        self._records = 0
+        self._thread = None
+        self._pool = None
+        self._inflight_batch = False
+        self.acked = 0
+        self.failures = 0
+
+    # --- журнал ---
+
+    def _write(self, record: dict, durable: bool = False):
+        if not self.journal_path:
+            return
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._journal.flush()
+        if durable and self.fsync:
+            os.fsync(self._journal.fileno())
+        self._records += 1
+        if self.compact_every and self._records >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        """Переписывает журнал, оставляя только незавершённые записи. Вызывать под _cond."""
+        if not self.journal_path:
+            return
+        tmp = self.journal_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for jid, entry in self._open.items():
+                f.write(json.dumps({"id": jid, "ev": "accept", "n": entry["n"], "ext": entry["ext"]},
+                                   ensure_ascii=False) + "\n")
+                if entry["done"]:
+                    f.write(json.dumps({"id": jid, "ev": "done"}) + "\n")
+                if entry["acked"]:
+                    f.write(json.dumps({"id": jid, "ev": "ack"}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        os.replace(tmp, self.journal_path)
+        self._records = 0
+
+    def recover(self) -> list:
+        """
+        Читает журнал после рестарта: done без ack снова ставит на удаление,
+        а уведомления, принятые, но не обработанные, возвращает как [(jid, notification)].
+        """
+        if not self.journal_path or not os.path.exists(self.journal_path):
+            return []
+        with self._cond:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка при падении
+                    entry = self._open.setdefault(rec.get("id"), self._entry())
+                    ev = rec.get("ev")
+                    if ev == "accept":
+                        entry["n"] = rec.get("n")
+                        entry["ext"] = bool(rec.get("ext"))
+                    elif ev == "done":
+                        entry["done"] = True
+                    elif ev == "ack":
+                        entry["acked"] = True
+
+            replay = []
+            for jid, entry in list(self._open.items()):
+                if entry["done"] and (entry["acked"] or not self._is_receipt(jid)):
+                    self._close(jid)
+                elif entry["done"]:
+                    self._queue.append(jid)
+                elif entry["n"]:
+                    replay.append((jid, entry["n"]))
+                else:
+                    self._close(jid)
+            self._compact()
+            self._cond.notify_all()
+
+        if self._queue or replay:
+            logger.info(f"♻️ Журнал подтверждений: повторный ack={len(self._queue)}, переобработка={len(replay)}")
+        return replay
 
-        # OpenAI
-        self.api_key = os.environ.get("OPENAI_API_KEY")
-        self.client = OpenAI(api_key=self.api_key)
-        self.openai_model = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
+    @staticmethod
+    def _is_receipt(jid) -> bool:
+        return isinstance(jid, int)
+
+    def _close(self, jid):
+        self._open.pop(jid, None)
+        self._closed[jid] = True
+        if len(self._closed) > 1024:
+            self._closed.popitem(last=False)
+
+    @staticmethod
+    def _entry(notification: Optional[dict] = None, ext: bool = False) -> dict:
+        return {"n": notification, "done": False, "acked": False, "ext": ext}
+
+    # --- API для бота ---
+
+    def accept(self, jid, notification: dict, external_ack: bool = True):
+        """
+        Долговечно фиксирует уведомление, принятое в работу. external_ack — голову очереди освобождает
+        вызывающий (приёмник через mark_acked) сразу после accept, не дожидаясь done.
+        """
+        with self._cond:
+            self._open[jid] = self._entry(notification, ext=external_ack)
+            self._write({"id": jid, "ev": "accept", "n": notification, "ext": external_ack}, durable=True)
+
+    def mark_acked(self, jid, ok: bool = True):
+        """Голова очереди освобождена вне конвейера (приёмник после accept)."""
+        with self._cond:
+            entry = self._open.get(jid)
+            if ok and entry is not None:
+                entry["acked"] = True
+                if entry["done"]:
+                    self._close(jid)
+            self._write({"id": jid, "ev": "ack" if ok else "fail"})
+            self._cond.notify_all()
+
+    def complete(self, jid):
+        """Обработка завершена: фиксируем done и, если нужно, ставим receipt на удаление."""
+        if jid is None:
+            return
+        if self.before_done:
+            # Результат обработки должен пережить падение раньше, чем receipt уйдёт на удаление
+            self.before_done()
+        with self._cond:
+            entry = self._open.setdefault(jid, self._entry())
+            if entry["done"]:
+                return  # повторный вызов из того же обработчика
+            entry["done"] = True
+            self._write({"id": jid, "ev": "done"}, durable=True)
+            if entry["acked"] or not self._is_receipt(jid):
+                self._close(jid)
+            elif entry["ext"]:
+                pass  # голову освобождает приёмник, запись закроет mark_acked
+            else:
+                self._queue.append(jid)
+                self._cond.notify_all()
+        if self.on_complete:
+            self.on_complete(jid)
+        self.start()
+
+    def is_pending(self, jid) -> bool:
+        with self._cond:
+            return jid in self._open
+
+    def is_closed(self, jid) -> bool:
+        """Запись недавно закрыта: уведомление обработано и подтверждено."""
+        with self._cond:
+            return jid in self._closed
+
+    def wait(self, jid, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока запись закроется (обработана и подтверждена)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: jid not in self._open, timeout)
+
+    # --- фоновая отправка ---
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="ack")
+            self._thread = threading.Thread(target=self._flusher, name="ack-flusher", daemon=True)
+            self._thread.start()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока очередь на удаление опустеет (ретраи с паузой не ждёт)."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._inflight_batch, timeout)
+
+    def _flusher(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                while self._retry and self._retry[0][0] <= now:
+                    self._queue.append(heapq.heappop(self._retry)[1])
+                if not self._queue:
+                    wait = (self._retry[0][0] - now) if self._retry else None
+                    self._cond.wait(wait)
+                    continue
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._inflight_batch = True
+
+            results = list(self._pool.map(self._ack_one, batch))
+
+            with self._cond:
+                for jid, ok in zip(batch, results):
+                    entry = self._open.get(jid)
+                    if ok:
+                        self.acked += 1
+                        self._attempts.pop(jid, None)
+                        if entry is not None:
+                            self._close(jid)
+                        self._write({"id": jid, "ev": "ack"})
+                        continue
+                    self.failures += 1
+                    attempts = self._attempts.get(jid, 0) + 1
+                    self._attempts[jid] = attempts
+                    self._write({"id": jid, "ev": "fail", "attempt": attempts})
+                    if attempts < self.max_attempts:
+                        heapq.heappush(self._retry, (time.time() + min(60, 2 ** attempts), jid))
+                    else:
+                        # Остаётся в журнале как done без ack — подтвердим после рестарта
+                        logger.error(f"❌ Не удалось подтвердить уведомление {jid} за {attempts} попыток")
+                        self._attempts.pop(jid, None)
+                self._inflight_batch = False
+                self._cond.notify_all()
+
+    def _ack_one(self, jid) -> bool:
+        try:
+            return bool(self.ack(jid))
+        except Exception as e:
+            logger.error(f"Ошибка подтверждения {jid}: {e}")
+            return False
+
+
+# === КЛАСТЕР: общий inbox и аренда разделов ===
+class ClusterStore:
+    """
+    Общее для узлов кластера хранилище в одном SQLite-файле (WAL, на общем локальном диске):
+      nodes  — heartbeat живых узлов;
+      leases — аренды с истечением: "poller" (кто опрашивает Green-API) и "part:<n>" (разделы чатов);
+      inbox  — принятые уведомления; state 0 — ждёт, 1 — взято узлом, 2 — обработано
+               (хранится keep секунд, чтобы повторная доставка того же idMessage отсеялась);
+      leads  — заявки всех узлов (ClusterLeadLog), чтобы /clients на любом узле видел все.
+    """
+
+    def __init__(self, path: str = "cluster.db", partitions: int = 64):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._tx() as c:
+            c.execute("CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+            c.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL,"
+                      " expires REAL NOT NULL)")
+            c.execute("CREATE TABLE IF NOT EXISTS inbox (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                      " part INTEGER NOT NULL, chat_id TEXT NOT NULL, msg_id TEXT UNIQUE, body TEXT NOT NULL,"
+                      " state INTEGER NOT NULL DEFAULT 0, claimed_by TEXT, updated_at REAL NOT NULL)")
+            c.execute("CREATE INDEX IF NOT EXISTS inbox_claim ON inbox (state, part, id)")
+            c.execute("CREATE TABLE IF NOT EXISTS leads (id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                      " phone TEXT NOT NULL, recorded_at TEXT NOT NULL, body TEXT NOT NULL)")
+            c.execute("CREATE INDEX IF NOT EXISTS leads_phone ON leads (phone, id)")
+            c.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('partitions', ?)", (str(partitions),))
+            stored = int(c.execute("SELECT value FROM meta WHERE key = 'partitions'").fetchone()[0])
+        if stored != partitions:
+            raise ValueError(f"{path}: кластер создан с CLUSTER_PARTITIONS={stored}, у узла {partitions}")
+        self.partitions = partitions
+
+    @contextmanager
+    def _tx(self):
+        """Короткая транзакция с блокировкой записи сразу (BEGIN IMMEDIATE) — без гонок между узлами."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    # --- узлы ---
+
+    def heartbeat(self, node: str):
+        with self._tx() as c:
+            c.execute("INSERT OR REPLACE INTO nodes (node, heartbeat) VALUES (?, ?)", (node, time.time()))
+
+    def live_nodes(self, ttl: float) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT node FROM nodes WHERE heartbeat >= ? ORDER BY node",
+                                      (time.time() - ttl,)).fetchall()
+        return [r[0] for r in rows]
+
+    def leave(self, node: str):
+        """Узел уходит штатно: аренды освобождаются, недоделанные им сообщения возвращаются в очередь."""
+        with self._tx() as c:
+            c.execute("DELETE FROM nodes WHERE node = ?", (node,))
+            c.execute("DELETE FROM leases WHERE owner = ?", (node,))
+            c.execute("UPDATE inbox SET state = 0, claimed_by = NULL WHERE state = 1 AND claimed_by = ?", (node,))
+
+    # --- аренды ---
+
+    def try_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Берёт свободную/истёкшую аренду или продлевает свою."""
+        now = time.time()
+        with self._tx() as c:
+            cur = c.execute(
+                "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+                (name, owner, now + ttl, now))
+            return cur.rowcount > 0
+
+    def renew(self, owner: str, ttl: float) -> set:
+        """Продлевает все ещё действующие аренды узла; возвращает их имена (истёкшие потеряны)."""
+        now = time.time()
+        with self._tx() as c:
+            c.execute("UPDATE leases SET expires = ? WHERE owner = ? AND expires >= ?", (now + ttl, owner, now))
+            rows = c.execute("SELECT name FROM leases WHERE owner = ? AND expires >= ?", (owner, now)).fetchall()
+        return {r[0] for r in rows}
+
+    def release(self, name: str, owner: str):
+        with self._tx() as c:
+            c.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+            if name.startswith("part:"):
+                c.execute("UPDATE inbox SET state = 0, claimed_by = NULL WHERE part = ? AND state = 1"
+                          " AND claimed_by = ?", (int(name[5:]), owner))
+
+    def requeue_partition(self, part: int) -> int:
+        """Новый владелец раздела возвращает в очередь то, что взял и не доделал прежний (упавший) узел."""
+        with self._tx() as c:
+            return c.execute("UPDATE inbox SET state = 0, claimed_by = NULL WHERE part = ? AND state = 1",
+                             (part,)).rowcount
+
+    # --- inbox ---
+
+    def enqueue(self, part: int, chat_id: str, msg_id: Optional[str], body: dict) -> bool:
+        """False — такой idMessage уже принят (повторная доставка)."""
+        with self._tx() as c:
+            cur = c.execute(
+                "INSERT OR IGNORE INTO inbox (part, chat_id, msg_id, body, state, updated_at)"
+                " VALUES (?, ?, ?, ?, 0, ?)",
+                (part, chat_id, msg_id, json.dumps(body, ensure_ascii=False), time.time()))
+            return cur.rowcount > 0
+
+    def claim(self, owner: str, parts, limit: int) -> list:
+        """Берёт до limit ждущих сообщений своих разделов в порядке поступления: [(id, part, body)]."""
+        parts = list(parts)
+        if not parts or limit <= 0:
+            return []
+        marks = ",".join("?" * len(parts))
+        with self._lock:  # пустой inbox — без блокировки записи
+            if not self._conn.execute(f"SELECT 1 FROM inbox WHERE state = 0 AND part IN ({marks}) LIMIT 1",
+                                      parts).fetchone():
+                return []
+        with self._tx() as c:
+            rows = c.execute(f"SELECT id, part, body FROM inbox WHERE state = 0 AND part IN ({marks})"
+                             f" ORDER BY id LIMIT ?", (*parts, limit)).fetchall()
+            if rows:
+                c.executemany("UPDATE inbox SET state = 1, claimed_by = ?, updated_at = ? WHERE id = ?",
+                              [(owner, time.time(), r[0]) for r in rows])
+        return [(r[0], r[1], json.loads(r[2])) for r in rows]
+
+    def done(self, row_ids: list):
+        now = time.time()
+        with self._tx() as c:
+            c.executemany("UPDATE inbox SET state = 2, updated_at = ? WHERE id = ?", [(now, i) for i in row_ids])
+
+    def requeue(self, row_id: int):
+        with self._tx() as c:
+            c.execute("UPDATE inbox SET state = 0, claimed_by = NULL WHERE id = ? AND state = 1", (row_id,))
+
+    def purge(self, keep: float):
+        with self._tx() as c:
+            c.execute("DELETE FROM inbox WHERE state = 2 AND updated_at < ?", (time.time() - keep,))
+            c.execute("DELETE FROM nodes WHERE heartbeat < ?", (time.time() - 24 * 3600,))
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM inbox WHERE state = 0").fetchone()[0]
+
+    # --- заявки ---
+
+    def add_lead(self, phone: str, rec: dict):
+        with self._tx() as c:
+            c.execute("INSERT INTO leads (phone, recorded_at, body) VALUES (?, ?, ?)",
+                      (phone, rec.get("recorded_at", ""), json.dumps(rec, ensure_ascii=False)))
+
+    def _leads(self, sql: str, args=()) -> list:
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        out = []
+        for phone, body in rows:
+            rec = json.loads(body)
+            rec.pop("phone_key", None)
+            out.append((phone, rec))
+        return out
+
+    def last_leads(self, n: int) -> list:
+        """Последние n клиентов [(phone, record)] — по свежей заявке на телефон, от старых к новым."""
+        return self._leads("SELECT phone, body FROM leads WHERE id IN (SELECT MAX(id) FROM leads GROUP BY phone)"
+                           " ORDER BY id DESC LIMIT ?", (max(n, 0),))[::-1]
+
+    def lead(self, phone: str) -> Optional[dict]:
+        rows = self._leads("SELECT phone, body FROM leads WHERE phone = ? ORDER BY id DESC LIMIT 1", (phone,))
+        return rows[0][1] if rows else None
+
+    def leads_since(self, recorded_at: str) -> list:
+        return self._leads("SELECT phone, body FROM leads WHERE recorded_at >= ? ORDER BY id", (recorded_at,))
+
+    def lead_count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]
+
+    def compact_leads(self) -> int:
+        """Оставляет последнюю заявку на каждый телефон; возвращает число удалённых."""
+        with self._tx() as c:
+            return c.execute("DELETE FROM leads WHERE id NOT IN (SELECT MAX(id) FROM leads GROUP BY phone)").rowcount
+
+
+class ClusterNode:
+    """
+    Узел кластера: несколько процессов бота на одном инстансе Green-API делят работу через ClusterStore.
+
+    Green-API отдаёт уведомления из одной очереди, поэтому её опрашивает только держатель аренды
+    "poller" (on_leader); принятое им или пришедшее вебхуком на любой узел пишется в общий inbox.
+    chatId → раздел по хешу, раздел → узел по консистентному хешированию живых узлов, так что новый
+    узел забирает ~1/N разделов. Раздел обрабатывает только держатель его аренды. При перебалансировке
+    старый владелец перестаёт брать сообщения раздела, дорабатывает начатые и лишь потом отпускает
+    аренду — ответы не задваиваются, порядок внутри чата сохраняется. Аренды упавшего узла истекают
+    через lease_ttl, недоделанное им берёт новый владелец.
+    """
+
+    def __init__(self, store: ClusterStore, node_id: str, submit, persist=None, on_acquire=None,
+                 on_leader=None, lease_ttl: float = 10, heartbeat: float = 2, tick: float = 0.1,
+                 max_inflight: int = 32, keep: float = 3600, vnodes: int = 64):
+        self.store = store
+        self.node_id = node_id
+        self.submit = submit  # submit(jid, notification) -> bool
+        self.persist = persist  # persist() — зафиксировать состояние чатов до отметки done
+        self.on_acquire = on_acquire  # on_acquire(part) — раздел пришёл с другого узла
+        self.on_leader = on_leader  # on_leader(bool) — начать/прекратить опрос Green-API
+        self.lease_ttl = lease_ttl
+        self.heartbeat_every = heartbeat
+        self.tick = tick
+        self.max_inflight = max(1, max_inflight)
+        self.keep = keep
+        self.vnodes = vnodes
+
+        self._lock = threading.Lock()
+        self._owned = set()  # разделы с нашей арендой
+        self._draining = set()  # разделы, которые отдаём: новых сообщений не берём
+        self._inflight = {}  # {part: сообщений в работе}
+        self._claimed = {}  # {row_id: part}
+        self._finished = []  # row_id обработанных, ждут _settle
+        self._leader = False
+        self._unsettled = True  # есть раздел, который надо отдать или забрать — перебалансировка каждый тик
+        self._ring_cache = ((), [])
+        self._wake = threading.Event()
+        self._closing = threading.Event()  # stop(): только продлеваем аренды, пока воркеры дорабатывают
+        self._stopped = threading.Event()
+        self._tick_lock = threading.Lock()
+        self._thread = None
+
+    # --- хеширование ---
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def partition_of(self, chat_id: str) -> int:
+        return self._hash(chat_id or "") % self.store.partitions
+
+    def _ring(self, nodes: list) -> list:
+        key = tuple(nodes)
+        if self._ring_cache[0] != key:
+            ring = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(self.vnodes))
+            self._ring_cache = (key, ring)
+        return self._ring_cache[1]
+
+    def owner_of(self, part: int, nodes: list) -> Optional[str]:
+        ring = self._ring(nodes)
+        if not ring:
+            return None
+        i = bisect.bisect(ring, (self._hash(f"part:{part}"), "")) % len(ring)
+        return ring[i][1]
+
+    # --- приём и завершение ---
+
+    def enqueue(self, body: dict) -> bool:
+        """Уведомление → общий inbox. True — принято (или уже было принято), голову можно освобождать."""
+        chat_id = (body.get('senderData') or {}).get('chatId', '')
+        try:
+            self.store.enqueue(self.partition_of(chat_id), chat_id, body.get('idMessage'), body)
+        except Exception as e:
+            logger.error(f"Кластер: не удалось записать уведомление в inbox: {e}")
+            return False
+        self._wake.set()
+        return True
+
+    def completed(self, jid):
+        """Хук AckPipeline.complete: сообщение inbox обработано, done отметит цикл узла (_settle)."""
+        if not isinstance(jid, str) or not jid.startswith("inbox:"):
+            return
+        with self._lock:
+            self._finished.append(int(jid[6:]))
+        self._wake.set()
+
+    def _settle(self):
+        """
+        Сначала коммит состояния чатов (persist), потом done в inbox: после падения узла сообщение либо
+        переиграется, либо его результат уже в состоянии. Раздел в работе, пока done не записан.
+        """
+        with self._lock:
+            finished, self._finished = self._finished, []
+        if not finished:
+            return
+        try:
+            if self.persist:
+                self.persist()
+            self.store.done(finished)
+        except Exception:
+            with self._lock:
+                self._finished[:0] = finished
+            raise
+        with self._lock:
+            for row_id in finished:
+                part = self._claimed.pop(row_id, None)
+                if part is not None:
+                    self._inflight[part] = self._inflight.get(part, 1) - 1
+
+    # --- цикл узла ---
+
+    def start(self):
+        self.store.heartbeat(self.node_id)
+        self._thread = threading.Thread(target=self._run, name="cluster-node", daemon=True)
+        self._thread.start()
+        logger.info(f"🕸 Узел кластера {self.node_id}: {self.store.path}, разделов {self.store.partitions}")
+
+    def _run(self):
+        next_heartbeat = 0.0
+        while not self._stopped.is_set():
+            try:
+                with self._tick_lock:
+                    now = time.time()
+                    closing = self._closing.is_set()
+                    self._settle()
+                    if now >= next_heartbeat:
+                        self.store.heartbeat(self.node_id)
+                        self.store.purge(self.keep)
+                        next_heartbeat = now + self.heartbeat_every
+                        if closing:
+                            self.store.renew(self.node_id, self.lease_ttl)
+                        else:
+                            self._rebalance()
+                    elif self._unsettled and not closing:
+                        self._rebalance()
+                    if not closing:
+                        self._claim()
+            except Exception as e:
+                logger.error(f"Кластер: ошибка цикла узла: {e}")
+                self._stopped.wait(1)
+            self._wake.wait(self.tick)
+            self._wake.clear()
+
+    def _rebalance(self):
+        held = self.store.renew(self.node_id, self.lease_ttl)
+        with self._lock:
+            lost = {p for p in self._owned if f"part:{p}" not in held}
+            if lost:
+                logger.warning(f"🕸 Аренда разделов потеряна (узел не продлил вовремя): {sorted(lost)}")
+                self._owned -= lost
+                self._draining -= lost
+
+        if self.on_leader:
+            leader = self.store.try_lease("poller", self.node_id, self.lease_ttl)
+            if leader != self._leader:
+                self._leader = leader
+                logger.info(f"🕸 {self.node_id}: {'опрашиваю' if leader else 'больше не опрашиваю'} Green-API")
+                self.on_leader(leader)
+
+        nodes = self.store.live_nodes(self.lease_ttl)
+        if self.node_id not in nodes:
+            nodes = sorted(nodes + [self.node_id])
+        desired = {p for p in range(self.store.partitions) if self.owner_of(p, nodes) == self.node_id}
+
+        for part in sorted(self._owned - desired):
+            with self._lock:
+                self._draining.add(part)
+                busy = self._inflight.get(part, 0) > 0
+            if busy:
+                continue  # дорабатываем начатое, отпустим на следующем круге
+            self.store.release(f"part:{part}", self.node_id)
+            with self._lock:
+                self._owned.discard(part)
+                self._draining.discard(part)
+
+        for part in sorted(desired - self._owned):
+            if not self.store.try_lease(f"part:{part}", self.node_id, self.lease_ttl):
+                continue  # прежний владелец ещё дорабатывает — заберём позже
+            orphans = self.store.requeue_partition(part)
+            if orphans:
+                logger.info(f"🕸 Раздел {part}: {orphans} недоделанных сообщений возвращено в очередь")
+            if self.on_acquire:
+                self.on_acquire(part)
+            with self._lock:
+                self._owned.add(part)
+                self._draining.discard(part)
+        self._unsettled = self._owned != desired
+
+    def _claim(self):
+        with self._lock:
+            active = self._owned - self._draining
+            budget = self.max_inflight - len(self._claimed)
+        for row_id, part, body in self.store.claim(self.node_id, active, budget):
+            with self._lock:
+                self._claimed[row_id] = part
+                self._inflight[part] = self._inflight.get(part, 0) + 1
+            if not self.submit(f"inbox:{row_id}", {"body": body}):
+                self.store.requeue(row_id)
+                with self._lock:
+                    self._claimed.pop(row_id, None)
+                    self._inflight[part] -= 1
+
+    def stop(self):
+        """
+        Больше не берём сообщения и не опрашиваем Green-API. Аренды разделов продлеваются до leave():
+        иначе, пока воркеры дорабатывают взятое, они истекут и другой узел повторит те же сообщения.
+        """
+        with self._tick_lock:
+            self._closing.set()
+            if self._leader and self.on_leader:
+                self._leader = False
+                self.on_leader(False)
+                self.store.release("poller", self.node_id)  # опрос сразу подхватит другой узел
+
+    def leave(self):
+        """Штатный уход после stop() и остановки воркеров: аренды отпускаются, не дожидаясь истечения."""
+        self._closing.set()
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        try:
+            self._settle()
+            self.store.leave(self.node_id)
+        except Exception as e:
+            logger.error(f"Кластер: ошибка при выходе узла: {e}")
+        with self._lock:
+            self._owned.clear()
+            self._draining.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"owned": len(self._owned), "draining": len(self._draining), "inflight": len(self._claimed),
+                    "leader": int(self._leader)}
+
+
+# === ДЕДУПЛИКАЦИЯ СООБЩЕНИЙ ===
+class DedupeStore:
+    """
+    Множество обработанных idMessage с TTL и LRU-вытеснением: память ограничена max_entries,
+    проверка — O(1). Сохраняется в append-only лог (ts<TAB>id), который перечитывается при старте
+    и периодически ужимается, — повторная доставка после рестарта не получит второй ответ.
+    """
+
+    def __init__(self, path: Optional[str] = "processed_messages.log", max_entries: int = 100_000,
+                 ttl: float = 3 * 24 * 3600):
+        self.path = path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self._items = OrderedDict()  # {message_id: ts}
+        self._lock = threading.Lock()
+        self._log = None
+        self._log_lines = 0
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        cutoff = time.time() - self.ttl
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self._log_lines += 1
+                ts, _, key = line.rstrip("\n").partition("\t")
+                try:
+                    ts = float(ts)
+                except ValueError:
+                    continue
+                if key and ts >= cutoff:
+                    self._items[key] = ts
+                    self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+        logger.info(f"Загружено обработанных сообщений: {len(self._items)}")
+
+    def __contains__(self, key) -> bool:
+        if not key:
+            return False
+        with self._lock:
+            ts = self._items.get(key)
+            if ts is None:
+                return False
+            if time.time() - ts > self.ttl:
+                del self._items[key]
+                return False
+            self._items.move_to_end(key)
+            return True
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, key):
+        if not key:
+            return
+        now = time.time()
+        with self._lock:
+            self._items[key] = now
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+            self._append(now, key)
+
+    def _append(self, ts: float, key: str):
+        if not self.path:
+            return
+        if self._log is None:
+            self._log = open(self.path, "a", encoding="utf-8")
+        self._log.write(f"{ts:.3f}\t{key}\n")
+        self._log.flush()
+        self._log_lines += 1
+        if self._log_lines > 2 * self.max_entries:
+            self._compact()
+
+    def _compact(self):
+        """Переписывает лог живыми записями (под _lock)."""
+        tmp = self.path + ".tmp"
+        cutoff = time.time() - self.ttl
+        with open(tmp, "w", encoding="utf-8") as f:
+            for key, ts in self._items.items():
+                if ts >= cutoff:
+                    f.write(f"{ts:.3f}\t{key}\n")
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        os.replace(tmp, self.path)
+        self._log_lines = len(self._items)
+
+    def flush(self):
+        """Лог и так дописывается на каждое добавление — закрываем файл при остановке."""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+class BloomFilter:
+    """Битовый массив + k хешей (double hashing на blake2b). Ложноположительные возможны, ложноотрицательные — нет."""
+
+    def __init__(self, capacity: int, error_rate: float = 1e-6):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class BloomDedupeStore:
+    """
+    Вероятностный вариант DedupeStore для очень больших объёмов: два Bloom-фильтра, которые сменяются
+    каждые ttl/2 (запись живёт от ttl/2 до ttl). Память фиксирована и не зависит от числа сообщений.
+    Цена — редкая ложная «дубликация» (error_rate), поэтому по умолчанию выбран точный режим.
+    Снимок фильтров пишется в файл раз в snapshot_every добавлений, при смене поколения и в flush();
+    ключи, добавленные после снимка, дописываются в лог (<path>.keys) и при загрузке проигрываются
+    в фильтр — свежие idMessage, которые Green-API присылает повторно, переживают падение.
+    """
+
+    def __init__(self, path: Optional[str] = "processed_messages.bloom", capacity: int = 1_000_000,
+                 error_rate: float = 1e-6, ttl: float = 3 * 24 * 3600, snapshot_every: int = 1000):
+        self.path = path
+        self.log_path = path + ".keys" if path else None
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.snapshot_every = snapshot_every
+        self._lock = threading.Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._rotated_at = time.time()
+        self._dirty = 0
+        self._log = None
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "rb") as f:
+                    meta = json.loads(f.readline())
+                    if meta.get("capacity") != self.capacity or meta.get("error_rate") != self.error_rate:
+                        logger.warning("Параметры Bloom-фильтра изменились, снимок пропущен")
+                    elif time.time() - meta["rotated_at"] < self.ttl:
+                        n = len(self._current.bits)
+                        self._current.bits = bytearray(f.read(n))
+                        self._previous.bits = bytearray(f.read(n))
+                        self._current.count = meta.get("count", 0)
+                        self._previous.count = meta.get("previous_count", 0)
+                        self._rotated_at = meta["rotated_at"]
+                    # Снимок старше ttl: оба поколения истекли — начинаем с пустых фильтров
+            except Exception as e:
+                logger.warning(f"Не удалось загрузить снимок Bloom-фильтра: {e}")
+        self._replay_log()
+        with self._lock:
+            self._maybe_rotate()
+
+    def _replay_log(self):
+        """Ключи после снимка — в текущее поколение (смена поколения обнуляет лог)."""
+        if not os.path.exists(self.log_path):
+            return
+        cutoff = time.time() - self.ttl
+        replayed = 0
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                ts, _, key = line.rstrip("\n").partition("\t")
+                try:
+                    ts = float(ts)
+                except ValueError:
+                    continue  # недописанная строка при падении
+                if key and ts >= cutoff:
+                    self._current.add(key)
+                    replayed += 1
+        self._dirty = replayed
+        if replayed:
+            logger.info(f"Bloom-фильтр: восстановлено ключей после снимка: {replayed}")
+
+    def _snapshot(self):
+        """Пишет снимок и обнуляет лог ключей (под _lock)."""
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        meta = {"capacity": self.capacity, "error_rate": self.error_rate, "rotated_at": self._rotated_at,
+                "count": self._current.count, "previous_count": self._previous.count}
+        with open(tmp, "wb") as f:
+            f.write(json.dumps(meta).encode("utf-8") + b"\n")
+            f.write(self._current.bits)
+            f.write(self._previous.bits)
+        os.replace(tmp, self.path)
+        # Падение между заменой снимка и обнулением лога лишь повторно добавит те же ключи
+        if self._log is not None:
+            self._log.close()
+        self._log = open(self.log_path, "w", encoding="utf-8")
+        self._dirty = 0
+
+    def _maybe_rotate(self):
+        if time.time() - self._rotated_at >= self.ttl / 2:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+            self._rotated_at = time.time()
+            self._snapshot()
+
+    def __contains__(self, key) -> bool:
+        if not key:
+            return False
+        with self._lock:
+            self._maybe_rotate()
+            return key in self._current or key in self._previous
+
+    def __len__(self) -> int:
+        return self._current.count
+
+    def add(self, key):
+        if not key:
+            return
+        with self._lock:
+            self._maybe_rotate()
+            self._current.add(key)
+            self._dirty += 1
+            if self._dirty >= self.snapshot_every:
+                self._snapshot()
+            elif self.log_path:
+                if self._log is None:
+                    self._log = open(self.log_path, "a", encoding="utf-8")
+                self._log.write(f"{time.time():.3f}\t{key}\n")
+                self._log.flush()
+
+    def flush(self):
+        """Снимок при остановке: следующий старт не проигрывает лог."""
+        with self._lock:
+            if self._dirty:
+                self._snapshot()
+
+
+# === ХРАНИЛИЩЕ СОСТОЯНИЯ ЧАТОВ ===
+class MemoryStateStore:
+    """Состояние чатов в памяти процесса (как было раньше): теряется при рестарте."""
+
+    def __init__(self):
+        self._data = {}  # {(ns, chat_id): value}
+        self._lock = threading.Lock()
+
+    def get(self, ns: str, chat_id: str, default=None):
+        with self._lock:
+            return self._data.get((ns, chat_id), default)
+
+    def set(self, ns: str, chat_id: str, value):
+        with self._lock:
+            self._data[(ns, chat_id)] = value
+
+    def delete(self, ns: str, chat_id: str):
+        with self._lock:
+            self._data.pop((ns, chat_id), None)
+
+    def count(self, ns: str) -> int:
+        with self._lock:
+            return sum(1 for (n, _) in self._data if n == ns)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStateStore:
+    """
+    Состояние чатов в SQLite (WAL): точечные чтения/записи по (ns, chat_id), значения — JSON.
+    Записи копятся в открытой транзакции и коммитятся пачкой: каждые commit_every изменений
+    или раз в commit_interval секунд фоновым потоком.
+    """
+
+    def __init__(self, path: str = "bot_state.db", commit_every: int = 100, commit_interval: float = 0.5):
+        self.path = path
+        self.commit_every = max(1, commit_every)
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_state ("
+            " ns TEXT NOT NULL, chat_id TEXT NOT NULL, value TEXT NOT NULL, updated_at REAL NOT NULL,"
+            " PRIMARY KEY (ns, chat_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+        self._dirty = 0
+        self._closed = threading.Event()
+        self._committer = threading.Thread(target=self._commit_loop, name="state-commit", daemon=True)
+        self._committer.start()
+
+    def get(self, ns: str, chat_id: str, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM chat_state WHERE ns = ? AND chat_id = ?", (ns, chat_id)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, ns: str, chat_id: str, value):
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_state (ns, chat_id, value, updated_at) VALUES (?, ?, ?, ?)",
+                (ns, chat_id, data, time.time()))
+            self._mark_dirty()
+
+    def delete(self, ns: str, chat_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_state WHERE ns = ? AND chat_id = ?", (ns, chat_id))
+            self._mark_dirty()
+
+    def set_many(self, ns: str, items: dict):
+        now = time.time()
+        rows = [(ns, k, json.dumps(v, ensure_ascii=False), now) for k, v in items.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chat_state (ns, chat_id, value, updated_at) VALUES (?, ?, ?, ?)", rows)
+            self._mark_dirty(len(rows))
+
+    def count(self, ns: str) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chat_state WHERE ns = ?", (ns,)).fetchone()[0]
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            self._mark_dirty()
+
+    def _mark_dirty(self, n: int = 1):
+        self._dirty += n
+        if self._dirty >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._dirty = 0
+
+    def _commit_loop(self):
+        while not self._closed.wait(self.commit_interval):
+            with self._lock:
+                if self._dirty:
+                    self._commit()
+
+    def flush(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+
+class ChatStateMap(MutableMapping):
+    """
+    dict-подобное окно на одно пространство имён хранилища (язык, форма, ручной режим, история).
+    Чаты подгружаются лениво, по первому обращению, и кешируются (LRU на cache_size чатов).
+    Присваивание пишет в хранилище. Чтение отдаёт копию списков и словарей: правка на месте
+    не должна расходиться с хранилищем, изменения нужно переприсвоить.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, store, ns: str, cache_size: int = 10_000):
+        self.store = store
+        self.ns = ns
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _load(self, chat_id):
+        with self._lock:
+            if chat_id in self._cache:
+                self._cache.move_to_end(chat_id)
+                return self._cache[chat_id]
+            value = self.store.get(self.ns, chat_id, self._MISSING)
+            self._remember(chat_id, value)
+            return value
+
+    def _remember(self, chat_id, value):
+        self._cache[chat_id] = value
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def __getitem__(self, chat_id):
+        value = self._load(chat_id)
+        if value is self._MISSING:
+            raise KeyError(chat_id)
+        return copy.deepcopy(value) if isinstance(value, (list, dict)) else value
+
+    def __setitem__(self, chat_id, value):
+        if isinstance(value, (list, dict)):
+            value = copy.deepcopy(value)  # дальнейшая правка объекта вызывающим не попадёт в кеш
+        with self._lock:
+            self.store.set(self.ns, chat_id, value)
+            self._remember(chat_id, value)
+
+    def __delitem__(self, chat_id):
+        with self._lock:
+            if self._load(chat_id) is self._MISSING:
+                raise KeyError(chat_id)
+            self.store.delete(self.ns, chat_id)
+            self._remember(chat_id, self._MISSING)
+
+    def __contains__(self, chat_id) -> bool:
+        return self._load(chat_id) is not self._MISSING
+
+    def __iter__(self):
+        # Полный обход хранилища не нужен боту; итерируем только по загруженным чатам
+        with self._lock:
+            return iter([k for k, v in self._cache.items() if v is not self._MISSING])
+
+    def __len__(self) -> int:
+        return self.store.count(self.ns)
+
+    def forget(self, predicate):
+        """Выбрасывает из кеша чаты, для которых predicate(chat_id) истинно (их мог менять другой узел)."""
+        with self._lock:
+            for chat_id in [k for k in self._cache if predicate(k)]:
+                del self._cache[chat_id]
+
+
+def make_state_store(backend: str = "sqlite", path: str = "bot_state.db"):
+    if backend.lower() == "memory":
+        return MemoryStateStore()
+    return SqliteStateStore(path)
+
+
+# === ЖУРНАЛ ЗАЯВОК ===
+class LeadLog:
+    """
+    Append-only журнал заявок (JSONL): запись — одна строка в конец файла, O(1).
+    В памяти держится индекс смещений: по телефону (последняя заявка) и по recorded_at
+    (порядок добавления), поэтому «последние N» и поиск по телефону читают только нужные строки.
+    compact() оставляет по одной (последней) заявке на телефон — как было в client_records.json;
+    append() запускает его сам, когда файл перерос compact_bytes и повторов в нём больше половины.
+    """
+
+    def __init__(self, path: str = "client_records.jsonl", compact_bytes: int = 0):
+        self.path = path
+        self.compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._offsets = []  # смещения строк в порядке добавления
+        self._times = []  # recorded_at тех же строк
+        self._sorted = True  # recorded_at не убывают — since() может искать бинарно
+        self._by_phone = {}  # {phone: смещение последней заявки}, порядок — по последней заявке
+        self._file = None
+        self._build_index()
+
+    def _build_index(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for raw in f:
+                try:
+                    rec = json.loads(raw)
+                except ValueError:
+                    rec = None  # недописанная строка при падении
+                if rec is not None:
+                    self._index(offset, rec)
+                offset += len(raw)
+
+    def _index(self, offset: int, rec: dict):
+        recorded_at = rec.get("recorded_at", "")
+        if self._times and recorded_at < self._times[-1]:
+            self._sorted = False
+        self._offsets.append(offset)
+        self._times.append(recorded_at)
+        if rec.get("phone_key"):
+            self._by_phone.pop(rec["phone_key"], None)  # в конец: клиент с самой свежей заявкой
+            self._by_phone[rec["phone_key"]] = offset
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def append(self, phone: str, data: dict) -> dict:
+        rec = {"phone_key": phone, **data}
+        rec.setdefault("recorded_at", datetime.now().isoformat())
+        rec.setdefault("status", "new")
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "ab")
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._index(offset, rec)
+            # Ужимать есть смысл, только если повторные заявки занимают хотя бы половину файла
+            needs_compact = (self.compact_bytes and offset + len(line) >= self.compact_bytes
+                       and len(self._offsets) >= 2 * len(self._by_phone))
+        if needs_compact:
+            try:
+                self.compact()
+            except OSError as e:
+                logger.error(f"Ошибка сжатия журнала заявок: {e}")
+        return rec
+
+    def _read_at(self, offsets: list) -> list:
+        """Читает строки по смещениям. Вызывать под _lock: compact() переписывает файл и смещения."""
+        out = []
+        with open(self.path, "rb") as f:
+            for off in offsets:
+                f.seek(off)
+                rec = json.loads(f.readline())
+                out.append((rec.pop("phone_key", ""), rec))
+        return out
+
+    def last(self, n: int) -> list:
+        """Последние n клиентов [(phone, record)] — по свежей заявке на телефон, от старых к новым."""
+        with self._lock:
+            offsets = list(islice(reversed(self._by_phone.values()), max(n, 0)))[::-1]
+            return self._read_at(offsets) if offsets else []
+
+    def get(self, phone: str) -> Optional[dict]:
+        with self._lock:
+            off = self._by_phone.get(phone)
+            return self._read_at([off])[0][1] if off is not None else None
+
+    def since(self, recorded_at: str) -> list:
+        """Заявки с recorded_at >= заданного (ISO-строка)."""
+        with self._lock:
+            if self._sorted:
+                offsets = self._offsets[bisect.bisect_left(self._times, recorded_at):]
+            else:
+                offsets = [off for off, t in zip(self._offsets, self._times) if t >= recorded_at]
+            return self._read_at(offsets) if offsets else []
+
+    def compact(self):
+        """Переписывает журнал, оставляя последнюю заявку на каждый телефон (атомарно)."""
+        with self._lock:
+            keep = sorted(self._by_phone.values())
+            tmp = self.path + ".tmp"
+            with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+                for off in keep:
+                    src.seek(off)
+                    dst.write(src.readline())
+                dst.flush()
+                os.fsync(dst.fileno())
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            os.replace(tmp, self.path)
+            self._offsets, self._times, self._by_phone, self._sorted = [], [], {}, True
+            self._build_index()
+        logger.info(f"🗜 Журнал заявок ужат: {len(self._offsets)} записей")
+
+    def migrate_json(self, json_path: str = "client_records.json") -> int:
+        """Разовый перенос старого client_records.json ({phone: record}); файл переименовывается в .migrated."""
+        if not os.path.exists(json_path) or len(self):
+            return 0
+        with open(json_path, "r", encoding="utf-8") as f:
+            clients = json.load(f)
+        # Журнал упорядочен по времени заявки, а в старом файле порядок — по первой заявке телефона
+        for phone, data in sorted(clients.items(), key=lambda item: item[1].get("recorded_at", "")):
+            self.append(phone, data)
+        os.replace(json_path, json_path + ".migrated")
+        logger.info(f"Перенесено заявок из {json_path}: {len(clients)}")
+        return len(clients)
+
+
+class ClusterLeadLog(LeadLog):
+    """
+    Журнал заявок в общей базе кластера (CLUSTER_DB) с интерфейсом LeadLog: у каждого узла свой
+    файловый журнал со своим индексом в памяти не видел бы заявок соседей, а compact() одного узла
+    подменял бы файл под дописывающими его остальными.
+    """
+
+    def __init__(self, store: ClusterStore):
+        self.store = store
+
+    def __len__(self) -> int:
+        return self.store.lead_count()
+
+    def append(self, phone: str, data: dict) -> dict:
+        rec = {"phone_key": phone, **data}
+        rec.setdefault("recorded_at", datetime.now().isoformat())
+        rec.setdefault("status", "new")
+        self.store.add_lead(phone, rec)
+        return rec
+
+    def last(self, n: int) -> list:
+        return self.store.last_leads(n)
+
+    def get(self, phone: str) -> Optional[dict]:
+        return self.store.lead(phone)
+
+    def since(self, recorded_at: str) -> list:
+        return self.store.leads_since(recorded_at)
+
+    def compact(self):
+        removed = self.store.compact_leads()
+        logger.info(f"🗜 Журнал заявок кластера ужат: -{removed} записей")
+
+
+# === ЗАПИСЬ ТРАФИКА (для replay.py) ===
+class TrafficCapture:
+    """
+    Опциональная запись входящих уведомлений Green-API в JSONL — по строке {"capturedAt", "body"}.
+    Номера и chatId заменяются HMAC-псевдонимами той же длины: в пределах одного секрета номер
+    всегда даёт один и тот же псевдоним, поэтому диалоги и порядок внутри чата сохраняются, а сами
+    номера в файл не попадают. Номера, набранные в тексте (шаг формы «телефон»), заменяются так же,
+    с сохранением форматирования; имена отправителей не пишутся.
+    """
+    _WA_ID = re.compile(r'(\d{5,})(@c\.us|@g\.us|@s\.whatsapp\.net|@lid)')
+    _PHONE_IN_TEXT = re.compile(r'\+?\d[\d\s\-()]{8,}\d')
+    _NAME_KEYS = {"senderName", "senderContactName", "chatName"}
+    _KEEP_KEYS = {"idMessage", "stanzaId", "typeWebhook", "typeMessage"}
+
+    def __init__(self, path: str = "requests.jsonl", secret: Optional[str] = None,
+                 sample: float = 1.0, max_bytes: int = 0):
+        self.path = path
+        if not secret:
+            secret = os.urandom(16).hex()
+            logger.warning("TRAFFIC_CAPTURE_SECRET не задан — псевдонимы номеров не совпадут между запусками")
+        self._key = secret.encode("utf-8")
+        self.sample = sample
+        self.max_bytes = max_bytes
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._full = False
+
+    def pseudonym(self, digits: str) -> str:
+        """Цифры → цифры той же длины (HMAC-SHA256 по секрету)."""
+        mac = hmac.new(self._key, digits.encode("utf-8"), hashlib.sha256).digest()
+        return str(int.from_bytes(mac, "big")).rjust(len(digits), "0")[-len(digits):]
+
+    def _phone_in_text(self, m) -> str:
+        raw = m.group(0)
+        fake = iter(self.pseudonym("".join(ch for ch in raw if ch.isdigit())))
+        return "".join(next(fake) if ch.isdigit() else ch for ch in raw)
+
+    def scrub(self, value, key: str = ""):
+        if isinstance(value, dict):
+            return {k: ("" if k in self._NAME_KEYS else self.scrub(v, k)) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.scrub(v, key) for v in value]
+        if isinstance(value, str) and key not in self._KEEP_KEYS:
+            value = self._WA_ID.sub(lambda m: self.pseudonym(m.group(1)) + m.group(2), value)
+            return self._PHONE_IN_TEXT.sub(self._phone_in_text, value)
+        if isinstance(value, int) and not isinstance(value, bool) and "phone" in key.lower():
+            return int(self.pseudonym(str(value)))
+        return value
+
+    def record(self, notification: dict):
+        """Пишет тело уведомления; ошибки записи не мешают обработке."""
+        body = (notification or {}).get('body')
+        if not body or self._full or (self.sample < 1 and random.random() >= self.sample):
+            return
+        try:
+            line = (json.dumps({"capturedAt": time.time(), "body": self.scrub(body)},
+                               ensure_ascii=False) + "\n").encode("utf-8")
+            with self._lock:
+                if self._file is None:
+                    self._file = open(self.path, "ab")
+                if self.max_bytes and self._file.tell() + len(line) > self.max_bytes:
+                    self._full = True
+                    logger.warning(f"📼 Запись трафика остановлена: {self.path} достиг лимита")
+                    return
+                self._file.write(line)
+                self._file.flush()
+                self.recorded += 1
+        except Exception as e:
+            logger.error(f"Ошибка записи трафика: {e}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# === GOOGLE SHEETS ===
+def google_sheets_client(creds_json: str):
+    """Авторизует сервисный аккаунт один раз; gspread/google-auth импортируются только здесь."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive",
+    ]
+    credentials = Credentials.from_service_account_info(json.loads(creds_json), scopes=scopes)
+    return gspread.authorize(credentials)
+
+
+class SheetsSink:
+    """
+    Фоновая выгрузка заявок в Google Sheets. Клиент авторизуется один раз, таблица и лист кешируются,
+    заголовок проверяется один раз. Строки копятся в очереди и уходят пачкой через append_rows
+    (до batch_size строк или раз в flush_interval секунд) с повтором при ошибках.
+    client_factory() -> объект с интерфейсом gspread.Client (в тестах — fakes.FakeSheetsClient).
+    """
+
+    HEADERS = ["Дата", "Имя", "Компания", "Телефон", "Задача", "Источник", "Статус"]
+
+    def __init__(self, client_factory, spreadsheet: str, worksheet: str = "Leads", batch_size: int = 50,
+                 flush_interval: float = 2.0, max_queue: int = 10_000, retry_max: float = 300.0):
+        self.client_factory = client_factory
+        self.spreadsheet = spreadsheet
+        self.worksheet = worksheet
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.retry_max = retry_max
+        self._client = None
+        self._ws = None
+        self._rows = deque()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._thread = None
+        self._stopped = False
+        self._flush_requested = False
+        self.sent = 0
+        self.errors = 0
+        self.dropped = 0
+
+    def enqueue(self, row: list):
+        with self._cond:
+            if len(self._rows) >= self.max_queue:
+                self._rows.popleft()
+                self.dropped += 1
+                logger.error("❌ Очередь Google Sheets переполнена, старая строка отброшена")
+            self._rows.append(row)
+            self._cond.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name="sheets-sink", daemon=True)
+                self._thread.start()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Ждёт, пока все поставленные строки уйдут в таблицу."""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._rows and not self._inflight, timeout)
+
+    def stop(self, timeout: Optional[float] = None):
+        self.flush(timeout)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _worksheet(self):
+        if self._ws is not None:
+            return self._ws
+        if self._client is None:
+            self._client = self.client_factory()
+        sh = self._client.open(self.spreadsheet)
+        if self.worksheet not in [w.title for w in sh.worksheets()]:
+            ws = sh.add_worksheet(title=self.worksheet, rows=1000, cols=10)
+        else:
+            ws = sh.worksheet(self.worksheet)
+        first_row = ws.row_values(1)
+        if not first_row or first_row != self.HEADERS:
+            ws.update("A1:G1", [self.HEADERS])
+            logger.info("🧾 Заголовок таблицы обновлён")
+        self._ws = ws
+        return ws
+
+    def _worker(self):
+        attempt = 0
+        while True:
+            with self._cond:
+                # Ждём первую строку, затем даём пачке набраться (или до flush/stop)
+                self._cond.wait_for(lambda: self._rows or self._stopped)
+                if not self._rows:
+                    return
+                self._cond.wait_for(
+                    lambda: len(self._rows) >= self.batch_size or self._stopped or self._flush_requested,
+                    self.flush_interval)
+                self._flush_requested = False
+                batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                self._inflight = len(batch)
+
+            try:
+                self._worksheet().append_rows(batch, value_input_option="USER_ENTERED")
+                self.sent += len(batch)
+                attempt = 0
+                logger.info(f"✅ Добавлено в Google Sheets: {len(batch)}")
+                failed = False
+            except Exception as e:
+                self.errors += 1
+                attempt += 1
+                self._ws = None  # лист/сессия могли протухнуть — переоткроем
+                if attempt >= 3:
+                    self._client = None
+                logger.warning(f"Google Sheets недоступен, повтор (попытка {attempt}): {e}")
+                failed = True
+
+            with self._cond:
+                if failed:
+                    self._rows.extendleft(reversed(batch))
+                self._inflight = 0
+                self._cond.notify_all()
+            if failed:
+                time.sleep(min(self.retry_max, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+# === ПРАЙС: файл загружается в Green-API один раз ===
+class PriceFiles:
+    """
+    Файлы прайса по языкам: sources = {lang: (url, имя файла)}, ключ "" — общий PRICE_FILE_URL.
+
+    sendFileByUrl с исходной ссылкой заставлял Green-API скачивать PDF при каждом нажатии «Прайс».
+    Теперь файл один раз скачивается и загружается через uploadFile, а дальше отправляется ссылка
+    на копию в хранилище Green-API. Копия перезагружается, если у источника сменился ETag/Last-Modified
+    (HEAD не чаще раза в check_interval, в фоне — клиент получает текущую копию сразу) или истёк
+    срок хранения upload_ttl. Ссылки лежат в хранилище состояния и переживают рестарт.
+    Если загрузить не удалось, отправляется исходная ссылка — как раньше.
+    """
+
+    def __init__(self, sources: dict, upload, session, store=None, ns: str = "price_file",
+                 check_interval: float = 600, upload_ttl: float = 14 * 24 * 3600,
+                 max_bytes: int = 100 * 1024 * 1024):
+        self.sources = {lang: src for lang, src in sources.items() if src and src[0]}
+        self.upload = upload  # upload(data, file_name, content_type) -> urlFile | None; None — не загружать
+        self.session = session
+        self.store = store
+        self.ns = ns
+        self.check_interval = check_interval
+        self.upload_ttl = upload_ttl
+        self.max_bytes = max_bytes
+        self.uploads = 0
+        self._entries = {}  # {url: {"url_file", "validator", "uploaded_at"}}
+        self._checked = {}  # {url: когда последний раз сверяли с источником}
+        self._refreshing = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def source(self, lang: str) -> Optional[tuple]:
+        return self.sources.get(lang) or self.sources.get("")
+
+    def resolve(self, lang: str) -> Optional[tuple]:
+        """(ссылка для sendFileByUrl, имя файла, исходная ссылка) или None, если прайс не задан."""
+        src = self.source(lang)
+        if not src:
+            return None
+        url, file_name = src
+        if self.upload is None:
+            return url, file_name, url
+        entry = self._entry(url)
+        due = time.time() - self._checked.get(url, 0) >= self.check_interval
+        if entry is None and due:
+            entry = self.refresh(url, file_name)
+        elif due:
+            self._refresh_later(url, file_name)
+        return (entry["url_file"] if entry else url), file_name, url
+
+    def invalidate(self, url: str):
+        """Копия не отправилась — при следующем нажатии загрузим заново."""
+        with self._lock:
+            self._entries.pop(url, None)
+            self._checked.pop(url, None)
+        if self.store is not None:
+            self.store.delete(self.ns, url)
+
+    def check(self):
+        """Сверка всех источников при старте (из _check_price_link): HEAD, лог и прогрев копий."""
+        for url, file_name in {src[0]: src[1] for src in self.sources.values()}.items():
+            if self.upload is None:
+                self._head(url)
+            else:
+                self.refresh(url, file_name)
+
+    # --- внутреннее ---
+
+    def _entry(self, url: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None and self.store is not None:
+            entry = self.store.get(self.ns, url)
+            if entry:
+                with self._lock:
+                    self._entries[url] = entry
+        if entry and time.time() - entry.get("uploaded_at", 0) >= self.upload_ttl:
+            return None  # Green-API хранит загруженные файлы ограниченное время
+        return entry
+
+    def _refresh_later(self, url: str, file_name: str):
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def job():
+            try:
+                self.refresh(url, file_name)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=job, name="price-refresh", daemon=True).start()
+
+    def refresh(self, url: str, file_name: str) -> Optional[dict]:
+        """Сверяет копию с источником и при необходимости перезагружает. Возвращает актуальную запись."""
+        with self._lock:
+            lock = self._locks.setdefault(url, threading.Lock())
+        with lock:  # одно скачивание на источник, даже если «Прайс» нажали сразу несколько человек
+            entry = self._entry(url)
+            if time.time() - self._checked.get(url, 0) < self.check_interval:
+                return entry  # уже сверили (другой поток или недавняя неудача — до тех пор шлём исходную ссылку)
+            try:
+                validator = self._head(url)
+                if entry is not None and (validator is None or validator == entry.get("validator")):
+                    return entry  # не изменился (или источник недоступен — держим прежнюю копию)
+                fresh = self._upload(url, file_name)
+                if fresh is None:
+                    return entry
+                with self._lock:
+                    self._entries[url] = fresh
+                if self.store is not None:
+                    self.store.set(self.ns, url, fresh)
+                return fresh
+            finally:
+                with self._lock:
+                    self._checked[url] = time.time()
+
+    @staticmethod
+    def _validator(headers) -> Optional[str]:
+        value = headers.get("ETag") or headers.get("Last-Modified")
+        return value or None
+
+    def _head(self, url: str) -> Optional[str]:
+        """ETag/Last-Modified источника; None — HEAD не удался."""
+        try:
+            r = self.session.head(url, timeout=8, allow_redirects=True)
+        except Exception as e:
+            logger.warning(f"Проверка прайса {url} упала: {e}")
+            return None
+        logger.info(f"PRICE_FILE_URL check: {url} status={r.status_code}, size={r.headers.get('Content-Length')}")
+        if r.status_code != 200:
+            return None
+        return self._validator(r.headers) or ""
+
+    def _upload(self, url: str, file_name: str) -> Optional[dict]:
+        try:
+            r = self.session.get(url, timeout=60)
+            r.raise_for_status()
+            data = r.content
+            if not data or len(data) > self.max_bytes:
+                logger.warning(f"Прайс {url}: размер {len(data)} байт — загружать не будем")
+                return None
+            content_type = (r.headers.get("Content-Type") or "").split(";")[0].strip()
+            url_file = self.upload(data, file_name, content_type or "application/octet-stream")
+        except Exception as e:
+            logger.warning(f"Не удалось загрузить прайс {url} в Green-API: {e}")
+            return None
+        if not url_file:
+            return None
+        self.uploads += 1
+        logger.info(f"📎 Прайс {file_name} загружен в Green-API ({len(data)} байт)")
+        return {"url_file": url_file, "validator": self._validator(r.headers) or "", "uploaded_at": time.time()}
+
+
+# === СТРИМИНГ ОТВЕТОВ LLM ===
+class ReplyChunker:
+    """
+    Режет поток токенов на сообщения WhatsApp по границам абзацев и списков: пустая строка
+    или переход «текст ↔ маркированный список» (сам список не рвётся). Кусок отдаётся, как только
+    граница появилась и он не короче min_chars; после max_chunks - 1 кусков остаток уходит последним.
+    """
+
+    BULLET = re.compile(r"^\s*(?:[•\-–*]|\d+[.)])\s")
+
+    def __init__(self, min_chars: int = 60, max_chunks: int = 4):
+        self.min_chars = min_chars
+        self.max_chunks = max(1, max_chunks)
+        self.buf = ""
+        self.emitted = 0
+
+    def _cut(self) -> Optional[int]:
+        """Позиция первой подходящей границы (начало строки) или None."""
+        pos = 0
+        prev_kind = None  # 'bullet' / 'text' последней непустой строки
+        blank = False
+        lines = self.buf.split("\n")
+        for i, line in enumerate(lines):
+            complete = i < len(lines) - 1
+            if not complete and len(line.strip()) < 3:
+                break  # начало строки ещё не пришло — тип не ясен
+            if not line.strip():
+                blank = prev_kind is not None
+            else:
+                kind = 'bullet' if self.BULLET.match(line) else 'text'
+                if prev_kind and (blank or kind != prev_kind) and len(self.buf[:pos].strip()) >= self.min_chars:
+                    return pos
+                prev_kind, blank = kind, False
+            pos += len(line) + 1
+        return None
+
+    def feed(self, delta: str) -> list:
+        self.buf += delta or ""
+        out = []
+        while self.emitted + len(out) < self.max_chunks - 1:
+            cut = self._cut()
+            if cut is None:
+                break
+            out.append(self.buf[:cut].strip())
+            self.buf = self.buf[cut:]
+        self.emitted += len(out)
+        return out
+
+    def close(self) -> list:
+        rest = self.buf.strip()
+        self.buf = ""
+        if rest:
+            self.emitted += 1
+            return [rest]
+        return []
+
+
+# === БЮДЖЕТ ТОКЕНОВ ИСТОРИИ ===
+_token_encoder = None
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Локальная оценка числа токенов: tiktoken, если установлен, иначе ~3 символа на токен
+    (кириллица в cl100k/o200k токенизируется плотнее латиницы, оценка намеренно с запасом).
+    """
+    global _token_encoder
+    if not text:
+        return 0
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    return (len(text) + 2) // 3
+
+
+def message_tokens(message: dict) -> int:
+    # ~4 служебных токена на сообщение (роль и разделители)
+    return estimate_tokens(message.get("content", "")) + 4
+
+
+def history_window_start(hist: list, budget: int) -> int:
+    """Индекс, с которого хвост истории влезает в budget токенов (последняя реплика — всегда)."""
+    used = 0
+    start = len(hist)
+    while start > 0:
+        cost = message_tokens(hist[start - 1])
+        if start < len(hist) and used + cost > budget:
+            break
+        used += cost
+        start -= 1
+    return start
+
+
+# === ИНТЕНТЫ: ключевые слова, компилируются один раз ===
+INTENT_KEYWORDS = {
+    "price": {
+        'ru': ["цена", "стоимость", "прайс", "сколько стоит", "прайслист", "прайс-лист", "ценник",
+               "давай", "давайте", "скинь", "скиньте", "пришли", "прайс пожалуйста", "прайс пж", "ок", "окей"],
+        'kk': ["баға", "құны", "прайс", "иә", "болсын", "жібер", "жібере сал", "ок"],
+        'en': ["price", "pricing", "cost", "how much", "pricelist", "send price", "ok", "okay", "yes",
+               "share price"],
+    },
+    "support": {
+        'ru': ["поддержк", "саппорт", "техпод", "help", "support", "помощь", "свяжитесь"],
+        'kk': ["қолдау", "көмек", "support"],
+        'en': ["support", "help", "contact", "assist"],
+    },
+    "consult": {
+        'ru': ["записаться", "консультац", "созвон", "перезвон", "запишите меня", "запишите"],
+        'kk': ["жазылу", "кеңес", "қоңырау", "жазыңыз мені"],
+        'en': ["schedule", "consultation", "appointment", "call me", "book"],
+    },
+}
+
+GREETINGS = frozenset({
+    # ru
+    'привет', 'здравствуй', 'здравствуйте', 'салам', 'здорово', 'добрый день', 'добрый вечер', 'доброе утро',
+    'прив', 'здраст', 'дратути', 'хай', 'приветик', 'приветствую',
+    # kk
+    'сәлем', 'сәлеметсіз бе', 'қайырлы таң', 'қайырлы күн', 'қайырлы кеш',
+    # en
+    'hi', 'hello', 'hey', 'good morning', 'good day', 'good evening', 'greetings', 'hiya', 'howdy',
+})
+
+
+class IntentMatcher:
+    """
+    Одна регулярка на язык из всех ключевых слов всех интентов: match() за один проход по тексту
+    возвращает множество найденных интентов. Ключ должен начинаться с начала слова (стемы вроде
+    «консультац» матчат продолжения); короткие ключи (≤ short) — только целым словом, чтобы «ок»
+    не срабатывал в «около», а «ok» — в «book». Пробелы внутри фраз матчат любой пробельный разрыв.
+    """
+
+    def __init__(self, keywords: dict, short: int = 3):
+        self._intents = {}  # {lang: {keyword: {intent}}}
+        self._patterns = {}  # {lang: compiled regex}
+        by_lang = {}
+        for intent, langs in keywords.items():
+            for lang, words in langs.items():
+                for w in words:
+                    w = w.lower()
+                    by_lang.setdefault(lang, set()).add(w)
+                    self._intents.setdefault(lang, {}).setdefault(w, set()).add(intent)
+        for lang, words in by_lang.items():
+            alts = []
+            for w in sorted(words, key=len, reverse=True):
+                body = r"\s+".join(re.escape(part) for part in w.split())
+                alts.append(body + (r"(?!\w)" if len(w) <= short else ""))
+            self._patterns[lang] = re.compile(r"(?<!\w)(?:" + "|".join(alts) + ")")
+
+    def match(self, text: str, lang: str) -> set:
+        pattern = self._patterns.get(lang)
+        if pattern is None or not text:
+            return set()
+        table = self._intents[lang]
+        found = set()
+        for m in pattern.finditer(text.lower()):
+            found |= table.get(" ".join(m.group(0).split()), ())
+        return found
+
+
+# === УЧЁТ ТОКЕНОВ LLM (кеш промптов провайдера) ===
+class LLMUsageStats:
+    """
+    Счётчики по языкам: запросы, prompt-токены всего и из кеша провайдера
+    (usage.prompt_tokens_details.cached_tokens), completion-токены и суммарная задержка
+    отдельно для запросов с попаданием в кеш и без — чтобы видеть экономию.
+    """
+
+    FIELDS = ("requests", "prompt_tokens", "cached_tokens", "completion_tokens",
+              "cached_requests", "cached_latency", "uncached_latency")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_lang = {}
+
+    def record(self, lang: str, usage, latency: float):
+        if usage is None:
+            return
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+        with self._lock:
+            row = self._by_lang.setdefault(lang, dict.fromkeys(self.FIELDS, 0))
+            row["requests"] += 1
+            row["prompt_tokens"] += prompt
+            row["cached_tokens"] += cached
+            row["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+            if cached:
+                row["cached_requests"] += 1
+                row["cached_latency"] += latency
+            else:
+                row["uncached_latency"] += latency
+        logger.debug(f"🧾 LLM [{lang}] prompt={prompt} cached={cached} {latency:.2f}s")
+
+    def snapshot(self) -> dict:
+        out = {}
+        with self._lock:
+            for lang, row in self._by_lang.items():
+                uncached = row["requests"] - row["cached_requests"]
+                out[lang] = {
+                    **row,
+                    "cached_ratio": row["cached_tokens"] / row["prompt_tokens"] if row["prompt_tokens"] else 0.0,
+                    "avg_cached_latency": row["cached_latency"] / row["cached_requests"] if row["cached_requests"] else 0.0,
+                    "avg_uncached_latency": row["uncached_latency"] / uncached if uncached else 0.0,
+                }
+        return out
+
+
+# === СКЛЕЙКА СООБЩЕНИЙ ПОДРЯД ===
+class MessageCoalescer:
+    """
+    Копит подряд идущие тексты одного чата, чтобы ответить на серию («привет», «мы стоматология»,
+    «нужен бот», «цена?») одной репликой. Окно window секунд продлевается каждым новым сообщением,
+    но не дольше max_wait от первого (или до max_messages сообщений). По истечении вызывается
+    on_ready(chat_id) — сама обработка забирает накопленное через take(chat_id) в потоке чата.
+    """
+
+    def __init__(self, on_ready, window: float = 2.0, max_wait: float = 8.0, max_messages: int = 6):
+        self.on_ready = on_ready
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max(1, max_messages)
+        self._lock = threading.Lock()
+        self._batches = {}  # {chat_id: {"first": ts, "texts": [...], "message_ids": [...], "ack_ids": [...], "phone": str}}
+        self._timers = {}
+
+    def add(self, chat_id: str, text: str, phone: str = "", message_id: Optional[str] = None, ack_id=None):
+        with self._lock:
+            now = time.monotonic()
+            batch = self._batches.setdefault(
+                chat_id, {"first": now, "texts": [], "message_ids": [], "ack_ids": [], "phone": phone}
+            )
+            if message_id and message_id in batch["message_ids"]:
+                return  # повторная доставка того же сообщения
+            batch["texts"].append(text)
+            batch["message_ids"].append(message_id)
+            if ack_id is not None:
+                batch["ack_ids"].append(ack_id)
+            if len(batch["texts"]) >= self.max_messages:
+                delay = 0
+            else:
+                delay = max(0.0, min(self.window, batch["first"] + self.max_wait - now))
+            self._arm(chat_id, delay)
+
+    def _arm(self, chat_id: str, delay: float):
+        timer = self._timers.pop(chat_id, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(delay, self._fire, args=(chat_id,))
+        timer.daemon = True
+        self._timers[chat_id] = timer
+        timer.start()
+
+    def _fire(self, chat_id: str):
+        with self._lock:
+            self._timers.pop(chat_id, None)
+            if chat_id not in self._batches:
+                return
+        try:
+            self.on_ready(chat_id)
+        except Exception as e:
+            logger.error(f"Ошибка передачи склеенных сообщений {chat_id}: {e}")
+
+    def pending(self, chat_id: str) -> bool:
+        with self._lock:
+            return chat_id in self._batches
+
+    def waiting(self) -> int:
+        """Чатов с несобранной серией."""
+        with self._lock:
+            return len(self._batches)
+
+    def take(self, chat_id: str) -> Optional[dict]:
+        with self._lock:
+            timer = self._timers.pop(chat_id, None)
+            if timer:
+                timer.cancel()
+            return self._batches.pop(chat_id, None)
+
+    def stop(self):
+        """Снимает таймеры; несклеенные сообщения не подтверждены и вернутся из журнала после рестарта."""
+        with self._lock:
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+
+
+# === ПЛАНИРОВЩИК ИСХОДЯЩИХ ===
+class OutboundScheduler:
+    """
+    Общий для инстанса token bucket на исходящие отправки (rate в секунду, запас burst)
+    с классами приоритета: ответы на кнопки и шаги формы → ответы LLM → рассылки.
+    Внутри класса чаты обслуживаются по кругу, так что один болтливый чат не задерживает остальных.
+    Отправитель сам делает запрос после acquire(); планировщик только выдаёт разрешения.
+    pause(sec) — сервер ответил 429: выдача останавливается, накопленный запас сгорает.
+    """
+
+    INTERACTIVE, LLM, BULK = 0, 1, 2
+
+    def __init__(self, rate: float = 10.0, burst: int = 10):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._classes = [OrderedDict() for _ in range(3)]  # [{chat_id: deque([grant, ...])}]
+        self._thread = None
+        self._stopped = False
+        self.granted = [0, 0, 0]
+
+    def acquire(self, chat_id: str, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> bool:
+        if self.rate <= 0:
+            return True
+        event = threading.Event()
+        self._enqueue(chat_id, priority, event.set)
+        return event.wait(timeout)
+
+    async def acquire_async(self, chat_id: str, priority: int = INTERACTIVE):
+        if self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def grant():
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+
+        self._enqueue(chat_id, priority, grant)
+        await fut
+
+    def _enqueue(self, chat_id: str, priority: int, grant):
+        priority = min(max(priority, 0), len(self._classes) - 1)
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="outbound", daemon=True)
+                self._thread.start()
+            self._classes[priority].setdefault(chat_id, deque()).append(grant)
+            self._cond.notify()
+
+    def pause(self, seconds: float):
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+            self._cond.notify()
+        logger.warning(f"🚦 Green-API ответил 429 — исходящие на паузе {seconds:.1f}с")
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(q) for queues in self._classes for q in queues.values())
+
+    def _next(self):
+        """Первый непустой класс; внутри класса — первый чат в очереди, после выдачи он уходит в конец."""
+        for priority, queues in enumerate(self._classes):
+            if queues:
+                chat_id, queue = next(iter(queues.items()))
+                grant = queue.popleft()
+                del queues[chat_id]
+                if queue:
+                    queues[chat_id] = queue
+                self.granted[priority] += 1
+                return grant
+        return None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                if not any(self._classes):
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                if now < self._paused_until:
+                    self._cond.wait(self._paused_until - now)
+                    continue
+                # Запас копится только после паузы: иначе первый проход после 429 вернул бы весь burst
+                refill_from = max(self._last, self._paused_until)
+                self._tokens = min(self.burst, self._tokens + (now - refill_from) * self.rate)
+                self._last = now
+                if self._tokens < 1:
+                    self._cond.wait((1 - self._tokens) / self.rate)
+                    continue
+                self._tokens -= 1
+                grant = self._next()
+            grant()
+
+    def stop(self):
+        """Останавливает выдачу; ждущие отправители отпускаются, чтобы не зависнуть на выходе."""
+        with self._cond:
+            self._stopped = True
+            waiting = [g for queues in self._classes for q in queues.values() for g in q]
+            for queues in self._classes:
+                queues.clear()
+            self._cond.notify_all()
+        for grant in waiting:
+            grant()
+
+
+# === ПРЕДОХРАНИТЕЛЬ LLM ===
+class CircuitBreaker:
+    """
+    Предохранитель вокруг вызова LLM по скользящему окну последних window секунд:
+    если среди не менее min_calls вызовов доля ошибок ≥ failure_ratio или доля медленных
+    (дольше slow_call сек) ≥ slow_ratio — цепь размыкается на open_for секунд и allow() сразу
+    возвращает False. Затем half_open: пропускается probes пробных вызовов; успех замыкает цепь,
+    ошибка снова размыкает. Каждый пропущенный allow() вызов обязан закончиться record().
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, window: float = 60.0, min_calls: int = 5, failure_ratio: float = 0.5,
+                 slow_call: float = 12.0, slow_ratio: float = 0.8, open_for: float = 30.0, probes: int = 1):
+        self.window = window
+        self.min_calls = max(1, min_calls)
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.slow_ratio = slow_ratio
+        self.open_for = open_for
+        self.probes = max(1, probes)
+        self._lock = threading.Lock()
+        self._calls = deque()  # (ts, ok, slow)
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probing = 0
+        self.opened_total = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def _maybe_half_open(self, now: float):
+        if self._state == self.OPEN and now - self._opened_at >= self.open_for:
+            self._state = self.HALF_OPEN
+            self._probing = 0
+            logger.info("🔌 LLM: предохранитель полуоткрыт, пробный запрос")
+
+    def allow(self) -> bool:
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.HALF_OPEN and self._probing < self.probes:
+                self._probing += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, ok: bool, latency: float):
+        now = time.monotonic()
+        slow = latency >= self.slow_call
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probing = max(0, self._probing - 1)
+                if ok and not slow:
+                    self._state = self.CLOSED
+                    self._calls.clear()
+                    logger.info("🔌 LLM: предохранитель замкнут, сервис восстановился")
+                else:
+                    self._open(now)
+                return
+            self._calls.append((now, ok, slow))
+            while self._calls and now - self._calls[0][0] > self.window:
+                self._calls.popleft()
+            if self._state != self.CLOSED or len(self._calls) < self.min_calls:
+                return
+            failures = sum(1 for _, good, _ in self._calls if not good)
+            slows = sum(1 for _, _, is_slow in self._calls if is_slow)
+            if failures / len(self._calls) >= self.failure_ratio or slows / len(self._calls) >= self.slow_ratio:
+                self._open(now)
+
+    def _open(self, now: float):
+        self._state = self.OPEN
+        self._opened_at = now
+        self._calls.clear()
+        self.opened_total += 1
+        logger.warning(f"🔌 LLM: предохранитель разомкнут на {self.open_for:.0f}с — отвечаем без OpenAI")
+
+    def snapshot(self) -> dict:
+        state = self.state
+        return {"state": state, "opened_total": self.opened_total, "rejected": self.rejected}
+
+
+# === КЕШ ОТВЕТОВ НА ТИПОВЫЕ ВОПРОСЫ ===
+class AnswerCache:
+    """
+    Кеш ответов LLM по (язык, нормализованный текст вопроса) с TTL и LRU-вытеснением.
+    fuzzy=True — при промахе ищет похожий вопрос по индексу символьных триграмм (Жаккар ≥ threshold).
+    Счётчики hits / fuzzy_hits / misses — для оценки пользы.
+    """
+
+    def __init__(self, max_entries: int = 2000, ttl: float = 6 * 3600, fuzzy: bool = False,
+                 threshold: float = 0.85, normalize=None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.fuzzy = fuzzy
+        self.threshold = threshold
+        self.normalize = normalize or (lambda t: t)
+        self._items = OrderedDict()  # {(lang, key): (ts, answer)}
+        self._grams = {}  # {(lang, trigram): set(key)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        t = self.normalize(text or "").lower()
+        t = re.sub(r"[^\w\s]", " ", t)
+        return " ".join(t.split())
+
+    @staticmethod
+    def _trigrams(key: str) -> set:
+        padded = f"  {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def get(self, lang: str, text: str) -> Optional[str]:
+        key = self._key(text)
+        if not key:
+            return None
+        with self._lock:
+            answer = self._lookup(lang, key)
+            if answer is not None:
+                self.hits += 1
+                return answer
+            if self.fuzzy:
+                similar = self._most_similar(lang, key)
+                if similar is not None:
+                    answer = self._lookup(lang, similar)
+                    if answer is not None:
+                        self.fuzzy_hits += 1
+                        return answer
+            self.misses += 1
+            return None
+
+    def _lookup(self, lang: str, key: str) -> Optional[str]:
+        item = self._items.get((lang, key))
+        if item is None:
+            return None
+        ts, answer = item
+        if time.time() - ts > self.ttl:
+            self._remove((lang, key))
+            return None
+        self._items.move_to_end((lang, key))
+        return answer
+
+    def _most_similar(self, lang: str, key: str) -> Optional[str]:
+        grams = self._trigrams(key)
+        overlap = {}
+        for g in grams:
+            for candidate in self._grams.get((lang, g), ()):
+                overlap[candidate] = overlap.get(candidate, 0) + 1
+        best, best_score = None, 0.0
+        for candidate, common in overlap.items():
+            score = common / (len(grams) + len(self._trigrams(candidate)) - common)
+            if score > best_score:
+                best, best_score = candidate, score
+        return best if best_score >= self.threshold else None
+
+    def put(self, lang: str, text: str, answer: str):
+        key = self._key(text)
+        if not key or not answer:
+            return
+        with self._lock:
+            if (lang, key) in self._items:
+                self._items.move_to_end((lang, key))
+            elif self.fuzzy:
+                for g in self._trigrams(key):
+                    self._grams.setdefault((lang, g), set()).add(key)
+            self._items[(lang, key)] = (time.time(), answer)
+            while len(self._items) > self.max_entries:
+                self._remove(next(iter(self._items)))
+
+    def _remove(self, item_key):
+        self._items.pop(item_key, None)
+        if self.fuzzy:
+            lang, key = item_key
+            for g in self._trigrams(key):
+                bucket = self._grams.get((lang, g))
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._grams[(lang, g)]
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "hits": self.hits, "fuzzy_hits": self.fuzzy_hits, "misses": self.misses}
+
+
+# === ХОЛОДНЫЙ СТАРТ ===
+class StartupProfile:
+    """
+    Фазы запуска: критический путь до первого receiveNotification и фоновые задачи (setSettings,
+    проверка PRICE_FILE_URL, импорт openai), которые приём не задерживают.
+    ready() пишет в лог время до готовности, report() — таблица для --profile-startup.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.imports = None  # время импорта модулей, с (заполняет --profile-startup)
+        self.ready_at = None
+        self.phases = []  # [(имя, начало от старта, длительность, в фоне)]
+        self._jobs = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name: str, background: bool = False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases.append((name, start - self.started, time.perf_counter() - start, background))
+
+    def mark(self, name: str):
+        """Фаза от начала профиля до текущего момента (например, весь конструктор)."""
+        with self._lock:
+            self.phases.append((name, 0.0, time.perf_counter() - self.started, False))
+
+    def background(self, name: str, fn):
+        """Некритичная задача старта — в фоновом потоке; ошибка только пишется в лог."""
+        def job():
+            with self.phase(name, background=True):
+                try:
+                    fn()
+                except Exception as e:
+                    logger.warning(f"Фоновая задача старта «{name}» упала: {e}")
+
+        thread = threading.Thread(target=job, name=f"startup-{len(self._jobs)}", daemon=True)
+        self._jobs.append(thread)
+        thread.start()
+
+    def ready(self):
+        """Критический путь пройден: дальше только приём."""
+        if self.ready_at is None:
+            self.ready_at = time.perf_counter() - self.started
+            logger.info(f"🚀 Готов к приёму за {self.ready_at:.2f} с")
+
+    def wait_background(self, timeout: float = 30) -> bool:
+        deadline = time.monotonic() + timeout
+        for thread in self._jobs:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._jobs)
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda p: p[1])
+        lines = [f"{'фаза':<36} {'старт, мс':>10} {'длит., мс':>10}"]
+        if self.imports is not None:
+            lines.append(f"{'импорт модулей':<36} {'':>10} {self.imports * 1000:>10.1f}")
+        for name, start, duration, background in phases:
+            label = f"{name} (фон)" if background else name
+            lines.append(f"{label:<36} {start * 1000:>10.1f} {duration * 1000:>10.1f}")
+        if self.ready_at is not None:
+            lines.append(f"{'── до первого опроса':<36} {'':>10} {self.ready_at * 1000:>10.1f}")
+            if self.imports is not None:
+                total = (self.imports + self.ready_at) * 1000
+                lines.append(f"{'── с импортом модулей':<36} {'':>10} {total:>10.1f}")
+        return "\n".join(lines)
+
+
+# === ОБЩИЕ РЕСУРСЫ ПРОЦЕССА ===
+def normalize_text(text: str) -> str:
+    return (text or "").replace("\u200b", "").replace("\xa0", " ").strip()
+
+
+class SharedResources:
+    """
+    Всё, что не зависит от номера WhatsApp и создаётся один раз на процесс: пул соединений Green-API,
+    клиент OpenAI с общим лимитом одновременных запросов (LLM_MAX_CONCURRENCY) и предохранителем,
+    хранилище состояния, кеш ответов, интенты и реестр метрик с сервером /metrics.
+    Одиночный бот создаёт себе свой экземпляр; в режиме TENANTS_FILE его делят все инстансы.
+    """
+
+    def __init__(self, env=None):
+        env = env or os.environ.get
+        pool_size = int(env("GREEN_API_POOL_SIZE", "20"))
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.api_key = env("OPENAI_API_KEY")
+        self.openai_timeout = float(env("OPENAI_TIMEOUT", "30"))
+        self._openai = None  # клиенты OpenAI создаются при первом запросе (см. openai / async_openai)
+        self._async_openai = None
+        self._clients_lock = threading.Lock()
+        # Не больше llm_limit запросов к OpenAI одновременно на весь процесс (0 — без лимита)
+        self.llm_limit = int(env("LLM_MAX_CONCURRENCY", "0"))
+        self.llm_slots = threading.BoundedSemaphore(self.llm_limit) if self.llm_limit > 0 else None
+        self._async_llm_slots = None
+        # При сбоях/тормозах OpenAI клиент сразу получает детерминированный ответ вместо ожидания таймаута
+        self.llm_breaker = CircuitBreaker(
+            window=float(env("LLM_BREAKER_WINDOW", "60")),
+            min_calls=int(env("LLM_BREAKER_MIN_CALLS", "5")),
+            failure_ratio=float(env("LLM_BREAKER_FAILURE_RATIO", "0.5")),
+            slow_call=float(env("LLM_BREAKER_SLOW_CALL", "12")),
+            slow_ratio=float(env("LLM_BREAKER_SLOW_RATIO", "0.8")),
+            open_for=float(env("LLM_BREAKER_OPEN_FOR", "30")),
+        )
+        self.llm_usage = LLMUsageStats()
+        self.summary_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+        # Состояние чатов — одна база; инстансы различаются пространствами имён (tenant:lang, ...)
+        self.state = make_state_store(env("STATE_BACKEND", "sqlite"), env("STATE_DB", "bot_state.db"))
+        self.intents = IntentMatcher(INTENT_KEYWORDS)
+        # Кеш ответов на типовые вопросы — только пока контекст короткий и ответ не зависит от истории
+        self.answer_cache = None
+        if env("ANSWER_CACHE", "true").lower() == "true":
+            self.answer_cache = AnswerCache(
+                max_entries=int(env("ANSWER_CACHE_SIZE", "2000")),
+                ttl=float(env("ANSWER_CACHE_TTL", str(6 * 3600))),
+                fuzzy=env("ANSWER_CACHE_FUZZY", "false").lower() == "true",
+                threshold=float(env("ANSWER_CACHE_THRESHOLD", "0.85")),
+                normalize=normalize_text,
+            )
+
+        self.metrics = Metrics()
+        self.metrics.histogram("bot_stage_seconds", "Время стадии обработки (stage/type/lang/outcome)")
+        self.metrics.histogram("green_api_request_seconds", "Время запроса к Green-API по методу и коду ответа")
+        self.metrics_server = None
+        self._lock = threading.Lock()
+
+    @property
+    def openai(self):
+        """Импорт openai — почти полсекунды холодного старта, поэтому он не на пути к первому опросу."""
+        if self._openai is None:
+            with self._clients_lock:
+                if self._openai is None:
+                    from openai import OpenAI
+
+                    self._openai = OpenAI(api_key=self.api_key, timeout=self.openai_timeout)
+        return self._openai
+
+    def async_openai(self):
+        if self._async_openai is None:
+            with self._clients_lock:
+                if self._async_openai is None:
+                    from openai import AsyncOpenAI
+
+                    self._async_openai = AsyncOpenAI(api_key=self.api_key, timeout=self.openai_timeout)
+        return self._async_openai
+
+    def async_llm_slots(self) -> Optional[asyncio.Semaphore]:
+        """Тот же лимит для asyncio-движка (все инстансы процесса работают в одном цикле событий)."""
+        if self._async_llm_slots is None and self.llm_limit > 0:
+            self._async_llm_slots = asyncio.Semaphore(self.llm_limit)
+        return self._async_llm_slots
+
+    def start_metrics_server(self, host: str, port: int) -> Optional[MetricsServer]:
+        """Один /metrics на процесс; повторные вызовы от других инстансов возвращают уже поднятый."""
+        with self._lock:
+            if self.metrics_server is None:
+                try:
+                    server = MetricsServer(self.metrics, host, port)
+                except OSError as e:
+                    logger.warning(f"Не удалось поднять /metrics на {host}:{port}: {e}")
+                    return None
+                self._register_collectors()
+                server.start()
+                self.metrics_server = server
+            return self.metrics_server
+
+    def _register_collectors(self):
+        m = self.metrics
+
+        def llm_tokens():
+            out = {}
+            for lang, row in self.llm_usage.snapshot().items():
+                for kind in ("prompt", "cached", "completion"):
+                    out[(("lang", lang), ("kind", kind))] = row[f"{kind}_tokens"]
+            return out
+
+        m.collect("bot_llm_tokens_total", "counter", "Токены OpenAI из resp.usage по языкам", llm_tokens)
+        m.collect("bot_llm_breaker_open", "gauge", "Состояние предохранителя LLM (1 — текущее)",
+                  lambda: {(("state", st),): int(self.llm_breaker.state == st)
+                           for st in (CircuitBreaker.CLOSED, CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN)})
+        m.collect("bot_llm_breaker_rejected_total", "counter", "Запросы, отбитые разомкнутым предохранителем",
+                  lambda: self.llm_breaker.rejected)
+        if self.answer_cache:
+            m.collect("bot_answer_cache_total", "counter", "Кеш ответов: попадания и промахи",
+                      lambda: {(("result", k),): v for k, v in self.answer_cache.stats().items() if k != "size"})
+
+
+class WhatsAppBot:
+    def __init__(self, config: Optional[dict] = None, shared: Optional[SharedResources] = None):
+        # config — настройки одного инстанса (ключи как у переменных окружения, см. load_tenants);
+        # чего в нём нет, берётся из окружения. shared — ресурсы, общие для всех инстансов процесса.
+        self.startup = StartupProfile()
+        self.config = {k: str(v) for k, v in (config or {}).items() if v is not None}
+        self.tenant = self.config.get("name")
+        if shared is None:
+            with self.startup.phase("общие ресурсы (состояние, интенты)"):
+                shared = SharedResources(self._cfg)
+        self.shared = shared
+        self.instance_id = self._cfg("INSTANCE_ID")
+        self.api_token = self._cfg("INSTANCE_TOKEN")
+        # GREEN_API_URL — свой хост API (выделенный инстанс или локальная заглушка fakes.FakeGreenApiServer)
+        api_url = self._cfg("GREEN_API_URL", "https://api.green-api.com").rstrip("/")
+        self.base_url = f"{api_url}/waInstance{self.instance_id}"
+        # uploadFile — на медиа-хосте: api.green-api.com → media.green-api.com (или GREEN_API_MEDIA_URL)
+        media_url = self._cfg("GREEN_API_MEDIA_URL") or re.sub(r"(//|\.)api\.", r"\1media.", api_url, count=1)
+        self.media_url = f"{media_url.rstrip('/')}/waInstance{self.instance_id}"
+        self.transport = GreenApiTransport(
+            self.base_url, self.api_token,
+            session=self.shared.session,
+            retries=int(self._cfg("GREEN_API_RETRIES", "3")),
+        )
+        # Темп исходящих на инстанс (0 — без ограничения); 429 от Green-API ставит отправку на паузу
+        self.outbound = OutboundScheduler(
+            rate=float(self._cfg("OUTBOUND_RATE", "10")),
+            burst=int(self._cfg("OUTBOUND_BURST", "10")),
+        )
+        self.transport.on_throttle = self.outbound.pause
+
+        # Метрики по стадиям конвейера; /metrics поднимается в run() (METRICS_PORT=0 — выключено).
+        # Реестр общий на процесс, у инстанса из TENANTS_FILE значения помечены tenant
+        self.metrics = TenantMetrics(self.shared.metrics, self.tenant) if self.tenant else self.shared.metrics
+        self.transport.metrics = self.metrics
+        self.metrics_host = self._cfg("METRICS_HOST", "127.0.0.1")
+        self.metrics_port = int(self._cfg("METRICS_PORT", "9108"))
+        self.metrics_server = None
+
+        # ДЕФОЛТЫ, чтобы не было None в тексте
+        self.brand = self._cfg("BRAND_NAME") or "qdigit"
+        self.support_phone = self._cfg("SUPPORT_PHONE") or "+7 777 777 77 77"
+
+        # Состояние чатов (язык, форма, ручной режим, история) — в хранилище, подгружается лениво.
+        # Общая база процесса; STATE_BACKEND/STATE_DB в config инстанса дают ему свою
+        if "STATE_BACKEND" in self.config or "STATE_DB" in self.config:
+            self.state = make_state_store(self._cfg("STATE_BACKEND", "sqlite"),
+                                          self._cfg_path("STATE_DB", "bot_state.db"))
+        else:
+            self.state = self.shared.state
+
+        # Прайс — публичный прямой URL (см. инструкцию ниже) + дефолтное имя;
+        # PRICE_FILE_URL_RU/_KK/_EN (и PRICE_FILE_NAME_*) — отдельный файл для языка
+        self.price_url = self._cfg("PRICE_FILE_URL")
+        self.price_filename = self._cfg("PRICE_FILE_NAME") or "qdigit_price.pdf"
+        price_sources = {"": (self.price_url, self.price_filename)}
+        for lang in ("ru", "kk", "en"):
+            price_sources[lang] = (self._cfg(f"PRICE_FILE_URL_{lang.upper()}"),
+                                   self._cfg(f"PRICE_FILE_NAME_{lang.upper()}") or self.price_filename)
+        # Файл один раз загружается в Green-API (uploadFile); PRICE_UPLOAD=false — старый sendFileByUrl с источника
+        self.price_files = PriceFiles(
+            price_sources,
+            self.upload_file if self._cfg("PRICE_UPLOAD", "true").lower() == "true" else None,
+            self.transport.session,
+            store=self.state,
+            ns=self._ns("price_file"),
+            check_interval=float(self._cfg("PRICE_CHECK_INTERVAL", "600")),
+        )
+
+        # OpenAI — общий клиент процесса (создаётся лениво, см. client)
+        self.api_key = self.shared.api_key
+        self.openai_model = self._cfg("OPENAI_MODEL", "gpt-4o-mini")
+        self.llm_params = {
+            "max_tokens": 220,
+            "temperature": 0.7,
+            "top_p": 0.9,
+            "frequency_penalty": 0.6,
+            "presence_penalty": 0.4,
+        }
+        # Стриминг: первый абзац уходит в WhatsApp, пока остальное ещё генерируется
+        self.llm_streaming = self._cfg("LLM_STREAMING", "true").lower() == "true"
+        self.stream_min_chars = int(self._cfg("LLM_STREAM_MIN_CHARS", "60"))
+        self.stream_max_chunks = int(self._cfg("LLM_STREAM_MAX_CHUNKS", "4"))
+
+        self.answer_cache = self.shared.answer_cache
+        # Сколько реплик истории допускается перед вопросом; 0 — только первый вопрос диалога,
+        # ответ на который не зависит от предыдущего контекста
+        self.answer_cache_max_history = int(self._cfg("ANSWER_CACHE_MAX_HISTORY", "0"))
+        self.intents = self.shared.intents
 
         if not all([self.instance_id, self.api_token, self.api_key]):
             raise ValueError("Не заданы переменные окружения: INSTANCE_ID/INSTANCE_TOKEN/OPENAI_API_KEY")
 
         # Хранилище выбранного языка для каждого чата
-        self.user_language = {}  # {chat_id: 'ru'/'kk'/'en'}
+        self.user_language = ChatStateMap(self.state, self._ns("lang"))  # {chat_id: 'ru'/'kk'/'en'}
 
         # СТАРОЕ: флаг ожидания формы (оставлен для совместимости)
         self.awaiting_form = {}  # {chat_id: True/False}
 
         # НОВОЕ: пошаговая форма консультации
         # {chat_id: {"step": 1..4, "data": {"name":..., "company":..., "phone":..., "bot_type":...}}}
-        self.form_state = {}
+        self.form_state = ChatStateMap(self.state, self._ns("form"))
 
         # Ручной режим: когда менеджер ведёт диалог
         # {chat_id: timestamp_включения}
-        self.manual_mode = {}
-        self.manual_mode_ttl = int(os.environ.get("MANUAL_MODE_TTL", "900"))  # 15 мин по умолчанию
+        self.manual_mode = ChatStateMap(self.state, self._ns("manual"))
+        self.manual_mode_ttl = int(self._cfg("MANUAL_MODE_TTL", "900"))  # 15 мин по умолчанию
 
         # Системные промпты (RU/KK/EN) — всегда говорить от лица бренда и кратко
         self.system_prompts = {
@@ -112,25 +3323,208 @@ RULES:
 • Be concise and friendly. 1–2 emojis."""
         }
 
-        self.processed_messages = set()
-        self.history = {}
+        # Свои промпты инстанса (SYSTEM_PROMPT_RU/KK/EN в config или окружении), {brand} подставляется
+        for lang in self.system_prompts:
+            custom = self._cfg(f"SYSTEM_PROMPT_{lang.upper()}")
+            if custom:
+                self.system_prompts[lang] = custom.replace("{brand}", self.brand)
+
+        # Системное сообщение собирается один раз и дальше не меняется ни на байт: это общий префикс
+        # всех запросов языка, который провайдер может взять из своего кеша промптов.
+        style_rules = {
+            'ru': "Говори коротко, дружелюбно и по делу. Используй 1–2 эмодзи.",
+            'kk': "Қысқа, достық және нақты. 1–2 эмодзи.",
+            'en': "Be brief, friendly, to the point. Use 1–2 emojis."
+        }
+        self.system_messages = {
+            lang: {"role": "system", "content": prompt + "\n\nСТИЛЬ:\n" + style_rules.get(lang, style_rules['en'])}
+            for lang, prompt in self.system_prompts.items()
+        }
+        # prompt_cache_key помогает провайдеру направлять запросы с одинаковым префиксом на один кеш
+        self.prompt_cache_key = self._cfg("LLM_PROMPT_CACHE_KEY", "true").lower() == "true"
+        self.llm_usage = self.shared.llm_usage
+        self.llm_breaker = self.shared.llm_breaker
+
+        # Кластер (CLUSTER_MODE): state, inbox и заявки — общие, в CLUSTER_DB. Файлы, которые узел
+        # дописывает и переписывает сам (дедуп, CSV, запись трафика), у каждого узла свои (_node_file)
+        cluster_store = None
+        self.node_id = None
+        if self._cfg("CLUSTER_MODE", "false").lower() == "true":
+            cluster_store = ClusterStore(self._cfg_path("CLUSTER_DB", "cluster.db"),
+                                         int(self._cfg("CLUSTER_PARTITIONS", "64")))
+            self.node_id = self._cfg("CLUSTER_NODE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+        # Обработанные idMessage: ограниченное, переживающее рестарт хранилище (DEDUPE_MODE=bloom — вероятностное)
+        if self._cfg("DEDUPE_MODE", "lru").lower() == "bloom":
+            self.processed_messages = BloomDedupeStore(
+                path=self._node_file(self._cfg_path("DEDUPE_PATH", "processed_messages.bloom")) or None,
+                capacity=int(self._cfg("DEDUPE_MAX", "1000000")),
+                ttl=float(self._cfg("DEDUPE_TTL", str(3 * 24 * 3600))),
+            )
+        else:
+            self.processed_messages = DedupeStore(
+                path=self._node_file(self._cfg_path("DEDUPE_PATH", "processed_messages.log")) or None,
+                max_entries=int(self._cfg("DEDUPE_MAX", "100000")),
+                ttl=float(self._cfg("DEDUPE_TTL", str(3 * 24 * 3600))),
+            )
+        self.history = ChatStateMap(self.state, self._ns("history"))
+
+        # Окно истории по бюджету токенов; всё, что старше окна, сворачивается в резюме
+        self.history_tokens = int(self._cfg("LLM_HISTORY_TOKENS", "1200"))
+        self.history_summary = self._cfg("LLM_HISTORY_SUMMARY", "true").lower() == "true"
+        self.summary_tokens = int(self._cfg("LLM_SUMMARY_TOKENS", "200"))
+        self.summary_batch_tokens = int(self._cfg("LLM_SUMMARY_BATCH_TOKENS", "300"))
+        self.summaries = ChatStateMap(self.state, self._ns("summary"))  # {chat_id: "резюме старых реплик"}
+        self._summary_pool = self.shared.summary_pool
+        self._summary_jobs = {}  # {chat_id: Future[(резюме, свёрнутые реплики)]}
+        self._summary_lock = threading.Lock()
+
+        # Заявки: append-only журнал с индексом (старый client_records.json переносится один раз)
+        if cluster_store:
+            self.leads = ClusterLeadLog(cluster_store)
+        else:
+            self.leads = LeadLog(
+                self._cfg_path("LEADS_FILE", "client_records.jsonl"),
+                # Повторные заявки того же телефона ужимаются, когда журнал перерастает LEADS_COMPACT_MB
+                compact_bytes=int(float(self._cfg("LEADS_COMPACT_MB", "16")) * 1024 * 1024),
+            )
+        try:
+            self.leads.migrate_json(self._tenant_file("client_records.json"))
+        except Exception as e:
+            logger.error(f"Ошибка переноса client_records.json: {e}")
+        self.csv_path = self._node_file(self._tenant_file("client_records.csv"))
+        self._csv_lock = threading.Lock()
+
+        # Запись входящего трафика для replay.py (выключена по умолчанию; номера анонимизируются)
+        self.capture = None
+        if self._cfg("TRAFFIC_CAPTURE", "false").lower() == "true":
+            self.capture = TrafficCapture(
+                self._node_file(self._cfg_path("TRAFFIC_CAPTURE_FILE", "requests.jsonl")),
+                secret=self._cfg("TRAFFIC_CAPTURE_SECRET"),
+                sample=float(self._cfg("TRAFFIC_CAPTURE_SAMPLE", "1")),
+                max_bytes=int(float(self._cfg("TRAFFIC_CAPTURE_MAX_MB", "512")) * 2 ** 20),
+            )
+            logger.info(f"📼 Запись трафика включена: {self.capture.path}")
+        self._csv_file = None
+        self._csv_writer = None
+
+        # Google Sheets (опционально): авторизация и лист кешируются, строки уходят фоновыми пачками
+        self.sheets = None
+        g_enable = self._cfg("GOOGLE_SHEETS_ENABLED", "").lower() == "true"
+        creds_json = self._cfg("GOOGLE_SERVICE_ACCOUNT_JSON")
+        sheet_name = self._cfg("GOOGLE_SHEETS_SPREADSHEET")
+        if g_enable and creds_json and sheet_name:
+            self.sheets = SheetsSink(
+                lambda: google_sheets_client(creds_json),
+                sheet_name,
+                self._cfg("GOOGLE_SHEETS_WORKSHEET", "Leads"),
+                batch_size=int(self._cfg("GOOGLE_SHEETS_BATCH", "50")),
+                flush_interval=float(self._cfg("GOOGLE_SHEETS_FLUSH_INTERVAL", "2")),
+            )
         self.last_reply = {}
 
-        # Быстрая самопроверка ссылки прайса
-        self._check_price_link()
+        # Параллельная обработка: воркеры по chatId (0 — старый последовательный режим)
+        self.workers = int(self._cfg("BOT_WORKERS", "8"))
+        self.max_pending = int(self._cfg("BOT_QUEUE_MAX", "500"))
+        self.dispatcher = None
+        self.receive_timeout = int(self._cfg("RECEIVE_TIMEOUT", "20"))  # long-poll, 0 — выключен
+
+        # Серия коротких сообщений подряд → одна реплика. Включается явно (COALESCE_WINDOW > 0):
+        # каждый свободный текст ждёт окно тишины перед ответом
+        self.coalescer = None
+        coalesce_window = float(self._cfg("COALESCE_WINDOW", "0"))
+        if coalesce_window > 0:
+            self.coalescer = MessageCoalescer(
+                self._schedule_coalesced_flush,
+                window=coalesce_window,
+                max_wait=float(self._cfg("COALESCE_MAX_WAIT", "8")),
+                max_messages=int(self._cfg("COALESCE_MAX_MESSAGES", "6")),
+            )
+
+        # Webhook-режим: если задан WEBHOOK_URL, Green-API шлёт уведомления сам (без опроса)
+        self.webhook_url = self._cfg("WEBHOOK_URL")
+        self.webhook_token = self._cfg("WEBHOOK_TOKEN")
+        self.webhook_port = int(self._cfg("WEBHOOK_PORT", "8080"))
+        self.webhook_path = self._cfg("WEBHOOK_PATH", "/webhook")
+        self.webhook_server = None
+
+        # Кластер: несколько процессов на одном инстансе делят чаты через общую SQLite (CLUSTER_DB).
+        # Green-API опрашивает один узел, остальные берут свои разделы из общего inbox.
+        self.cluster = None
+        if cluster_store:
+            if isinstance(self.state, MemoryStateStore):
+                logger.warning("⚠️ CLUSTER_MODE с STATE_BACKEND=memory: состояние чатов не общее для узлов")
+            self.cluster = ClusterNode(
+                cluster_store,
+                self.node_id,
+                self._submit,
+                persist=self.state.flush,
+                on_acquire=self._cluster_acquired,
+                on_leader=None if self.webhook_url else self._cluster_leader,
+                lease_ttl=float(self._cfg("CLUSTER_LEASE_TTL", "10")),
+                heartbeat=float(self._cfg("CLUSTER_HEARTBEAT", "2")),
+                # Держим локально немного больше, чем успевают воркеры: остальное ждёт в inbox и при
+                # перебалансировке сразу достаётся новому владельцу раздела
+                max_inflight=int(self._cfg("CLUSTER_MAX_INFLIGHT", str(max(1, self.workers) * 4))),
+            )
+
+        # Подтверждения уходят в фоне; журнал переживает рестарт (пустой ACK_JOURNAL — без журнала).
+        # В кластере журнал не нужен: принятое уже лежит в общем inbox.
+        self.acks = AckPipeline(
+            self.delete_notification,
+            journal_path=None if self.cluster else (self._cfg_path("ACK_JOURNAL", "ack_journal.jsonl") or None),
+            concurrency=int(self._cfg("ACK_CONCURRENCY", "4")),
+            on_complete=self.cluster.completed if self.cluster else None,
+            # Состояние чатов коммитится пачками; done без коммита потерял бы его при падении.
+            # В кластере коммит делает узел перед done в inbox (ClusterNode._settle)
+            before_done=None if self.cluster else self.state.flush,
+        )
+        self.receiver = None
+        # Самопроверка ссылки прайса и setSettings — в фоне из run(), не в конструкторе
+        self.startup.mark("конструктор")
+
+    # === НАСТРОЙКИ ИНСТАНСА ===
+
+    @property
+    def client(self):
+        """Клиент OpenAI процесса; создаётся при первом запросе к LLM или фоном при старте."""
+        return self.shared.openai
+
+    def _cfg(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        """Настройка инстанса: сначала его config, затем переменная окружения."""
+        if key in self.config:
+            return self.config[key]
+        return os.environ.get(key, default)
+
+    def _cfg_path(self, key: str, default: str) -> str:
+        """Файл инстанса; путь из окружения общий для процесса, поэтому получает суффикс tenant."""
+        if key in self.config:
+            return self.config[key]
+        return self._tenant_file(os.environ.get(key, default))
+
+    def _tenant_file(self, path: str) -> str:
+        if not self.tenant or not path:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self.tenant}{ext}"
+
+    def _node_file(self, path: str) -> str:
+        """Файл, который пишет только этот узел кластера: суффикс CLUSTER_NODE_ID (задайте его постоянным)."""
+        if not self.node_id or not path:
+            return path
+        root, ext = os.path.splitext(path)
+        node = re.sub(r"[^\w.-]", "_", self.node_id)
+        return f"{root}.{node}{ext}"
+
+    def _ns(self, name: str) -> str:
+        """Пространство имён хранилища состояния: у инстанса — с префиксом tenant."""
+        return f"{self.tenant}:{name}" if self.tenant else name
 
     # === ВЫБОР ЯЗЫКА ===
 
     def is_greeting(self, text: str) -> bool:
         t = (text or "").lower().strip()
-        ru_greetings = {'привет', 'здравствуй', 'здравствуйте', 'салам', 'здорово',
-                        'добрый день', 'добрый вечер', 'доброе утро', 'прив', 'здраст',
-                        'дратути', 'хай', 'приветик', 'приветствую'}
-        kk_greetings = {'сәлем', 'салам', 'сәлеметсіз бе', 'қайырлы таң', 'қайырлы күн', 'қайырлы кеш'}
-        en_greetings = {'hi', 'hello', 'hey', 'good morning', 'good day', 'good evening', 'greetings', 'hiya', 'howdy'}
-        all_greetings = ru_greetings | kk_greetings | en_greetings
-        base = t.replace('!', '').replace(',', '').strip()
-        return t in all_greetings or base in all_greetings
+        return t in GREETINGS or t.replace('!', '').replace(',', '').strip() in GREETINGS
 
     # === РУЧНОЙ РЕЖИМ (менеджер) ===
 
@@ -159,8 +3553,20 @@ RULES:
         Отправляет одно сообщение с приветствием и интерактивными кнопками:
         Прайс / Консультация / Наши услуги.
         """
-        url = f"{self.base_url}/sendInteractiveButtonsReply/{self.api_token}"
+        payload = self._welcome_payload(chat_id, lang_code)
+
+        try:
+            self.outbound.acquire(chat_id, OutboundScheduler.INTERACTIVE)
+            r = self.transport.post("sendInteractiveButtonsReply", json=payload)
+            ok = r.status_code == 200
+            if not ok:
+                logger.error(f"Ошибка send_welcome_with_actions: {r.status_code} {r.text}")
+            return ok
+        except Exception as e:
+            logger.error(f"Ошибка отправки welcome+actions: {e}")
+            return False
 
+    def _welcome_payload(self, chat_id: str, lang_code: str) -> dict:
         bodies = {
             'ru': (
                 f"👋 Здравствуйте! Вас приветствует *{self.brand}*.\n"
@@ -197,19 +3603,28 @@ RULES:
                 {"buttonId": "short_services", "buttonText": l["services"]},
             ],
         }
+        return payload
+
+    def send_language_selection(self, chat_id: str) -> bool:
+        payload, fallback = self._language_selection_payload(chat_id)
 
         try:
-            r = requests.post(url, json=payload, timeout=30)
-            ok = r.status_code == 200
-            if not ok:
-                logger.error(f"Ошибка send_welcome_with_actions: {r.status_code} {r.text}")
-            return ok
+            self.outbound.acquire(chat_id, OutboundScheduler.INTERACTIVE)
+            r = self.transport.post("sendInteractiveButtonsReply", json=payload)
+            if r.status_code == 200:
+                logger.info(f"✅ Отправлены кнопки выбора языка для {chat_id}")
+                return True
+            else:
+                logger.error(f"Ошибка отправки кнопок: {r.status_code} {r.text}")
+                self.send_message(chat_id, fallback)
+                return False
         except Exception as e:
-            logger.error(f"Ошибка отправки welcome+actions: {e}")
+            logger.error(f"Ошибка отправки кнопок: {e}")
+            self.send_message(chat_id, fallback)
             return False
 
-    def send_language_selection(self, chat_id: str) -> bool:
-        url = f"{self.base_url}/sendInteractiveButtonsReply/{self.api_token}"
+    def _language_selection_payload(self, chat_id: str) -> tuple:
+        """Кнопки выбора языка + текстовый fallback на случай, если кнопки не ушли."""
         body = (
             "👋 *Здравствуйте!* Вас приветствует компания *{brand}*.\n"
             "👋 *Сәлеметсіз бе!* Сізді *{brand}* компаниясы қарсы алады.\n"
@@ -228,56 +3643,45 @@ RULES:
                 {"buttonId": "lang_ru", "buttonText": "🇷🇺 Русский"},
                 {"buttonId": "lang_kk", "buttonText": "🇰🇿 Қазақша"},
                 {"buttonId": "lang_en", "buttonText": "🇬🇧 English"}
-            ]
-        }
-
-        fallback = (
-            f"👋 *Здравствуйте!* Вас приветствует компания *{self.brand}*.\n"
-            "👋 *Сәлеметсіз бе!* Сізді *{brand}* компаниясы қарсы алады.\n"
-            "👋 *Hello!* You're welcomed by *{brand}*.\n\n"
-            "1️⃣ Русский 🇷🇺\n"
-            "2️⃣ Қазақша 🇰🇿\n"
-            "3️⃣ English 🇬🇧\n\n"
-            "_Напишите цифру / Санды жазыңыз / Type number_"
-        ).replace("{brand}", self.brand)
-
-        try:
-            r = requests.post(url, json=payload, timeout=10)
-            if r.status_code == 200:
-                logger.info(f"✅ Отправлены кнопки выбора языка для {chat_id}")
-                return True
-            else:
-                logger.error(f"Ошибка отправки кнопок: {r.status_code} {r.text}")
-                self.send_message(chat_id, fallback)
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка отправки кнопок: {e}")
-            self.send_message(chat_id, fallback)
-            return False
+            ]
+        }
+
+        fallback = (
+            f"👋 *Здравствуйте!* Вас приветствует компания *{self.brand}*.\n"
+            "👋 *Сәлеметсіз бе!* Сізді *{brand}* компаниясы қарсы алады.\n"
+            "👋 *Hello!* You're welcomed by *{brand}*.\n\n"
+            "1️⃣ Русский 🇷🇺\n"
+            "2️⃣ Қазақша 🇰🇿\n"
+            "3️⃣ English 🇬🇧\n\n"
+            "_Напишите цифру / Санды жазыңыз / Type number_"
+        ).replace("{brand}", self.brand)
+        return payload, fallback
 
     def set_language(self, chat_id: str, lang_code: str):
-        self.user_language[chat_id] = lang_code
-        logger.info(f"🌍 Язык для {chat_id} установлен: {lang_code}")
         try:
-            filename = "user_languages.json"
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    langs = json.load(f)
-            else:
-                langs = {}
-            langs[chat_id] = lang_code
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(langs, f, ensure_ascii=False, indent=2)
+            self.user_language[chat_id] = lang_code
         except Exception as e:
             logger.error(f"Ошибка сохранения языка: {e}")
+        logger.info(f"🌍 Язык для {chat_id} установлен: {lang_code}")
 
     def load_user_languages(self):
+        """
+        Языки теперь читаются из хранилища по одному чату при первом обращении.
+        Здесь остаётся только разовый перенос старого user_languages.json.
+        """
+        filename = self._tenant_file("user_languages.json")
+        meta_key = "migrated:user_languages" + (f":{self.tenant}" if self.tenant else "")
         try:
-            filename = "user_languages.json"
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    self.user_language = json.load(f)
-                logger.info(f"Загружено языков: {len(self.user_language)}")
+            if not os.path.exists(filename) or not hasattr(self.state, "set_many"):
+                return
+            if self.state.get_meta(meta_key) == "1":
+                return
+            with open(filename, 'r', encoding='utf-8') as f:
+                langs = json.load(f)
+            self.state.set_many(self.user_language.ns, langs)
+            self.state.set_meta(meta_key, "1")
+            self.state.flush()
+            logger.info(f"Перенесено языков из {filename}: {len(langs)}")
         except Exception as e:
             logger.error(f"Ошибка загрузки языков: {e}")
 
@@ -301,11 +3705,15 @@ RULES:
         return ""
 
     def _normalize_text(self, text: str) -> str:
-        return (text or "").replace("\u200b", "").replace("\xa0", " ").strip()
+        return normalize_text(text)
 
     def clear_chat_history(self, chat_id: str):
         if chat_id in self.history:
             del self.history[chat_id]
+        if chat_id in self.summaries:
+            del self.summaries[chat_id]
+        with self._summary_lock:
+            self._summary_jobs.pop(chat_id, None)
         if chat_id in self.last_reply:
             del self.last_reply[chat_id]
         if chat_id in self.user_language:
@@ -318,11 +3726,12 @@ RULES:
             del self.manual_mode[chat_id]
         logger.info(f"История чата {chat_id} очищена")
 
-    def send_message(self, chat_id: str, message: str) -> bool:
-        url = f"{self.base_url}/sendMessage/{self.api_token}"
+    def send_message(self, chat_id: str, message: str, priority: int = OutboundScheduler.INTERACTIVE) -> bool:
+        """priority — класс в планировщике исходящих: INTERACTIVE (по умолчанию), LLM или BULK для рассылок."""
         payload = {"chatId": chat_id, "message": message}
         try:
-            r = requests.post(url, json=payload, timeout=10)
+            self.outbound.acquire(chat_id, priority)
+            r = self.transport.post("sendMessage", json=payload)
             ok = r.status_code == 200
             if not ok:
                 logger.error("Ошибка отправки: %s %s", r.status_code, r.text)
@@ -331,11 +3740,12 @@ RULES:
             logger.error(f"Ошибка отправки: {e}")
             return False
 
-    def send_file_by_url(self, chat_id: str, file_url: str, file_name: str, caption: str = "") -> bool:
-        url = f"{self.base_url}/sendFileByUrl/{self.api_token}"
+    def send_file_by_url(self, chat_id: str, file_url: str, file_name: str, caption: str = "",
+                         priority: int = OutboundScheduler.INTERACTIVE) -> bool:
         payload = {"chatId": chat_id, "urlFile": file_url, "fileName": file_name, "caption": caption or ""}
         try:
-            r = requests.post(url, json=payload, timeout=15)
+            self.outbound.acquire(chat_id, priority)
+            r = self.transport.post("sendFileByUrl", json=payload)
             ok = r.status_code == 200
             if not ok:
                 logger.error("Ошибка отправки файла: %s %s", r.status_code, r.text)
@@ -344,22 +3754,36 @@ RULES:
             logger.error(f"Ошибка отправки файла: {e}")
             return False
 
-    def get_notification(self) -> Optional[dict]:
-        url = f"{self.base_url}/receiveNotification/{self.api_token}"
+    def get_notification(self, receive_timeout: Optional[int] = None) -> Optional[dict]:
+        return self.poll_notification(receive_timeout)[1]
+
+    def poll_notification(self, receive_timeout: Optional[int] = None) -> tuple:
+        """
+        (ok, notification): ok=False — ошибка сети/HTTP, notification=None при ok=True — очередь пуста.
+        receive_timeout — long-poll Green-API (5–60 с): сервер держит запрос, пока не придёт уведомление.
+        """
+        params, timeout = None, None
+        if receive_timeout:
+            params = {"receiveTimeout": receive_timeout}
+            timeout = receive_timeout + 10
+        started = time.monotonic()
+        ok, notification = False, None
         try:
-            r = requests.get(url, timeout=15)
+            r = self.transport.get("receiveNotification", params=params, timeout=timeout)
             if r.status_code == 200:
-                return r.json()
-            logger.error("receiveNotification %s %s", r.status_code, r.text)
-            return None
+                ok, notification = True, r.json()
+            else:
+                logger.error("receiveNotification %s %s", r.status_code, r.text)
         except Exception as e:
             logger.error(f"Ошибка получения уведомлений: {e}")
-            return None
+        outcome = ("message" if notification else "empty") if ok else "error"
+        self.metrics.observe("bot_stage_seconds", time.monotonic() - started,
+                             stage="poll", type="", lang="", outcome=outcome)
+        return ok, notification
 
     def delete_notification(self, receipt_id: int) -> bool:
-        url = f"{self.base_url}/deleteNotification/{self.api_token}/{receipt_id}"
         try:
-            r = requests.delete(url, timeout=10)
+            r = self.transport.delete("deleteNotification", receipt_id)
             ok = r.status_code == 200
             if not ok:
                 logger.error("deleteNotification %s %s", r.status_code, r.text)
@@ -370,44 +3794,236 @@ RULES:
 
     # === LLM ===
     def get_openai_response(self, chat_id: str, user_message: str) -> str:
+        lang = self.user_language.get(chat_id, 'ru')
+        with self.metrics.timer("bot_stage_seconds", stage="llm", type="text", lang=lang) as timer:
+            cached = self._cached_answer(chat_id, user_message)
+            if cached is not None:
+                timer.labels["outcome"] = "cached"
+                return cached
+            if not self.llm_breaker.allow():
+                timer.labels["outcome"] = "fallback"
+                return self._llm_fallback_text(lang)
+            lang_code, hist, messages = self._prepare_llm_request(chat_id, user_message)
+            with self._llm_slot():
+                started = time.monotonic()
+                try:
+                    resp = self.client.chat.completions.create(
+                        model=self.openai_model,
+                        messages=messages,
+                        **self._llm_kwargs(lang_code)
+                    )
+                except Exception as e:
+                    self.llm_breaker.record(False, time.monotonic() - started)
+                    logger.error(f"Ошибка OpenAI: {e}")
+                    timer.labels["outcome"] = "error"
+                    return self._llm_error_text(lang_code)
+            self.llm_breaker.record(True, time.monotonic() - started)
+            self.llm_usage.record(lang_code, getattr(resp, "usage", None), time.monotonic() - started)
+            return self._finish_llm_answer(chat_id, hist, resp.choices[0].message.content)
+
+    def _llm_slot(self):
+        """Место в общем на процесс лимите запросов к OpenAI (LLM_MAX_CONCURRENCY, 0 — без лимита)."""
+        return self.shared.llm_slots or nullcontext()
+
+    def _llm_kwargs(self, lang_code: str, stream: bool = False) -> dict:
+        kwargs = dict(self.llm_params)
+        if self.prompt_cache_key:
+            kwargs["extra_body"] = {"prompt_cache_key": f"{self.brand}-{lang_code}"}
+        if stream:
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
+
+    def _prepare_llm_request(self, chat_id: str, user_message: str) -> tuple:
+        """Добавляет реплику в историю и собирает messages. Общая часть sync/async движков."""
         lang_code = self.user_language.get(chat_id, 'ru')
-        system_prompt = self.system_prompts.get(lang_code, self.system_prompts['ru'])
 
-        hist = self.history.setdefault(chat_id, [])
+        hist = self._apply_summary(chat_id, self.history.get(chat_id) or [])
         hist.append({"role": "user", "content": user_message})
-        window = hist[-12:]
-
-        style_rules = {
-            'ru': "Говори коротко, дружелюбно и по делу. Используй 1–2 эмодзи.",
-            'kk': "Қысқа, достық және нақты. 1–2 эмодзи.",
-            'en': "Be brief, friendly, to the point. Use 1–2 emojis."
-        }
-        system = system_prompt + "\n\nСТИЛЬ:\n" + style_rules.get(lang_code, style_rules['en'])
-        messages = [{"role": "system", "content": system}] + window
-
-        try:
+        window = hist[history_window_start(hist, self.history_tokens):]
+
+        # Порядок — от самого стабильного к самому изменчивому: системный промпт, резюме, окно истории
+        messages = [self.system_messages.get(lang_code, self.system_messages['ru'])]
+        summary = self.summaries.get(chat_id)
+        if summary:
+            messages.append({"role": "system", "content": "Краткое содержание диалога ранее:\n" + summary})
+        messages += window
+        return lang_code, hist, messages
+
+    def _finish_llm_answer(self, chat_id: str, hist: list, content: str, complete: bool = True) -> str:
+        """complete=False — стрим оборвался после первых кусков: в кеш не кладём, в истории помечаем."""
+        answer = content.strip()
+        # hist[-1] — вопрос; до него в истории было len(hist) - 1 реплик
+        if complete and self.answer_cache and len(hist) - 1 <= self.answer_cache_max_history:
+            self.answer_cache.put(self._cache_scope(chat_id), hist[-1]["content"], answer)
+        if not complete:
+            answer += " […ответ прерван]"
+        hist.append({"role": "assistant", "content": answer})
+        self._store_history(chat_id, hist)
+        logger.info(f"🧠 GPT ответил: {answer[:80]}...")
+        return answer
+
+    def _store_history(self, chat_id: str, hist: list):
+        """
+        Сохраняет историю. Реплики старше окна копятся, пока их не наберётся на summary_batch_tokens,
+        и сворачиваются в резюме фоном; без резюме (или если оно отстаёт) хвост режется по 3× бюджету.
+        """
+        start = history_window_start(hist, self.history_tokens)
+        if self.history_summary and start and sum(map(message_tokens, hist[:start])) >= self.summary_batch_tokens:
+            with self._summary_lock:
+                if chat_id not in self._summary_jobs:
+                    folded = [dict(m) for m in hist[:start]]
+                    self._summary_jobs[chat_id] = self._summary_pool.submit(
+                        self._summarize, self.summaries.get(chat_id) or "", folded
+                    )
+        hist = hist[history_window_start(hist, 3 * self.history_tokens):]
+        self.history[chat_id] = hist
+
+    def _summarize(self, summary: str, folded: list) -> tuple:
+        if self.llm_breaker.state != CircuitBreaker.CLOSED:
+            raise RuntimeError("OpenAI недоступен (предохранитель разомкнут), резюме позже")
+        dialog = "\n".join(f"{'Клиент' if m['role'] == 'user' else 'Бот'}: {m['content']}" for m in folded)
+        prompt = (
+            "Обнови краткое резюме переписки менеджера с клиентом. Сохрани факты: имя, ниша, задачи, "
+            "бюджет, сроки, договорённости и открытые вопросы. Без приветствий и воды, на языке диалога.\n\n"
+            f"Текущее резюме:\n{summary or '—'}\n\nНовые реплики:\n{dialog}"
+        )
+        with self._llm_slot():
             resp = self.client.chat.completions.create(
                 model=self.openai_model,
-                messages=messages,
-                max_tokens=220,
-                temperature=0.7,
-                top_p=0.9,
-                frequency_penalty=0.6,
-                presence_penalty=0.4
+                messages=[{"role": "user", "content": prompt}],
+                max_tokens=self.summary_tokens,
+                temperature=0.2,
             )
-            answer = resp.choices[0].message.content.strip()
-            hist.append({"role": "assistant", "content": answer})
-            self.history[chat_id] = hist[-24:]
-            logger.info(f"🧠 GPT ответил: {answer[:80]}...")
-            return answer
+        return resp.choices[0].message.content.strip(), folded
+
+    def _apply_summary(self, chat_id: str, hist: list) -> list:
+        """Подхватывает готовое фоновое резюме и убирает свёрнутые реплики из начала истории."""
+        with self._summary_lock:
+            job = self._summary_jobs.get(chat_id)
+            if job is None or not job.done():
+                return hist
+            del self._summary_jobs[chat_id]
+        try:
+            summary, folded = job.result()
         except Exception as e:
-            logger.error(f"Ошибка OpenAI: {e}")
-            error_messages = {
-                'ru': "Простите, произошёл технический сбой. Попробуйте ещё раз через минуту 🙏",
-                'kk': "Кешіріңіз, техникалық ақау орын алды. Бір минуттан кейін қайталап көріңіз 🙏",
-                'en': "Sorry, a technical error occurred. Please try again in a minute 🙏"
-            }
-            return error_messages.get(lang_code, error_messages['en'])
+            logger.error(f"Ошибка резюмирования истории {chat_id}: {e}")
+            return hist
+        # Пока резюме считалось, хвост мог быть обрезан — сворачиваем только то, что совпало
+        if hist[:len(folded)] != folded:
+            return hist
+        hist = hist[len(folded):]
+        self.summaries[chat_id] = summary
+        self.history[chat_id] = hist
+        logger.info(f"📝 Резюме истории {chat_id} обновлено: -{len(folded)} реплик")
+        return hist
+
+    def _cached_answer(self, chat_id: str, user_message: str) -> Optional[str]:
+        """Ответ из кеша, если вопрос типовой и история ещё короткая; реплики дописываются в историю."""
+        if not self.answer_cache:
+            return None
+        hist = self.history.get(chat_id) or []
+        if len(hist) > self.answer_cache_max_history:
+            return None
+        answer = self.answer_cache.get(self._cache_scope(chat_id), user_message)
+        if answer is None:
+            return None
+        hist = hist + [{"role": "user", "content": user_message}, {"role": "assistant", "content": answer}]
+        self._store_history(chat_id, hist)
+        logger.info(f"⚡ Ответ из кеша для {chat_id}: {answer[:60]}...")
+        return answer
+
+    def _cache_scope(self, chat_id: str) -> str:
+        """Раздел кеша ответов: язык чата, у инстанса — ещё и tenant (в ответах его бренд)."""
+        lang = self.user_language.get(chat_id, 'ru')
+        return f"{self.tenant}:{lang}" if self.tenant else lang
+
+    def _llm_fallback_text(self, lang_code: str) -> str:
+        """Ответ без LLM, пока предохранитель разомкнут: ведёт на быстрые интенты route_intent."""
+        texts = {
+            'ru': ("Сейчас ассистент отвечает с задержкой 🙏 Что могу сделать сразу:\n"
+                   "• напишите «прайс» — пришлю прайс-лист\n"
+                   "• напишите «консультация» — запишу на созвон\n"
+                   f"• поддержка: {self.support_phone}"),
+            'kk': ("Қазір көмекші кідіріспен жауап береді 🙏 Бірден жасай аламын:\n"
+                   "• «прайс» деп жазыңыз — прайс жіберемін\n"
+                   "• «кеңес» деп жазыңыз — қоңырауға жазамын\n"
+                   f"• қолдау: {self.support_phone}"),
+            'en': ("Our assistant is slow to respond right now 🙏 What I can do immediately:\n"
+                   "• type \"price\" — I'll send the price list\n"
+                   "• type \"consultation\" — I'll book a call\n"
+                   f"• support: {self.support_phone}"),
+        }
+        return texts.get(lang_code, texts['en'])
+
+    def _llm_error_text(self, lang_code: str) -> str:
+        error_messages = {
+            'ru': "Простите, произошёл технический сбой. Попробуйте ещё раз через минуту 🙏",
+            'kk': "Кешіріңіз, техникалық ақау орын алды. Бір минуттан кейін қайталап көріңіз 🙏",
+            'en': "Sorry, a technical error occurred. Please try again in a minute 🙏"
+        }
+        return error_messages.get(lang_code, error_messages['en'])
+
+    def _reply_with_llm(self, chat_id: str, message_text: str):
+        if self.llm_streaming:
+            self._stream_llm_reply(chat_id, message_text)
+            return
+        response = self.get_openai_response(chat_id, message_text)
+        self.send_message(chat_id, response, OutboundScheduler.LLM)
+
+    def _stream_llm_reply(self, chat_id: str, message_text: str):
+        """Ответ LLM по кускам: каждый завершённый абзац/список отправляется сразу."""
+        lang = self.user_language.get(chat_id, 'ru')
+        with self.metrics.timer("bot_stage_seconds", stage="llm", type="text", lang=lang) as timer:
+            cached = self._cached_answer(chat_id, message_text)
+            if cached is not None:
+                timer.labels["outcome"] = "cached"
+                self.send_message(chat_id, cached, OutboundScheduler.LLM)
+                return
+            if not self.llm_breaker.allow():
+                timer.labels["outcome"] = "fallback"
+                self.send_message(chat_id, self._llm_fallback_text(lang))
+                return
+            lang_code, hist, messages = self._prepare_llm_request(chat_id, message_text)
+            chunker = ReplyChunker(self.stream_min_chars, self.stream_max_chunks)
+            parts = []
+            complete = False
+            with self._llm_slot():
+                started = time.monotonic()
+                first_token = None
+                try:
+                    stream = self.client.chat.completions.create(
+                        model=self.openai_model,
+                        messages=messages,
+                        stream=True,
+                        **self._llm_kwargs(lang_code, stream=True)
+                    )
+                    for event in stream:
+                        if not event.choices:
+                            # Последнее событие потока — только usage (stream_options.include_usage)
+                            self.llm_usage.record(lang_code, getattr(event, "usage", None), time.monotonic() - started)
+                            continue
+                        if first_token is None:
+                            first_token = time.monotonic() - started
+                        delta = event.choices[0].delta.content or ""
+                        parts.append(delta)
+                        for chunk in chunker.feed(delta):
+                            self.send_message(chat_id, chunk, OutboundScheduler.LLM)
+                except Exception as e:
+                    self.llm_breaker.record(False, time.monotonic() - started)
+                    logger.error(f"Ошибка OpenAI (stream): {e}")
+                    timer.labels["outcome"] = "error"
+                    if not chunker.emitted:
+                        self.send_message(chat_id, self._llm_error_text(lang_code), OutboundScheduler.LLM)
+                        return
+                else:
+                    # Для стрима «медленно» — это долгое ожидание первого токена
+                    waited = first_token if first_token is not None else time.monotonic() - started
+                    self.llm_breaker.record(True, waited)
+                    complete = True
+
+            for chunk in chunker.close():
+                self.send_message(chat_id, chunk, OutboundScheduler.LLM)
+            self._finish_llm_answer(chat_id, hist, "".join(parts), complete)
 
     # === МАРШРУТИЗАЦИЯ ===
     def route_intent(self, text: str, lang_code: str, chat_id: str = None) -> Optional[str]:
@@ -415,24 +4031,12 @@ RULES:
         Маршрутизация по быстрым интентам (прайс, поддержка, консультация).
         Для консультации запускаем пошаговую форму.
         """
-        t = (text or "").lower().strip()
+        intents = self.intents.match(text, lang_code)
 
-        price_kw = {
-            'ru': ["цена", "стоимость", "прайс", "сколько стоит", "прайслист", "прайс-лист", "ценник",
-                   "давай", "давайте", "скинь", "скиньте", "пришли", "прайс пожалуйста", "прайс пж", "ок", "окей"],
-            'kk': ["баға", "құны", "прайс", "иә", "болсын", "жібер", "жібере сал", "ок"],
-            'en': ["price", "pricing", "cost", "how much", "pricelist", "send price", "ok", "okay", "yes",
-                   "share price"]
-        }
-        if any(k in t for k in price_kw.get(lang_code, [])):
+        if "price" in intents:
             return "__INTENT_PRICE__"
 
-        support_kw = {
-            'ru': ["поддержк", "саппорт", "техпод", "help", "support", "помощь", "свяжитесь"],
-            'kk': ["қолдау", "көмек", "support"],
-            'en': ["support", "help", "contact", "assist"]
-        }
-        if any(k in t for k in support_kw.get(lang_code, [])):
+        if "support" in intents:
             note = {
                 'ru': f"Наш номер поддержки: {self.support_phone}\nНапишите в WhatsApp — быстро ответим. 📞",
                 'kk': f"Біздің қолдау нөмірі: {self.support_phone}\nWhatsApp-қа жазыңыз — жылдам жауап береміз. 📞",
@@ -440,13 +4044,7 @@ RULES:
             }
             return note.get(lang_code, note['en'])
 
-        consult_keywords = {
-            'ru': ["записаться", "консультац", "созвон", "перезвон", "запишите меня", "запишите"],
-            'kk': ["жазылу", "кеңес", "қоңырау", "жазыңыз мені"],
-            'en': ["schedule", "consultation", "appointment", "call me", "book"]
-        }
-
-        if any(kw in t for kw in consult_keywords.get(lang_code, [])):
+        if "consult" in intents:
             if chat_id:
                 self.form_state[chat_id] = {"step": 1, "data": {}}
             forms_start = {
@@ -460,42 +4058,35 @@ RULES:
 
     # === СОХРАНЕНИЕ КЛИЕНТА ===
     def save_client_data(self, phone: str, data: dict) -> bool:
-        """Локально JSON + (опционально) запись в Google Sheets/CSV."""
-        try:
-            filename = "client_records.json"
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    clients = json.load(f)
-            else:
-                clients = {}
-
-            clients[phone] = {**data, 'recorded_at': datetime.now().isoformat(), 'status': 'new'}
-
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(clients, f, ensure_ascii=False, indent=2)
+        """Локально — append в журнал заявок + (опционально) запись в Google Sheets/CSV."""
+        with self.metrics.timer("bot_stage_seconds", stage="lead_save", type="form", lang="") as timer:
+            try:
+                record = self.leads.append(phone, {**data, 'recorded_at': datetime.now().isoformat(), 'status': 'new'})
 
-            self._persist_to_sheets_and_csv(clients[phone])
+                self._persist_to_sheets_and_csv(record)
 
-            logger.info(f"Записан клиент {phone}: {data.get('name', 'Без имени')}")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка сохранения: {e}")
-            return False
+                logger.info(f"Записан клиент {phone}: {data.get('name', 'Без имени')}")
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка сохранения: {e}")
+                timer.labels["outcome"] = "error"
+                return False
 
     def _persist_to_sheets_and_csv(self, row: dict):
         """Опционально: отправка в Google Sheets (если настроено), + append в CSV."""
         # CSV
         try:
-            import csv
-            csv_exists = os.path.exists("client_records.csv")
-            with open("client_records.csv", "a", newline="", encoding="utf-8") as f:
-                writer = csv.DictWriter(
-                    f,
-                    fieldnames=["recorded_at", "name", "company", "phone", "bot_type", "status"]
-                )
-                if not csv_exists:
-                    writer.writeheader()
-                writer.writerow({
+            with self._csv_lock:
+                if self._csv_writer is None:
+                    csv_exists = os.path.exists(self.csv_path)
+                    self._csv_file = open(self.csv_path, "a", newline="", encoding="utf-8")
+                    self._csv_writer = csv.DictWriter(
+                        self._csv_file,
+                        fieldnames=["recorded_at", "name", "company", "phone", "bot_type", "status"]
+                    )
+                    if not csv_exists:
+                        self._csv_writer.writeheader()
+                self._csv_writer.writerow({
                     "recorded_at": row.get("recorded_at"),
                     "name": row.get("name"),
                     "company": row.get("company"),
@@ -503,53 +4094,21 @@ RULES:
                     "bot_type": row.get("bot_type"),
                     "status": row.get("status", "new"),
                 })
+                self._csv_file.flush()
         except Exception as e:
             logger.warning(f"Ошибка записи в CSV: {e}")
 
-        # Google Sheets
-        try:
-            g_enable = os.environ.get("GOOGLE_SHEETS_ENABLED", "").lower() == "true"
-            creds_json = os.environ.get("GOOGLE_SERVICE_ACCOUNT_JSON")
-            sheet_name = os.environ.get("GOOGLE_SHEETS_SPREADSHEET")
-            worksheet = os.environ.get("GOOGLE_SHEETS_WORKSHEET", "Leads")
-
-            if g_enable and creds_json and sheet_name:
-                import gspread
-                from google.oauth2.service_account import Credentials
-
-                creds_dict = json.loads(creds_json)
-                scopes = [
-                    "https://www.googleapis.com/auth/spreadsheets",
-                    "https://www.googleapis.com/auth/drive",
-                ]
-                credentials = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-                gc = gspread.authorize(credentials)
-                sh = gc.open(sheet_name)
-
-                if worksheet not in [w.title for w in sh.worksheets()]:
-                    ws = sh.add_worksheet(title=worksheet, rows=1000, cols=10)
-                else:
-                    ws = sh.worksheet(worksheet)
-
-                headers = ["Дата", "Имя", "Компания", "Телефон", "Задача", "Источник", "Статус"]
-                first_row = ws.row_values(1)
-                if not first_row or first_row != headers:
-                    ws.update("A1:G1", [headers])
-                    logger.info("🧾 Заголовок таблицы обновлён")
-
-                ws.append_row([
-                    datetime.now().strftime("%d.%m.%Y %H:%M"),
-                    row.get("name"),
-                    row.get("company"),
-                    row.get("phone"),
-                    row.get("bot_type"),
-                    "WhatsApp",
-                    row.get("status", "new"),
-                ], value_input_option="USER_ENTERED")
-
-                logger.info("✅ Добавлено в Google Sheets")
-        except Exception as e:
-            logger.warning(f"Google Sheets недоступен или не настроен: {e}")
+        # Google Sheets — в фоне, пачками
+        if self.sheets:
+            self.sheets.enqueue([
+                datetime.now().strftime("%d.%m.%Y %H:%M"),
+                row.get("name"),
+                row.get("company"),
+                row.get("phone"),
+                row.get("bot_type"),
+                "WhatsApp",
+                row.get("status", "new"),
+            ])
 
     # === СТАРЫЙ extract_client_info (на будущее) ===
     def extract_client_info(self, text: str, lang_code: str) -> dict:
@@ -628,6 +4187,7 @@ RULES:
 
             data["name"] = txt
             state["step"] = 2
+            self.form_state[chat_id] = state
 
             msgs = {
                 'ru': "Отлично, {name}! Теперь укажите *название вашей компании* "
@@ -648,6 +4208,7 @@ RULES:
                 data["company"] = txt
 
             state["step"] = 3
+            self.form_state[chat_id] = state
 
             msgs = {
                 'ru': "Укажите, пожалуйста, ваш номер телефона 📱",
@@ -671,6 +4232,7 @@ RULES:
 
             data["phone"] = txt
             state["step"] = 4
+            self.form_state[chat_id] = state
 
             msgs = {
                 'ru': "Круто! Теперь кратко опишите задачу: что вам нужно — сайт, бот, автоматизация, маркетинг? 🙂",
@@ -713,6 +4275,27 @@ RULES:
 
     # === ОБРАБОТКА СООБЩЕНИЙ (с учётом SWE001 и ручного режима) ===
     def process_message(self, notification: dict):
+        """Обработка одного уведомления + метрика stage="process". True — текст отложен в склейку."""
+        if self.capture:
+            self.capture.record(notification)
+        started = time.monotonic()
+        result = None
+        try:
+            result = self._process_notification(notification)
+            return result
+        finally:
+            body = (notification or {}).get('body') or {}
+            message_data = body.get('messageData') or {}
+            chat_id = (body.get('senderData') or {}).get('chatId', '')
+            self.metrics.observe(
+                "bot_stage_seconds", time.monotonic() - started,
+                stage="process",
+                type=message_data.get('typeMessage') or body.get('typeWebhook', ''),
+                lang=self.user_language.get(chat_id, '') if chat_id else '',
+                outcome="deferred" if result is True else "ok",
+            )
+
+    def _process_notification(self, notification: dict):
         try:
             if not notification:
                 return
@@ -728,11 +4311,17 @@ RULES:
             chat_id = sender_data.get('chatId', '')
             phone = sender_data.get('sender', '')
 
-            if message_id and message_id in self.processed_messages:
+            # Переигрываемое из журнала не завершилось, хотя idMessage мог уже попасть в дедуп
+            if message_id and message_id in self.processed_messages and not notification.get('replayed'):
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
+            # Всё, что не склеивается (кнопки, команды, сообщения менеджера), идёт после накопленной серии
+            if self.coalescer and chat_id and self.coalescer.pending(chat_id) \
+                    and not self._is_coalescible(type_webhook, message_data):
+                self._flush_coalesced(chat_id)
+
             # === Исходящие сообщения (менеджер) ===
             if type_webhook == 'outgoingMessageReceived':
                 raw_text = self._extract_text(message_data)
@@ -745,7 +4334,7 @@ RULES:
                     logger.info(f"🧑‍💼 Менеджер включил ручной режим для {chat_id} (бот молчит)")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 if message_text.strip() == '/bot_on':
@@ -753,7 +4342,7 @@ RULES:
                     logger.info(f"🤖 Менеджер отключил ручной режим, бот снова активен в чате {chat_id}")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 # Любое другое сообщение менеджера = вмешательство → включаем ручной режим
@@ -762,18 +4351,18 @@ RULES:
 
                 self.processed_messages.add(message_id)
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             # Обрабатываем только входящие от клиента
             if type_webhook != 'incomingMessageReceived':
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             if not chat_id:
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             # Если чат в ручном режиме — бот молчит
@@ -781,7 +4370,7 @@ RULES:
                 logger.info(f"⏸️ Чат {chat_id} в ручном режиме, бот не отвечает")
                 self.processed_messages.add(message_id)
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             # Текст или extendedText
@@ -806,7 +4395,7 @@ RULES:
                     logger.warning(f"⚠️ SWE001 в чате {chat_id}, попросили клиента продублировать сообщение")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 if not message_text:
@@ -817,7 +4406,7 @@ RULES:
                         self.send_message(chat_id, "Не расслышал сообщение. Напишите, пожалуйста, ещё раз 🙂")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 logger.info(f"📩 Текстовое сообщение от {phone}: {message_text}")
@@ -830,7 +4419,7 @@ RULES:
                         self.send_message(chat_id, "У вас нет доступа к этой команде")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 if message_text.strip() == '/reset':
@@ -839,7 +4428,7 @@ RULES:
                         self.send_message(chat_id, "✅ История чата очищена")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 # ЯЗЫК
@@ -855,38 +4444,20 @@ RULES:
                         logger.info(f"⏸️ Игнорируем сообщение до выбора языка: {message_text[:50]}")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 lang_code = self.user_language[chat_id]
 
-                # Пошаговая форма консультации
-                if chat_id in self.form_state:
-                    self.handle_form_step(chat_id, phone, message_text, lang_code)
-                    self.processed_messages.add(message_id)
-                    if receipt_id:
-                        self.delete_notification(receipt_id)
-                    return
-
-                # Быстрая маршрутизация
-                quick = self.route_intent(message_text, lang_code, chat_id)
-                if quick:
-                    if quick == "__INTENT_PRICE__":
-                        self._send_price(chat_id, lang_code)
-                    else:
-                        self.send_message(chat_id, quick)
-                    self.processed_messages.add(message_id)
-                    if receipt_id:
-                        self.delete_notification(receipt_id)
-                    return
+                # Склейка: route_intent/LLM увидят всю серию одной репликой после паузы
+                if self._coalesce(notification, chat_id, phone, message_text, message_id, lang_code):
+                    return True
 
-                # GPT
-                response = self.get_openai_response(chat_id, message_text)
-                self.send_message(chat_id, response)
+                self._handle_text_turn(chat_id, phone, message_text, lang_code)
 
                 self.processed_messages.add(message_id)
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             # КНОПКИ
@@ -896,7 +4467,7 @@ RULES:
                     logger.info(f"⏸️ Чат {chat_id} в ручном режиме (interactiveButtonsResponse игнорируется)")
                     self.processed_messages.add(message_id)
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 reply_data = message_data.get('interactiveButtonsResponse', {}) or {}
@@ -905,7 +4476,7 @@ RULES:
                 if not selected_button:
                     logger.error(f"Нет selectedButtonId: {json.dumps(message_data)}")
                     if receipt_id:
-                        self.delete_notification(receipt_id)
+                        self._ack(receipt_id)
                     return
 
                 logger.info(f"🔘 Нажата кнопка: {selected_button} ({selected_text}) от {chat_id}")
@@ -941,48 +4512,135 @@ RULES:
 
                 self.processed_messages.add(message_id)
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
             else:
                 logger.info(f"Игнорируем неподдерживаемый тип: {message_data.get('typeMessage')}")
                 if receipt_id:
-                    self.delete_notification(receipt_id)
+                    self._ack(receipt_id)
                 return
 
         except Exception as e:
             logger.error(f"Ошибка обработки сообщения: {e}")
             rid = notification.get('receiptId') if notification else None
             if rid:
-                self.delete_notification(rid)
+                self._ack(rid)
+
+    def _handle_text_turn(self, chat_id: str, phone: str, message_text: str, lang_code: str):
+        """Реплика клиента с выбранным языком: шаг формы, быстрый интент или ответ LLM."""
+        # Пошаговая форма консультации
+        if chat_id in self.form_state:
+            with self.metrics.timer("bot_stage_seconds", stage="form_step", type="text", lang=lang_code):
+                self.handle_form_step(chat_id, phone, message_text, lang_code)
+            return
+
+        # Быстрая маршрутизация
+        with self.metrics.timer("bot_stage_seconds", stage="route_intent", type="text", lang=lang_code) as timer:
+            quick = self.route_intent(message_text, lang_code, chat_id)
+            timer.labels["outcome"] = ("price" if quick == "__INTENT_PRICE__" else "intent") if quick else "none"
+        if quick:
+            if quick == "__INTENT_PRICE__":
+                self._send_price(chat_id, lang_code)
+            else:
+                self.send_message(chat_id, quick)
+            return
+
+        # GPT
+        self._reply_with_llm(chat_id, message_text)
+
+    # === СКЛЕЙКА СООБЩЕНИЙ ===
+    @staticmethod
+    def _is_coalescible(type_webhook: str, message_data: dict) -> bool:
+        if type_webhook != 'incomingMessageReceived':
+            return False
+        if message_data.get('typeMessage') not in ('textMessage', 'extendedTextMessage'):
+            return False
+        data = message_data.get('textMessageData') or message_data.get('extendedTextMessageData') or {}
+        text = data.get('textMessage') or data.get('text') or ''
+        return not text.strip().startswith('/')
+
+    def _coalesce(self, notification: dict, chat_id: str, phone: str, message_text: str, message_id,
+                  lang_code: str) -> bool:
+        """
+        Откладывает текст в серию чата. Подтверждение откладывается вместе с ним, поэтому склеивать
+        можно только уже принятое в журнал (journalId) или уже удалённое из очереди (нет receiptId):
+        в последовательном опросе голова очереди не освободится, пока сообщение не обработано.
+        Быстрые интенты («прайс», «консультация») не ждут окна: серия до них уходит сразу.
+        """
+        if not self.coalescer or chat_id in self.form_state:
+            return False
+        if notification.get('receiptId') and not notification.get('journalId'):
+            return False
+        if self.intents.match(message_text, lang_code):
+            if self.coalescer.pending(chat_id):
+                self._flush_coalesced(chat_id)
+            return False
+        self.coalescer.add(chat_id, message_text, phone=phone, message_id=message_id,
+                           ack_id=notification.get('journalId'))
+        return True
+
+    def _schedule_coalesced_flush(self, chat_id: str):
+        """Серия готова — обработать её в потоке чата, чтобы сохранить порядок с остальными сообщениями."""
+        if self.dispatcher:
+            self.dispatcher.submit(chat_id, {"coalesced": chat_id, "queuedAt": time.monotonic()})
+        else:
+            self._flush_coalesced(chat_id)
+
+    def _flush_coalesced(self, chat_id: str):
+        batch = self.coalescer.take(chat_id) if self.coalescer else None
+        if not batch:
+            return
+        try:
+            if self.is_manual_mode(chat_id):
+                logger.info(f"⏸️ Чат {chat_id} в ручном режиме, склеенные сообщения без ответа")
+            else:
+                text = "\n".join(batch["texts"])
+                if len(batch["texts"]) > 1:
+                    logger.info(f"🧩 Склеено {len(batch['texts'])} сообщений от {chat_id}: {text[:80]!r}")
+                self._handle_text_turn(chat_id, batch["phone"], text, self.user_language.get(chat_id, 'ru'))
+        except Exception as e:
+            logger.error(f"Ошибка обработки склеенных сообщений {chat_id}: {e}")
+        finally:
+            for message_id in batch["message_ids"]:
+                if message_id:
+                    self.processed_messages.add(message_id)
+            self._complete_acks(batch["ack_ids"])
+
+    def _complete_acks(self, jids):
+        """Обработка уведомлений завершена — done в журнал подтверждений."""
+        for jid in jids:
+            self.acks.complete(jid)
 
     def _send_price(self, chat_id: str, lang_code: str):
+        caption = self._price_caption(lang_code)
+        price = self.price_files.resolve(lang_code)
+
+        if price:
+            file_url, file_name, source_url = price
+            ok = self.send_file_by_url(chat_id, file_url, file_name, caption=caption)
+            if not ok and file_url != source_url:
+                self.price_files.invalidate(source_url)  # копия в Green-API недоступна — перезагрузим
+                ok = self.send_file_by_url(chat_id, source_url, file_name, caption=caption)
+            if not ok:
+                self.send_message(chat_id, caption + "\n\n" + source_url)
+        else:
+            self.send_message(chat_id, caption + "\n\n(Файл прайса пока не подключён. Укажите PRICE_FILE_URL в .env)")
+
+    def _price_caption(self, lang_code: str) -> str:
         caption_map = {
             'ru': "Отправляю актуальный прайс *{brand}*. Если нужен расчёт под вашу задачу — напишите нишу и сроки 🙂",
             'kk': "*{brand}* прайсын жіберемін. Дәл есеп керек болса — сала мен мерзімдерді жазыңыз 🙂",
             'en': "Sharing *{brand}* pricing file. For a tailored estimate, tell your niche and timeline 🙂"
         }
-        caption = caption_map.get(lang_code, caption_map['en']).format(brand=self.brand)
-
-        if self.price_url:
-            ok = self.send_file_by_url(chat_id, self.price_url, self.price_filename, caption=caption)
-            if not ok:
-                self.send_message(chat_id, caption + "\n\n" + self.price_url)
-        else:
-            self.send_message(chat_id, caption + "\n\n(Файл прайса пока не подключён. Укажите PRICE_FILE_URL в .env)")
+        return caption_map.get(lang_code, caption_map['en']).format(brand=self.brand)
 
     def handle_clients_command(self, chat_id: str):
         try:
-            filename = "client_records.json"
-            if not os.path.exists(filename):
-                self.send_message(chat_id, "📭 Записей пока нет")
-                return
-            with open(filename, 'r', encoding='utf-8') as f:
-                clients = json.load(f)
-            if not clients:
+            recent = self.leads.last(3)
+            if not recent:
                 self.send_message(chat_id, "📭 Записей пока нет")
                 return
-            recent = list(clients.items())[-3:]
             response_lines = ["📋 Последние записи:\n"]
             for phone, data in recent:
                 response_lines.append(
@@ -996,47 +4654,755 @@ RULES:
         except Exception as e:
             self.send_message(chat_id, f"Ошибка: {e}")
 
-    def run(self):
+    def run(self, profile: bool = False):
+        """
+        Критический путь до первого опроса — только то, без чего нельзя принимать сообщения;
+        setSettings, проверка прайса и импорт openai идут в фоне (StartupProfile.background).
+        profile — режим --profile-startup: один опрос без long-poll, отчёт по фазам и выход.
+        """
         logger.info("🤖 Бот запущен!")
-        self.load_user_languages()
+        with self.startup.phase("перенос языков"):
+            self.load_user_languages()
+        self.startup.background("setSettings", self._apply_instance_settings)
+        self.startup.background("проверка PRICE_FILE_URL", self._check_price_link)
+        self.startup.background("импорт openai", lambda: self.client)
+
+        with self.startup.phase("воркеры и журнал подтверждений"):
+            if self.workers > 0:
+                self.dispatcher = ChatDispatcher(self._process_journaled, self.workers, self.max_pending)
+                self.dispatcher.start()
+            self.acks.start()
+            for jid, notification in self.acks.recover():
+                self._submit(jid, {**notification, "replayed": True})
+        with self.startup.phase("/metrics"):
+            self.start_metrics_server()
+
+        if self.cluster:
+            self.cluster.start()  # опрос Green-API поднимет узел, получивший аренду "poller"
+        if self.webhook_url or self.cluster:
+            if self.webhook_url:
+                self.start_webhook_server()
+            self.startup.ready()
+            if profile:
+                return self._finish_profile()
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                logger.info("⛔ Бот остановлен")
+                self.shutdown()
+            return
 
+        self.receiver = NotificationReceiver(
+            self.poll_notification, self.dispatch, self._release_head,
+            receive_timeout=self.receive_timeout,
+        )
+        self.startup.ready()
+        if profile:
+            # receiveNotification голову не удаляет — опрос без long-poll безопасен и быстр
+            with self.startup.phase("первый receiveNotification"):
+                self.poll_notification(0)
+            return self._finish_profile()
+        try:
+            self.receiver.run()
+        except KeyboardInterrupt:
+            logger.info("⛔ Бот остановлен")
+            self.shutdown()
+
+    def _finish_profile(self):
+        if not self.startup.wait_background():
+            logger.warning("Фоновые задачи старта не завершились за 30 с")
+        print(self.startup.report())
+        self.shutdown()
+
+    def _apply_instance_settings(self):
         try:
-            settings_url = f"{self.base_url}/setSettings/{self.api_token}"
-            settings = {"incomingWebhook": "yes", "pollMessageWebhook": "yes"}
-            requests.post(settings_url, json=settings, timeout=10)
+            self.transport.post("setSettings", json=self._instance_settings())
         except Exception as e:
             logger.warning(f"Не удалось применить setSettings: {e}")
 
-        while True:
-            try:
-                notification = self.get_notification()
-                if notification:
-                    self.process_message(notification)
-                else:
-                    time.sleep(1)
-            except KeyboardInterrupt:
-                logger.info("⛔ Бот остановлен")
-                break
-            except Exception as e:
-                logger.error(f"Ошибка в главном цикле: {e}")
-                time.sleep(5)
+    def shutdown(self):
+        """Останавливает приём и дорабатывает принятое: склейку, воркеры, подтверждения, состояние."""
+        if self.cluster:
+            self.cluster.stop()
+        if self.webhook_server:
+            self.webhook_server.stop()
+        if self.receiver:
+            self.receiver.stop()
+        if self.coalescer:
+            self.coalescer.stop()
+        if self.dispatcher:
+            self.dispatcher.stop(timeout=30)
+        self.acks.flush(timeout=10)
+        self.state.flush()
+        self.processed_messages.flush()
+        if self.cluster:
+            self.cluster.leave()  # недоделанное (например, в склейке) вернётся в inbox другим узлам
+        if self.sheets:
+            self.sheets.stop(timeout=10)
+        if self.capture:
+            self.capture.close()
+
+    def _register_collectors(self):
+        """Очереди инстанса — в /metrics на каждый scrape (LLM, кеш и предохранитель — в SharedResources)."""
+        m = self.metrics
+        m.collect("bot_outbound_pending", "gauge", "Отправки, ждущие разрешения планировщика",
+                  lambda: self.outbound.pending())
+        m.collect("bot_dispatcher_pending", "gauge", "Уведомления в очереди воркеров",
+                  lambda: self.dispatcher.pending() if self.dispatcher else 0)
+        if self.cluster:
+            m.collect("bot_cluster_partitions", "gauge", "Разделы чатов, арендованные узлом",
+                      lambda: self.cluster.stats()["owned"])
+            m.collect("bot_cluster_inbox_pending", "gauge", "Сообщения общего inbox, ждущие узла",
+                      lambda: self.cluster.store.pending())
+
+    def start_metrics_server(self) -> Optional[MetricsServer]:
+        if self.metrics_port <= 0 or self.metrics_server:
+            return self.metrics_server
+        self.metrics_server = self.shared.start_metrics_server(self.metrics_host, self.metrics_port)
+        if self.metrics_server:
+            self._register_collectors()
+        return self.metrics_server
+
+    def _instance_settings(self) -> dict:
+        settings = {"incomingWebhook": "yes", "pollMessageWebhook": "yes"}
+        if self.webhook_url:
+            settings["webhookUrl"] = self.webhook_url
+            if self.webhook_token:
+                settings["webhookUrlToken"] = self.webhook_token
+        return settings
+
+    def on_webhook(self, body: dict) -> bool:
+        """Вебхук → тот же конвейер, что и у опроса. deleteNotification не нужен: ack — это ответ 200."""
+        if self.cluster:
+            return self.cluster.enqueue(body)
+        notification = {"receiptId": None, "body": body}
+        jid = f"wh:{body['idMessage']}" if body.get('idMessage') else None
+        if jid:
+            self.acks.accept(jid, notification)
+        if not self.dispatcher:
+            threading.Thread(target=self._process_journaled, args=({**notification, "journalId": jid},),
+                             daemon=True).start()
+            return True
+        return self._submit(jid, notification, timeout=2)
+
+    def start_webhook_server(self, on_notification=None) -> WebhookServer:
+        self.webhook_server = WebhookServer(
+            on_notification or self.on_webhook,
+            port=self.webhook_port,
+            path=self.webhook_path,
+            token=self.webhook_token,
+        )
+        self.webhook_server.start()
+        return self.webhook_server
+
+    def dispatch(self, notification: dict) -> bool:
+        """
+        Передаёт уведомление воркеру его чата. Возвращает True, если голову очереди нужно освободить.
+        receiveNotification отдаёт голову, пока её не удалят, поэтому в режиме диспетчера уведомление
+        сначала долговечно пишется в журнал (accept), и только потом голова освобождается;
+        воркер получает копию без receiptId и по завершении отмечает done.
+        """
+        receipt_id = notification.get('receiptId')
+        if not self.dispatcher:
+            if receipt_id is not None and self.acks.is_closed(receipt_id):
+                return False  # ответ на опрос обогнал удаление — уже обработано
+            if receipt_id is not None and self.acks.is_pending(receipt_id):
+                # Уже обработано, удаление ещё в пути — не крутим одну и ту же голову
+                self.acks.wait(receipt_id, timeout=5)
+                return False
+            self.process_message(notification)  # подтверждает через self._ack
+            return False
+
+        if receipt_id is not None:
+            self.acks.accept(receipt_id, notification)
+        return self._submit(receipt_id, notification)
+
+    def _submit(self, jid, notification: dict, timeout: Optional[float] = None) -> bool:
+        body = notification.get('body', {}) or {}
+        chat_id = (body.get('senderData', {}) or {}).get('chatId', '')
+        item = {k: v for k, v in notification.items() if k != 'receiptId'}
+        item['journalId'] = jid
+        item['queuedAt'] = time.monotonic()
+        if not self.dispatcher:
+            self._process_journaled(item)
+            return True
+        return self.dispatcher.submit(chat_id, item, timeout=timeout)
+
+    def _process_journaled(self, item: dict):
+        if item.get('queuedAt'):
+            self.metrics.observe("bot_stage_seconds", time.monotonic() - item['queuedAt'],
+                                 stage="queue_wait", type="", lang="", outcome="ok")
+        if item.get('coalesced'):
+            self._flush_coalesced(item['coalesced'])
+            return
+        deferred = False
+        try:
+            # True — текст ушёл в склейку, подтвердит его _flush_coalesced
+            deferred = self.process_message(item) is True
+        finally:
+            if not deferred:
+                self.acks.complete(item.get('journalId'))
+
+    def _release_head(self, receipt_id: int) -> bool:
+        """Освобождает голову очереди Green-API для уже принятого в журнал уведомления."""
+        ok = self.delete_notification(receipt_id)
+        self.acks.mark_acked(receipt_id, ok)
+        return ok
+
+    def _cluster_acquired(self, part: int):
+        """Раздел пришёл с другого узла: кеш его чатов мог устареть."""
+        def in_part(chat_id):
+            return self.cluster.partition_of(chat_id) == part
+
+        for chats in (self.user_language, self.form_state, self.manual_mode, self.history, self.summaries):
+            chats.forget(in_part)
+        for chat_id in [c for c in self.awaiting_form if in_part(c)]:
+            self.awaiting_form.pop(chat_id, None)
+
+    def _cluster_leader(self, leader: bool):
+        """Аренда "poller": опрашиваем очередь Green-API и складываем уведомления в общий inbox."""
+        if not leader:
+            if self.receiver:
+                # Поток heartbeat не ждёт текущий long-poll; принятое им отсеет inbox по idMessage
+                self.receiver.stop(wait=False)
+                self.receiver = None
+            return
+        self.receiver = NotificationReceiver(
+            self.poll_notification, lambda n: self.cluster.enqueue(n.get('body') or {}), self.delete_notification,
+            receive_timeout=self.receive_timeout,
+        )
+        threading.Thread(target=self.receiver.run, name="cluster-poller", daemon=True).start()
+
+    def _ack(self, receipt_id):
+        """Обработка уведомления завершена — подтверждение уходит в фоновую стадию."""
+        if receipt_id:
+            self.acks.complete(receipt_id)
 
     def _check_price_link(self):
+        """HEAD по каждому файлу прайса и прогрев копий в Green-API — первое нажатие не ждёт загрузки."""
+        if not self.price_files.sources:
+            logger.warning("PRICE_FILE_URL не задан")
+            return
+        self.price_files.check()
+
+    def upload_file(self, data: bytes, file_name: str, content_type: str) -> Optional[str]:
+        """uploadFile Green-API: файл в их хранилище, в ответ urlFile для sendFileByUrl."""
+        url = f"{self.media_url}/uploadFile/{self.api_token}"
+        started = time.monotonic()
+        try:
+            r = self.transport.session.post(url, data=data, timeout=60,
+                                            headers={"Content-Type": content_type, "GA-Filename": file_name})
+        except Exception as e:
+            self.transport.observe("uploadFile", started, e.__class__.__name__)
+            logger.error(f"Ошибка uploadFile: {e}")
+            return None
+        self.transport.observe("uploadFile", started, r.status_code)
+        if r.status_code != 200:
+            logger.error("Ошибка uploadFile: %s %s", r.status_code, r.text)
+            return None
+        return (r.json() or {}).get("urlFile")
+
+
+# === ASYNCIO-ДВИЖОК ===
+class AsyncWhatsAppBot(WhatsAppBot):
+    """
+    asyncio-вариант бота: приём, отправка и подтверждение уведомлений через httpx.AsyncClient,
+    ответы LLM через AsyncOpenAI — один процесс держит сотни диалогов без потока на каждый.
+
+    Маршрутизация (process_message, формы, интенты) общая с синхронным ботом. Синхронные
+    send_*/delete_notification здесь — тонкие обёртки: в цикле событий они ставят async-операцию
+    в цепочку чата (порядок внутри чата сохраняется) и сразу возвращают True,
+    вне цикла — выполняют её и ждут результат.
+    """
+
+    def __init__(self, config: Optional[dict] = None, shared: Optional[SharedResources] = None):
+        super().__init__(config, shared)
+        if self.cluster:
+            raise ValueError("CLUSTER_MODE пока поддерживается только с BOT_ENGINE=threads")
+        self.atransport = None  # AsyncGreenApiTransport, создаётся внутри цикла событий
+        self.max_inflight = int(self._cfg("ASYNC_MAX_INFLIGHT", "200"))
+        self._loop = None
+        self._chains = {}  # {chat_id: asyncio.Task последней операции чата}
+        self._deferred_acks = None  # done, отложенные до конца цепочек текущей маршрутизации (_track)
+
+    @property
+    def aclient(self):
+        return self.shared.async_openai()
+
+    # --- async I/O ---
+
+    async def send_message_async(self, chat_id: str, message: str,
+                                 priority: int = OutboundScheduler.INTERACTIVE) -> bool:
+        payload = {"chatId": chat_id, "message": message}
+        try:
+            await self.outbound.acquire_async(chat_id, priority)
+            r = await self.atransport.post("sendMessage", json=payload)
+            ok = r.status_code == 200
+            if not ok:
+                logger.error("Ошибка отправки: %s %s", r.status_code, r.text)
+            return ok
+        except Exception as e:
+            logger.error(f"Ошибка отправки: {e}")
+            return False
+
+    async def send_file_by_url_async(self, chat_id: str, file_url: str, file_name: str, caption: str = "",
+                                     priority: int = OutboundScheduler.INTERACTIVE) -> bool:
+        payload = {"chatId": chat_id, "urlFile": file_url, "fileName": file_name, "caption": caption or ""}
+        try:
+            await self.outbound.acquire_async(chat_id, priority)
+            r = await self.atransport.post("sendFileByUrl", json=payload)
+            ok = r.status_code == 200
+            if not ok:
+                logger.error("Ошибка отправки файла: %s %s", r.status_code, r.text)
+            return ok
+        except Exception as e:
+            logger.error(f"Ошибка отправки файла: {e}")
+            return False
+
+    async def send_welcome_with_actions_async(self, chat_id: str, lang_code: str) -> bool:
+        try:
+            await self.outbound.acquire_async(chat_id, OutboundScheduler.INTERACTIVE)
+            r = await self.atransport.post("sendInteractiveButtonsReply", json=self._welcome_payload(chat_id, lang_code))
+            ok = r.status_code == 200
+            if not ok:
+                logger.error(f"Ошибка send_welcome_with_actions: {r.status_code} {r.text}")
+            return ok
+        except Exception as e:
+            logger.error(f"Ошибка отправки welcome+actions: {e}")
+            return False
+
+    async def send_language_selection_async(self, chat_id: str) -> bool:
+        payload, fallback = self._language_selection_payload(chat_id)
+        try:
+            await self.outbound.acquire_async(chat_id, OutboundScheduler.INTERACTIVE)
+            r = await self.atransport.post("sendInteractiveButtonsReply", json=payload)
+            if r.status_code == 200:
+                logger.info(f"✅ Отправлены кнопки выбора языка для {chat_id}")
+                return True
+            logger.error(f"Ошибка отправки кнопок: {r.status_code} {r.text}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки кнопок: {e}")
+        await self.send_message_async(chat_id, fallback)
+        return False
+
+    async def get_notification_async(self, receive_timeout: Optional[int] = None) -> Optional[dict]:
+        params, timeout = None, None
+        if receive_timeout:
+            params = {"receiveTimeout": receive_timeout}
+            timeout = receive_timeout + 10
+        try:
+            r = await self.atransport.get("receiveNotification", params=params, timeout=timeout)
+            if r.status_code == 200:
+                return r.json()
+            logger.error("receiveNotification %s %s", r.status_code, r.text)
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка получения уведомлений: {e}")
+            return None
+
+    async def delete_notification_async(self, receipt_id: int) -> bool:
+        try:
+            r = await self.atransport.delete("deleteNotification", receipt_id)
+            ok = r.status_code == 200
+            if not ok:
+                logger.error("deleteNotification %s %s", r.status_code, r.text)
+            return ok
+        except Exception as e:
+            logger.error(f"Ошибка удаления уведомления: {e}")
+            return False
+
+    def _allm_slot(self):
+        return self.shared.async_llm_slots() or nullcontext()
+
+    async def get_openai_response_async(self, chat_id: str, user_message: str) -> str:
+        lang = self.user_language.get(chat_id, 'ru')
+        with self.metrics.timer("bot_stage_seconds", stage="llm", type="text", lang=lang) as timer:
+            cached = self._cached_answer(chat_id, user_message)
+            if cached is not None:
+                timer.labels["outcome"] = "cached"
+                return cached
+            if not self.llm_breaker.allow():
+                timer.labels["outcome"] = "fallback"
+                return self._llm_fallback_text(lang)
+            lang_code, hist, messages = self._prepare_llm_request(chat_id, user_message)
+            async with self._allm_slot():
+                started = time.monotonic()
+                try:
+                    resp = await self.aclient.chat.completions.create(
+                        model=self.openai_model,
+                        messages=messages,
+                        **self._llm_kwargs(lang_code)
+                    )
+                except Exception as e:
+                    self.llm_breaker.record(False, time.monotonic() - started)
+                    logger.error(f"Ошибка OpenAI: {e}")
+                    timer.labels["outcome"] = "error"
+                    return self._llm_error_text(lang_code)
+            self.llm_breaker.record(True, time.monotonic() - started)
+            self.llm_usage.record(lang_code, getattr(resp, "usage", None), time.monotonic() - started)
+            return self._finish_llm_answer(chat_id, hist, resp.choices[0].message.content)
+
+    async def _reply_with_llm_async(self, chat_id: str, message_text: str):
+        if self.llm_streaming:
+            await self._stream_llm_reply_async(chat_id, message_text)
+            return
+        response = await self.get_openai_response_async(chat_id, message_text)
+        await self.send_message_async(chat_id, response, OutboundScheduler.LLM)
+
+    async def _stream_llm_reply_async(self, chat_id: str, message_text: str):
+        lang = self.user_language.get(chat_id, 'ru')
+        with self.metrics.timer("bot_stage_seconds", stage="llm", type="text", lang=lang) as timer:
+            cached = self._cached_answer(chat_id, message_text)
+            if cached is not None:
+                timer.labels["outcome"] = "cached"
+                await self.send_message_async(chat_id, cached, OutboundScheduler.LLM)
+                return
+            if not self.llm_breaker.allow():
+                timer.labels["outcome"] = "fallback"
+                await self.send_message_async(chat_id, self._llm_fallback_text(lang))
+                return
+            lang_code, hist, messages = self._prepare_llm_request(chat_id, message_text)
+            chunker = ReplyChunker(self.stream_min_chars, self.stream_max_chunks)
+            parts = []
+            complete = False
+            async with self._allm_slot():
+                started = time.monotonic()
+                first_token = None
+                try:
+                    stream = await self.aclient.chat.completions.create(
+                        model=self.openai_model,
+                        messages=messages,
+                        stream=True,
+                        **self._llm_kwargs(lang_code, stream=True)
+                    )
+                    async for event in stream:
+                        if not event.choices:
+                            # Последнее событие потока — только usage (stream_options.include_usage)
+                            self.llm_usage.record(lang_code, getattr(event, "usage", None), time.monotonic() - started)
+                            continue
+                        if first_token is None:
+                            first_token = time.monotonic() - started
+                        delta = event.choices[0].delta.content or ""
+                        parts.append(delta)
+                        for chunk in chunker.feed(delta):
+                            await self.send_message_async(chat_id, chunk, OutboundScheduler.LLM)
+                except Exception as e:
+                    self.llm_breaker.record(False, time.monotonic() - started)
+                    logger.error(f"Ошибка OpenAI (stream): {e}")
+                    timer.labels["outcome"] = "error"
+                    if not chunker.emitted:
+                        await self.send_message_async(chat_id, self._llm_error_text(lang_code), OutboundScheduler.LLM)
+                        return
+                else:
+                    # Для стрима «медленно» — это долгое ожидание первого токена
+                    waited = first_token if first_token is not None else time.monotonic() - started
+                    self.llm_breaker.record(True, waited)
+                    complete = True
+
+            for chunk in chunker.close():
+                await self.send_message_async(chat_id, chunk, OutboundScheduler.LLM)
+            self._finish_llm_answer(chat_id, hist, "".join(parts), complete)
+
+    async def _send_price_async(self, chat_id: str, lang_code: str):
+        caption = self._price_caption(lang_code)
+        # Копия в Green-API почти всегда уже есть; загрузка при промахе — в потоке, не в цикле событий
+        price = await asyncio.to_thread(self.price_files.resolve, lang_code)
+        if price:
+            file_url, file_name, source_url = price
+            ok = await self.send_file_by_url_async(chat_id, file_url, file_name, caption=caption)
+            if not ok and file_url != source_url:
+                self.price_files.invalidate(source_url)
+                ok = await self.send_file_by_url_async(chat_id, source_url, file_name, caption=caption)
+            if not ok:
+                await self.send_message_async(chat_id, caption + "\n\n" + source_url)
+        else:
+            await self.send_message_async(
+                chat_id, caption + "\n\n(Файл прайса пока не подключён. Укажите PRICE_FILE_URL в .env)")
+
+    # --- синхронные обёртки (совместимость с process_message и внешним кодом) ---
+
+    def _call(self, chat_id: str, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if running is not None and running is self._loop:
+            self._chain(chat_id, coro)
+            return True
+        if self._loop is not None and self._loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        return asyncio.run(self._standalone(coro))
+
+    async def _standalone(self, coro):
+        self.atransport = self._make_async_transport()
+        try:
+            return await coro
+        finally:
+            await self.atransport.aclose()
+            self.atransport = None
+
+    def _make_async_transport(self) -> AsyncGreenApiTransport:
+        transport = AsyncGreenApiTransport(
+            self.base_url, self.api_token,
+            pool_size=self.max_inflight,
+            retries=self.transport.retries,
+        )
+        transport.on_throttle = self.outbound.pause
+        transport.metrics = self.metrics
+        return transport
+
+    def _chain(self, chat_id: str, coro) -> asyncio.Task:
+        """Ставит операцию после предыдущей операции того же чата."""
+        prev = self._chains.get(chat_id)
+
+        async def runner():
+            if prev is not None:
+                try:
+                    await prev
+                except Exception:
+                    pass
+            return await coro
+
+        task = self._loop.create_task(runner())
+        self._chains[chat_id] = task
+        task.add_done_callback(lambda t: self._chains.pop(chat_id, None) if self._chains.get(chat_id) is t else None)
+        return task
+
+    def send_message(self, chat_id: str, message: str, priority: int = OutboundScheduler.INTERACTIVE) -> bool:
+        return self._call(chat_id, self.send_message_async(chat_id, message, priority))
+
+    def send_file_by_url(self, chat_id: str, file_url: str, file_name: str, caption: str = "",
+                         priority: int = OutboundScheduler.INTERACTIVE) -> bool:
+        return self._call(chat_id, self.send_file_by_url_async(chat_id, file_url, file_name, caption, priority))
+
+    def send_welcome_with_actions(self, chat_id: str, lang_code: str) -> bool:
+        return self._call(chat_id, self.send_welcome_with_actions_async(chat_id, lang_code))
+
+    def send_language_selection(self, chat_id: str) -> bool:
+        return self._call(chat_id, self.send_language_selection_async(chat_id))
+
+    def delete_notification(self, receipt_id: int) -> bool:
+        return self._call("__acks__", self.delete_notification_async(receipt_id))
+
+    def _reply_with_llm(self, chat_id: str, message_text: str):
+        self._call(chat_id, self._reply_with_llm_async(chat_id, message_text))
+
+    def _send_price(self, chat_id: str, lang_code: str):
+        self._call(chat_id, self._send_price_async(chat_id, lang_code))
+
+    def _schedule_coalesced_flush(self, chat_id: str):
+        # Таймер склейки срабатывает в своём потоке — сама обработка идёт в цикле событий
+        self._loop.call_soon_threadsafe(self._track, None, lambda: self._flush_coalesced(chat_id))
+
+    def _complete_acks(self, jids):
+        if self._deferred_acks is not None:
+            self._deferred_acks.extend(jids)  # ответ на серию ещё в цепочке чата
+        else:
+            super()._complete_acks(jids)
+
+    # --- журнал подтверждений ---
+
+    def _track(self, jid, route, release=None):
+        """
+        Маршрутизация синхронна, а I/O уходит в цепочки чатов. done в журнал подтверждений
+        пишется, только когда завершатся все операции, поставленные этой маршрутизацией.
+        """
+        before = set(self._chains.values())
+        jids = self._deferred_acks = []
+        deferred = False
+        try:
+            # True — текст ушёл в склейку, done запишет сброс серии
+            deferred = route() is True
+        except Exception as e:
+            logger.error(f"Ошибка обработки уведомления {jid}: {e}")
+        finally:
+            self._deferred_acks = None
+        if jid is not None and not deferred:
+            jids.append(jid)
+
+        def finish(_=None):
+            super(AsyncWhatsAppBot, self)._complete_acks(jids)
+            if release:
+                release()
+
+        started = [t for t in self._chains.values() if t not in before]
+        if started:
+            asyncio.gather(*started, return_exceptions=True).add_done_callback(finish)
+        else:
+            finish()
+
+    async def _offer_webhook(self, body: dict, inflight: asyncio.Semaphore) -> bool:
+        """Вебхук: нет свободного места — отказ (Green-API повторит доставку), иначе журнал и обработка."""
+        if inflight.locked():
+            return False
+        notification = {"receiptId": None, "body": body}
+        jid = f"wh:{body['idMessage']}" if body.get('idMessage') else None
+        if jid:
+            self.acks.accept(jid, notification)
+        await self._admit(jid, notification, inflight)
+        return True
+
+    async def _admit(self, jid, notification: dict, inflight: asyncio.Semaphore):
+        """Уведомление уже в журнале (accept) — ждём место под ограничением и маршрутизируем."""
+        await inflight.acquire()
+        item = {k: v for k, v in notification.items() if k != 'receiptId'}
+        item['journalId'] = jid
+        self._track(jid, lambda: self.process_message(item), inflight.release)
+
+    # --- главный цикл ---
+
+    def run(self):
         try:
-            if not self.price_url:
-                logger.warning("PRICE_FILE_URL не задан")
+            asyncio.run(self.run_async())
+        except KeyboardInterrupt:
+            logger.info("⛔ Бот остановлен")
+
+    async def run_async(self):
+        logger.info("🤖 Бот запущен (asyncio)!")
+        with self.startup.phase("/metrics"):
+            self.start_metrics_server()
+        with self.startup.phase("перенос языков"):
+            self.load_user_languages()
+        self.startup.background("проверка PRICE_FILE_URL", self._check_price_link)
+        self.startup.background("импорт openai", self.shared.async_openai)
+        self._loop = asyncio.get_running_loop()
+        inflight = asyncio.Semaphore(self.max_inflight)
+
+        self.atransport = self._make_async_transport()
+        settings = asyncio.create_task(self._apply_instance_settings_async())  # не ждём перед приёмом
+        try:
+            self.acks.start()
+            for jid, notification in self.acks.recover():
+                await self._admit(jid, {**notification, "replayed": True}, inflight)
+            self.startup.ready()
+
+            if self.webhook_url:
+                def on_webhook(body: dict) -> bool:
+                    # Потоки HTTP-сервера только передают тело в цикл событий; False — ответ 503
+                    offer = self._offer_webhook(body, inflight)
+                    try:
+                        return asyncio.run_coroutine_threadsafe(offer, self._loop).result(timeout=2)
+                    except Exception as e:
+                        logger.error(f"Вебхук не принят: {e}")
+                        return False
+
+                server = self.start_webhook_server(on_webhook)
+                try:
+                    await asyncio.Event().wait()
+                finally:
+                    server.stop()
                 return
-            r = requests.head(self.price_url, timeout=8, allow_redirects=True)
-            logger.info(f"PRICE_FILE_URL check: status={r.status_code}, size={r.headers.get('Content-Length')}")
+
+            while True:
+                try:
+                    notification = await self.get_notification_async(self.receive_timeout)
+                    if not notification:
+                        if not self.receive_timeout:
+                            await asyncio.sleep(1)
+                        continue
+
+                    receipt_id = notification.get('receiptId')
+                    if receipt_id is not None and (self.acks.is_pending(receipt_id)
+                                                   or self.acks.is_closed(receipt_id)):
+                        # Уже в журнале: прошлое удаление головы не удалось — повторяем только его
+                        self.acks.mark_acked(receipt_id, await self.delete_notification_async(receipt_id))
+                        continue
+
+                    if receipt_id is not None:
+                        self.acks.accept(receipt_id, notification)
+                    await self._admit(receipt_id, notification, inflight)
+                    # Голова очереди отдаётся повторно, пока её не удалят. Тело уже в журнале (accept),
+                    # поэтому освобождаем её сразу; при падении незавершённое переиграет recover()
+                    if receipt_id is not None:
+                        self.acks.mark_acked(receipt_id, await self.delete_notification_async(receipt_id))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Ошибка в главном цикле: {e}")
+                    await asyncio.sleep(5)
+        finally:
+            settings.cancel()
+            await asyncio.to_thread(self.acks.flush, 10)
+            self.processed_messages.flush()
+            await self.atransport.aclose()
+
+    async def _apply_instance_settings_async(self):
+        try:
+            await self.atransport.post("setSettings", json=self._instance_settings())
         except Exception as e:
-            logger.warning(f"Проверка PRICE_FILE_URL упала: {e}")
+            logger.warning(f"Не удалось применить setSettings: {e}")
+
+
+# === НЕСКОЛЬКО ИНСТАНСОВ В ОДНОМ ПРОЦЕССЕ ===
+def load_tenants(path: str) -> list:
+    """
+    TENANTS_FILE — JSON-список настроек инстансов. Ключи — как у переменных окружения (INSTANCE_ID,
+    INSTANCE_TOKEN, BRAND_NAME, SUPPORT_PHONE, PRICE_FILE_URL, SYSTEM_PROMPT_RU, WEBHOOK_PORT, ...),
+    плюс "name" — имя инстанса для метрик, состояния и файлов (по умолчанию INSTANCE_ID).
+    Чего в записи нет, берётся из окружения; OPENAI_*, LLM_BREAKER_* и кеш ответов — общие.
+    Состояние чатов — в общей базе (STATE_*), если в записи не задан свой STATE_BACKEND/STATE_DB.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        tenants = json.load(f)
+    out, seen = [], set()
+    for i, cfg in enumerate(tenants):
+        name = str(cfg.get("name") or cfg.get("INSTANCE_ID") or "")
+        if not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"{path}[{i}]: нужен name или INSTANCE_ID (буквы, цифры, . _ -)")
+        if name in seen:
+            raise ValueError(f"{path}: инстанс {name} описан дважды")
+        seen.add(name)
+        out.append({**cfg, "name": name})
+    return out
+
+
+def run_tenants(configs: list, engine: str = "threads"):
+    """Все инстансы в одном процессе: приём, воркеры и отправка — свои, SharedResources — общие."""
+    shared = SharedResources()
+    bot_class = AsyncWhatsAppBot if engine == "async" else WhatsAppBot
+    bots = [bot_class(config=cfg, shared=shared) for cfg in configs]
+    logger.info(f"🏢 Инстансов в процессе: {len(bots)} ({', '.join(bot.tenant for bot in bots)})")
+
+    if engine == "async":
+        async def run_all():
+            await asyncio.gather(*(bot.run_async() for bot in bots))
+
+        try:
+            asyncio.run(run_all())
+        except KeyboardInterrupt:
+            logger.info("⛔ Боты остановлены")
+        return
+
+    threads = [threading.Thread(target=bot.run, name=f"tenant-{bot.tenant}", daemon=True) for bot in bots]
+    for t in threads:
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logger.info("⛔ Боты остановлены")
+        for bot in bots:
+            bot.shutdown()
 
 
 if __name__ == "__main__":
     try:
-        bot = WhatsAppBot()
-        bot.run()
+        engine = os.environ.get("BOT_ENGINE", "threads").lower()
+        tenants_file = os.environ.get("TENANTS_FILE")
+        if "--profile-startup" in sys.argv[1:]:
+            # Холодный старт по фазам (threads, один инстанс): до первого опроса и фоновые задачи
+            imports = time.perf_counter() - _IMPORT_STARTED
+            bot = WhatsAppBot()
+            bot.startup.imports = imports
+            bot.run(profile=True)
+        elif tenants_file:
+            run_tenants(load_tenants(tenants_file), engine)
+        else:
+            bot = AsyncWhatsAppBot() if engine == "async" else WhatsAppBot()
+            bot.run()
     except Exception as e:
         print(f"Ошибка запуска: {e}")
         print(
-            "Проверьте переменные окружения: INSTANCE_ID, INSTANCE_TOKEN, OPENAI_API_KEY, BRAND_NAME, SUPPORT_PHONE, PRICE_FILE_URL, PRICE_FILE_NAME")
\ No newline at end of file
+            "Проверьте переменные окружения: INSTANCE_ID, INSTANCE_TOKEN, OPENAI_API_KEY, BRAND_NAME, SUPPORT_PHONE, PRICE_FILE_URL, PRICE_FILE_NAME")
@@ -0,0 +1,274 @@
+"""
+Воспроизведение записанного трафика на локальных заглушках Green-API и OpenAI (fakes.py).
+
+Запись включается в боте: TRAFFIC_CAPTURE=true (файл TRAFFIC_CAPTURE_FILE, по умолчанию requests.jsonl,
+номера и chatId анонимизированы). Здесь запись подаётся обратно в настоящий конвейер WhatsAppBot
+с исходными интервалами, сжатыми в N раз, или без пауз; порядок сообщений внутри чата сохраняется.
+Отчёт тот же, что у bench.py, плюс отставание подачи от расписания.
+
+    python replay.py requests.jsonl --speed 1            # в реальном темпе
+    python replay.py requests.jsonl --speed 20 --mode poll   # час пика за 3 минуты
+    python replay.py requests.jsonl --speed max --json replay.json --min-throughput 50
+"""
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import fakes
+from bench import configure_env, make_recording_metrics, percentiles, print_report, rss_mb
+
+
+def load_capture(path: str, limit: int = 0) -> list:
+    """[(смещение от начала записи в секундах, body)] в порядке файла; битые строки пропускаются."""
+    out = []
+    first = None
+    offset = 0.0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                ts, body = float(rec["capturedAt"]), rec["body"]
+            except (ValueError, KeyError, TypeError):
+                continue
+            if first is None:
+                first = ts
+            # Расписание не идёт назад (часы могли прыгнуть), иначе поехал бы порядок внутри чата
+            offset = max(offset, ts - first)
+            out.append((offset, body))
+            if limit and len(out) >= limit:
+                break
+    return out
+
+
+def chat_of(body: dict) -> str:
+    return (body.get("senderData") or {}).get("chatId", "")
+
+
+class Feeder:
+    """
+    Подаёт записи по расписанию (offset / speed; speed=0 — без пауз) выбранным способом.
+    Вебхуки шлются из lanes потоков; чат всегда попадает в одну и ту же полосу, так что его
+    сообщения уходят по одному и в исходном порядке.
+    """
+
+    def __init__(self, records: list, speed: float, deliver, lanes: int = 0):
+        self.records = records
+        self.speed = speed
+        self.deliver = deliver
+        self.lags = []
+        self._lags_lock = threading.Lock()
+        self._lanes = [queue.Queue() for _ in range(lanes)]
+        self._threads = [threading.Thread(target=self._lane, args=(q,), name=f"replay-lane-{i}", daemon=True)
+                         for i, q in enumerate(self._lanes)]
+        self._stop = threading.Event()
+        self.fed = threading.Event()
+
+    def _due(self, started: float, offset: float) -> float:
+        return started + offset / self.speed if self.speed else started
+
+    def _send(self, due: float, body: dict):
+        self.deliver(body)
+        with self._lags_lock:
+            self.lags.append(max(0.0, time.monotonic() - due))
+
+    def _lane(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            self._send(*item)
+
+    def run(self):
+        for t in self._threads:
+            t.start()
+        started = time.monotonic()
+        for offset, body in self.records:
+            due = self._due(started, offset)
+            delay = due - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            if self._lanes:
+                self._lanes[zlib.crc32(chat_of(body).encode("utf-8")) % len(self._lanes)].put((due, body))
+            else:
+                self._send(due, body)
+        for q in self._lanes:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self.fed.set()
+
+    def start(self) -> "Feeder":
+        threading.Thread(target=self.run, name="replay-feeder", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+def make_delivery(args, bot, main_module, green):
+    """Функция подачи одного тела уведомления и функция остановки приёма."""
+    if args.mode == "direct":
+        return lambda body: bot._submit(None, {"receiptId": None, "body": body}), lambda: None
+
+    if args.mode == "poll":
+        bot.receiver = main_module.NotificationReceiver(
+            bot.poll_notification, bot.dispatch, bot._release_head, receive_timeout=bot.receive_timeout,
+        )
+        threading.Thread(target=bot.receiver.run, name="replay-receiver", daemon=True).start()
+        return green.push, bot.receiver.stop
+
+    server = bot.start_webhook_server()
+    url = f"http://127.0.0.1:{server.port}{bot.webhook_path}"
+    local = threading.local()
+
+    def send(body):
+        if not hasattr(local, "sender"):
+            local.sender = fakes.FakeWebhookSender(url, bot.webhook_token)
+        while local.sender.send(body) == 503:
+            time.sleep(0.05)
+
+    return send, server.stop
+
+
+def parse_speed(value: str) -> float:
+    if value.lower() in ("max", "0"):
+        return 0.0
+    speed = float(value.lower().rstrip("x×"))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("скорость должна быть > 0 или max")
+    return speed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного трафика на локальных заглушках")
+    parser.add_argument("capture", nargs="?", default="requests.jsonl", help="файл записи (JSONL)")
+    parser.add_argument("--speed", type=parse_speed, default=1.0, help="1 — реальный темп, N — в N раз быстрее, max")
+    parser.add_argument("--limit", type=int, default=0, help="взять только первые N записей")
+    parser.add_argument("--mode", choices=["poll", "webhook", "direct"], default="direct")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--senders", type=int, default=16, help="полос отправки вебхуков")
+    parser.add_argument("--state", choices=["sqlite", "memory"], default="sqlite")
+    parser.add_argument("--streaming", action="store_true", help="стриминг ответов LLM")
+    parser.add_argument("--answer-cache", action="store_true", help="включить кеш ответов")
+    parser.add_argument("--coalesce-window", type=float, default=0, help="склейка сообщений, с (0 — выключена)")
+    parser.add_argument("--outbound-rate", type=float, default=0, help="лимит отправок в секунду (0 — без лимита)")
+    parser.add_argument("--green-latency", type=float, default=0.02)
+    parser.add_argument("--green-errors", type=float, default=0.0, help="доля 500 от Green-API")
+    parser.add_argument("--openai-latency", type=float, default=0.2)
+    parser.add_argument("--openai-errors", type=float, default=0.0, help="доля 500 от OpenAI")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="пауза между кусками стрима OpenAI")
+    parser.add_argument("--timeout", type=float, default=600, help="сколько ждать после окончания подачи")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="куда сохранить отчёт")
+    parser.add_argument("--min-throughput", type=float, default=0, help="код выхода 1, если msg/s ниже")
+    args = parser.parse_args()
+
+    args.capture = os.path.abspath(args.capture)
+    records = load_capture(args.capture, args.limit)
+    if not records:
+        sys.exit(f"В {args.capture} нет записей")
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    workdir = tempfile.mkdtemp(prefix="qdigit-replay-")
+    os.chdir(workdir)
+
+    green = fakes.FakeGreenApiServer(latency=args.green_latency, jitter=args.green_latency / 2,
+                                     error_rate=args.green_errors, seed=args.seed).start()
+    openai = fakes.FakeOpenAIServer(latency=args.openai_latency, jitter=args.openai_latency / 4,
+                                    error_rate=args.openai_errors, chunk_delay=args.chunk_delay,
+                                    seed=args.seed).start()
+    configure_env(args, green, openai, workdir)
+    os.environ["COALESCE_WINDOW"] = str(args.coalesce_window)
+    os.environ["TRAFFIC_CAPTURE"] = "false"
+
+    import main as main_module
+
+    for name in ('whatsapp_bot', 'httpx', 'openai'):
+        main_module.logging.getLogger(name).setLevel(main_module.logging.WARNING)
+
+    bot = main_module.WhatsAppBot()
+    bot.metrics = make_recording_metrics(main_module)
+    bot.transport.metrics = bot.metrics
+    if bot.workers > 0:
+        bot.dispatcher = main_module.ChatDispatcher(bot._process_journaled, bot.workers, bot.max_pending)
+        bot.dispatcher.start()
+    bot.acks.start()
+
+    total = len(records)
+    chats = {chat_of(body) for _, body in records}
+    deliver, stop_intake = make_delivery(args, bot, main_module, green)
+    feeder = Feeder(records, args.speed, deliver, lanes=args.senders if args.mode == "webhook" else 0)
+
+    rss_start = rss_mb()
+    started = time.monotonic()
+    feeder.start()
+    feeder.fed.wait()
+    fed_at = time.monotonic()
+    deadline = fed_at + args.timeout
+    while bot.metrics.count(("stage", "process")) < total and time.monotonic() < deadline:
+        time.sleep(0.02)
+    while bot.coalescer and any(bot.coalescer.pending(c) for c in chats) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    done = bot.metrics.count(("stage", "process"))
+
+    feeder.stop()
+    stop_intake()
+    if bot.coalescer:
+        bot.coalescer.stop()
+    if bot.dispatcher:
+        bot.dispatcher.stop(timeout=30)
+    bot.acks.flush(timeout=10)
+    bot.state.flush()
+
+    span = records[-1][0]
+    report = {
+        "mode": f"replay {args.mode} ×{args.speed:g}" if args.speed else f"replay {args.mode} max",
+        "capture": args.capture,
+        "chats": len(chats),
+        "messages": total,
+        "processed": done,
+        "timed_out": done < total,
+        "workers": bot.workers,
+        "captured_span": span,
+        "scheduled_span": span / args.speed if args.speed else 0.0,
+        "feed_elapsed": fed_at - started,
+        "elapsed": elapsed,
+        "msgs_per_sec": done / elapsed if elapsed else 0.0,
+        "feed_lag": percentiles(feeder.lags),
+        "openai_requests": openai.requests.get("chat.completions", 0),
+        "openai_errors": openai.errors,
+        "green_sends": green.sent_count,
+        "green_errors": green.errors,
+        "rss_start_mb": rss_start,
+        "rss_end_mb": rss_mb(),
+        "stages": {},
+        "llm_usage": bot.llm_usage.snapshot(),
+        "breaker": bot.llm_breaker.snapshot(),
+    }
+    for (group, name), samples in sorted(bot.metrics.samples.items(), key=lambda kv: (kv[0][0], str(kv[0][1]))):
+        report["stages"][f"{group}:{name}"] = percentiles(samples)
+
+    print_report(report)
+    lag = report["feed_lag"]
+    print(f"\nзапись: {span:.1f} с → по расписанию {report['scheduled_span']:.1f} с, подача заняла "
+          f"{report['feed_elapsed']:.1f} с; отставание подачи p95 {lag.get('p95', 0) * 1000:.0f} мс, "
+          f"max {lag.get('max', 0) * 1000:.0f} мс")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    green.stop()
+    openai.stop()
+    if report["timed_out"] or report["msgs_per_sec"] < args.min_throughput:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()